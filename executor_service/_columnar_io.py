@@ -0,0 +1,236 @@
+import mmap
+import struct
+import msgpack
+import numpy as np
+
+from contextlib import contextmanager
+from typing import BinaryIO, Any, Iterator
+
+from executor_service._msgpack_io import FORMAT_VERSION, encode_value, decode_ext
+
+
+__all__ = [
+    'ColumnarReader',
+    'columnar_reader',
+    'columnar_writer',
+    'column_values',
+    'MAGIC'
+]
+
+
+MAGIC = b'DWHCOL\x00\x01'
+
+ENCODING_MSGPACK = 0
+ENCODING_NUMPY = 1
+
+# числовые колонки, даты и время хранятся как есть, без создания объекта на каждое значение
+NUMPY_KINDS = 'biufM'
+
+_LEN = struct.Struct('>Q')
+_BLOCK = struct.Struct('>II')
+_COLUMN = struct.Struct('>BQ')
+_DTYPE_LEN = struct.Struct('>B')
+
+
+class ColumnarWriter:
+    """
+    Пишет результат блоками по block_size строк, каждая колонка блока упакована отдельно.
+    Формат: MAGIC, заголовок (длина + msgpack), затем блоки:
+    [число строк, число колонок][кодировка, длина колонки] * число колонок, данные колонок.
+    Колонки numpy числовых типов пишутся сырыми байтами с описанием dtype, остальные упаковываются в msgpack
+    """
+    def __init__(self, fd: BinaryIO, col_names: list[str], col_types: list[str], block_size: int):
+        self._fd = fd
+        self._block_size = block_size
+        self._packer = msgpack.Packer(default=encode_value, datetime=False)
+        self._rows = []
+        self.names = col_names
+        self.types = col_types
+        self.rows = 0
+        self.peak_batch_bytes = 0
+
+        header = self._packer.pack({'version': FORMAT_VERSION, 'names': col_names, 'types': col_types})
+        self._fd.write(MAGIC)
+        self._fd.write(_LEN.pack(len(header)))
+        self._fd.write(header)
+
+    def writerow(self, row: Any):
+        self._rows.append(row)
+        if len(self._rows) >= self._block_size:
+            self.flush()
+
+    def writerows(self, rows: list[Any]):
+        for row in rows:
+            self.writerow(row)
+
+    def write_columns(self, columns: list[list[Any] | np.ndarray]):
+        self.flush()
+        self._write_block(columns)
+
+    def flush(self):
+        if not self._rows:
+            return
+        columns = list(zip(*self._rows))
+        self._rows = []
+        self._write_block(columns)
+
+    def _write_block(self, columns: list):
+        if not columns or not len(columns[0]):
+            return
+        encoded = [self._encode_column(column) for column in columns]
+        lengths = [sum(len(part) for part in payload) for _, payload in encoded]
+        self.rows += len(columns[0])
+        self.peak_batch_bytes = max(self.peak_batch_bytes, sum(lengths))
+        self._fd.write(_BLOCK.pack(len(columns[0]), len(columns)))
+        for (encoding, _), length in zip(encoded, lengths):
+            self._fd.write(_COLUMN.pack(encoding, length))
+        for _, payload in encoded:
+            for part in payload:
+                self._fd.write(part)
+
+    def _encode_column(self, column) -> tuple[int, list[bytes | memoryview]]:
+        if isinstance(column, np.ndarray):
+            if column.dtype.kind not in NUMPY_KINDS:
+                return ENCODING_MSGPACK, [self._packer.pack(column.tolist())]
+            column = np.ascontiguousarray(column)
+            dtype = column.dtype.str.encode()
+            return ENCODING_NUMPY, [_DTYPE_LEN.pack(len(dtype)), dtype, column.view(np.uint8).data]
+        return ENCODING_MSGPACK, [self._packer.pack(list(column))]
+
+
+class ColumnarReader:
+    """
+    Читает блоки из отображенного в память файла, колонки распаковываются напрямую из mmap без копирования
+    """
+    def __init__(self, fd: BinaryIO):
+        self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        if self._view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('File is not in columnar format')
+        offset = len(MAGIC)
+        header_len, = _LEN.unpack_from(self._view, offset)
+        offset += _LEN.size
+        header = self._unpack(offset, header_len)
+        if header.get('version') != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f'Unsupported intermediate file version {header.get("version")}')
+
+        self.names = header['names']
+        self.types = header['types']
+        self._data_offset = offset + header_len
+
+    def __iter__(self):
+        for columns in self._python_batches():
+            yield from zip(*columns)
+
+    def batches(self, _size: int = None) -> Iterator[list[tuple]]:
+        """
+        Строки блоками в том размере, в котором они были записаны
+        """
+        for columns in self._python_batches():
+            yield list(zip(*columns))
+
+    def column_batches(self) -> Iterator[list[list | np.ndarray]]:
+        """
+        Колонки блоками, колонки в кодировке numpy возвращаются массивами поверх mmap без копирования
+        """
+        for _rows, columns in self._blocks():
+            yield [
+                self._column_array(offset, length) if encoding == ENCODING_NUMPY else self._unpack(offset, length)
+                for encoding, offset, length in columns
+            ]
+
+    def column_dtypes(self) -> list[np.dtype | None]:
+        """
+        Тип numpy каждой колонки, если во всех блоках она записана сырыми байтами одного типа, иначе None.
+        Читаются только заголовки блоков
+        """
+        dtypes = [None] * len(self.names)
+        first = True
+        for _rows, columns in self._blocks():
+            for i, (encoding, offset, _length) in enumerate(columns):
+                dtype = self._column_dtype(offset)[0] if encoding == ENCODING_NUMPY else None
+                if first:
+                    dtypes[i] = dtype
+                elif dtypes[i] != dtype:
+                    dtypes[i] = None
+            first = False
+        return dtypes
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # на файл еще ссылаются массивы из column_batches, отображение закроется при их удалении
+            pass
+
+    def _blocks(self) -> Iterator[tuple[int, list[tuple[int, int, int]]]]:
+        offset = self._data_offset
+        end = len(self._view)
+        while offset < end:
+            rows, cols = _BLOCK.unpack_from(self._view, offset)
+            offset += _BLOCK.size
+
+            headers = []
+            for _ in range(cols):
+                headers.append(_COLUMN.unpack_from(self._view, offset))
+                offset += _COLUMN.size
+
+            columns = []
+            for encoding, length in headers:
+                columns.append((encoding, offset, length))
+                offset += length
+            yield rows, columns
+
+    def _python_batches(self) -> Iterator[list[list]]:
+        for columns in self.column_batches():
+            yield [column_values(column) for column in columns]
+
+    def _column_dtype(self, offset: int) -> tuple[np.dtype, int]:
+        dtype_len, = _DTYPE_LEN.unpack_from(self._view, offset)
+        offset += _DTYPE_LEN.size
+        dtype = np.dtype(bytes(self._view[offset:offset + dtype_len]).decode())
+        return dtype, offset + dtype_len
+
+    def _column_array(self, offset: int, length: int) -> np.ndarray:
+        dtype, data_offset = self._column_dtype(offset)
+        return np.frombuffer(self._mmap, dtype=dtype, count=(offset + length - data_offset) // dtype.itemsize,
+                             offset=data_offset)
+
+    def _unpack(self, offset: int, length: int) -> Any:
+        with self._view[offset:offset + length] as data:
+            return msgpack.unpackb(data, ext_hook=decode_ext, strict_map_key=False)
+
+
+def column_values(column: list | np.ndarray) -> list:
+    """
+    Значения колонки объектами Python
+    """
+    if not isinstance(column, np.ndarray):
+        return column
+    if column.dtype.kind == 'M':
+        # tolist возвращает date для дней и datetime для точности до микросекунд, NaT становится None
+        unit = np.datetime_data(column.dtype)[0]
+        return column.tolist() if unit == 'D' else column.astype('datetime64[us]').tolist()
+    return column.tolist()
+
+
+@contextmanager
+def columnar_writer(path: str, col_names: list[str], col_types: list[str], block_size: int) -> ColumnarWriter:
+    with open(path, 'wb') as fd:
+        writer = ColumnarWriter(fd, col_names, col_types, block_size)
+        yield writer
+        writer.flush()
+
+
+@contextmanager
+def columnar_reader(path: str) -> ColumnarReader:
+    with open(path, 'rb') as fd:
+        reader = ColumnarReader(fd)
+        try:
+            yield reader
+        finally:
+            reader.close()
@@ -1,9 +1,11 @@
-import io
-
+import struct
 import msgpack
-from datetime import datetime, timezone
+
+from uuid import UUID
+from decimal import Decimal
+from datetime import date, datetime, time, timedelta
 from contextlib import contextmanager
-from typing import BinaryIO, Any
+from typing import BinaryIO, Any, Iterator
 
 
 __all__ = [
@@ -12,10 +14,52 @@ __all__ = [
 ]
 
 
-def handle_datetime(value):
+FORMAT_VERSION = 1
+
+EXT_DECIMAL = 1
+EXT_DATE = 2
+EXT_TIME = 3
+EXT_UUID = 4
+EXT_INTERVAL = 5
+EXT_DATETIME = 6
+
+_INTERVAL = struct.Struct('>iiI')
+_DATE = struct.Struct('>i')
+
+
+def encode_value(value):
+    # datetime проверяется раньше date, так как является его подклассом
     if isinstance(value, datetime):
-        return value.replace(tzinfo=timezone.utc)
-    raise TypeError(f'Value {repr(value)} is not serializable')
+        return msgpack.ExtType(EXT_DATETIME, value.isoformat().encode())
+    if isinstance(value, date):
+        return msgpack.ExtType(EXT_DATE, _DATE.pack(value.toordinal()))
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(value).encode())
+    if isinstance(value, time):
+        return msgpack.ExtType(EXT_TIME, value.isoformat().encode())
+    if isinstance(value, UUID):
+        return msgpack.ExtType(EXT_UUID, value.bytes)
+    if isinstance(value, timedelta):
+        return msgpack.ExtType(EXT_INTERVAL, _INTERVAL.pack(value.days, value.seconds, value.microseconds))
+    # типы без нативного представления (inet, range, ...) сохраняются в текстовом виде
+    return str(value)
+
+
+def decode_ext(code: int, data: bytes):
+    if code == EXT_DECIMAL:
+        return Decimal(data.decode())
+    if code == EXT_DATE:
+        return date.fromordinal(_DATE.unpack(data)[0])
+    if code == EXT_TIME:
+        return time.fromisoformat(data.decode())
+    if code == EXT_UUID:
+        return UUID(bytes=data)
+    if code == EXT_INTERVAL:
+        days, seconds, microseconds = _INTERVAL.unpack(data)
+        return timedelta(days=days, seconds=seconds, microseconds=microseconds)
+    if code == EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
 
 
 class PickleIO:
@@ -26,10 +70,22 @@ class PickleIO:
 
 
 class MsgpackWriter(PickleIO):
+    def __init__(self, fd: BinaryIO, col_names: list[str], col_types: list[str]):
+        super().__init__(fd)
+        self._packer = msgpack.Packer(default=encode_value, datetime=False)
+        self.names = col_names
+        self.types = col_types
+        self.writerow({'version': FORMAT_VERSION, 'names': col_names, 'types': col_types})
+        self.rows = 0
+        self.peak_batch_bytes = 0
+
     def writerow(self, row: Any):
-        data = msgpack.packb(row, default=handle_datetime, datetime=True)
+        data = self._packer.pack(row)
         self._fd.write(len(data).to_bytes(self.LEN_SIZE, byteorder='big'))
         self._fd.write(data)
+        self.rows += 1
+        if len(data) > self.peak_batch_bytes:
+            self.peak_batch_bytes = len(data)
 
     def writerows(self, rows: list[Any]):
         for row in rows:
@@ -40,6 +96,14 @@ class MsgpackReader(PickleIO):
     class Eof(Exception):
         pass
 
+    def __init__(self, fd: BinaryIO):
+        super().__init__(fd)
+        header = self.readrow()
+        if header.get('version') != FORMAT_VERSION:
+            raise ValueError(f'Unsupported intermediate file version {header.get("version")}')
+        self.names = header['names']
+        self.types = header['types']
+
     def __iter__(self):
         try:
             while True:
@@ -48,19 +112,30 @@ class MsgpackReader(PickleIO):
         except self.Eof:
             pass
 
+    def batches(self, size: int) -> Iterator[list[Any]]:
+        batch_records = []
+        for row in self:
+            batch_records.append(row)
+            if len(batch_records) >= size:
+                yield batch_records
+                batch_records = []
+
+        if batch_records:
+            yield batch_records
+
     def readrow(self) -> Any:
         length = self._fd.read(self.LEN_SIZE)
         if not length:
             raise self.Eof()
         length = int.from_bytes(length, byteorder='big')
         data = self._fd.read(length)
-        return msgpack.unpackb(data, timestamp=3)
+        return msgpack.unpackb(data, ext_hook=decode_ext, strict_map_key=False)
 
 
 @contextmanager
-def msgpack_writer(path: str) -> MsgpackWriter:
+def msgpack_writer(path: str, col_names: list[str], col_types: list[str]) -> MsgpackWriter:
     with open(path, 'wb') as fd:
-        yield MsgpackWriter(fd)
+        yield MsgpackWriter(fd, col_names, col_types)
 
 
 @contextmanager
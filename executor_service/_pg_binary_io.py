@@ -0,0 +1,166 @@
+import numpy as np
+
+from typing import Callable, Sequence
+
+
+__all__ = [
+    'COPY_SIGNATURE',
+    'COPY_TRAILER',
+    'copy_record_dtype',
+    'encode_copy_block',
+    'encode_copy_columns'
+]
+
+
+# заголовок бинарного COPY: сигнатура, флаги и длина расширения заголовка
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00' + b'\x00\x00\x00\x00' + b'\x00\x00\x00\x00'
+COPY_TRAILER = b'\xff\xff'
+
+# типы Postgres фиксированной длины, значения которых можно собрать из массивов numpy
+PG_BINARY_DTYPES = {
+    'bool': np.dtype('?'),
+    'int2': np.dtype('>i2'),
+    'int4': np.dtype('>i4'),
+    'int8': np.dtype('>i8'),
+    'float4': np.dtype('>f4'),
+    'float8': np.dtype('>f8'),
+    'date': np.dtype('>i4'),
+    'timestamp': np.dtype('>i8'),
+    'timestamptz': np.dtype('>i8'),
+}
+
+_PG_EPOCH = np.datetime64('2000-01-01', 'us')
+_PG_EPOCH_DAYS = np.datetime64('2000-01-01', 'D')
+
+_COUNT = np.dtype('>i2')
+_LENGTH = np.dtype('>i4')
+
+
+def copy_record_dtype(field_types: list[str], column_dtypes: list[np.dtype | None]) -> np.dtype | None:
+    """
+    Тип записи numpy, совпадающий с представлением строки в бинарном COPY:
+    число полей, затем длина и значение каждого поля.
+    Возвращает None, если хотя бы одну колонку нельзя записать без преобразования значений по одному
+    """
+    fields = [('count', '>i2')]
+    for i, (type_, dtype) in enumerate(zip(field_types, column_dtypes)):
+        pg_dtype = _field_dtype(type_, dtype)
+        if pg_dtype is None:
+            return None
+        fields.append((f'length_{i}', '>i4'))
+        fields.append((f'value_{i}', pg_dtype))
+    return np.dtype(fields)
+
+
+def encode_copy_block(record_dtype: np.dtype, field_types: list[str], columns: list[np.ndarray]) -> bytes:
+    """
+    Собирает строки блока в формате бинарного COPY.
+    NaT в колонках дат и времени записывается как NULL: длина -1 без значения
+    """
+    records = np.empty(len(columns[0]), dtype=record_dtype)
+    records['count'] = len(columns)
+    nulls = []
+    for i, (type_, column) in enumerate(zip(field_types, columns)):
+        value = f'value_{i}'
+        records[f'length_{i}'] = record_dtype[value].itemsize
+        records[value] = _field_values(type_, column)
+        if column.dtype.kind == 'M':
+            null = np.isnat(column)
+            if null.any():
+                records[f'length_{i}'][null] = -1
+                nulls.append((value, null))
+    if not nulls:
+        return records.tobytes()
+
+    # у NULL нет значения: его байты вырезаются из записей, остальные строки остаются фиксированной длины
+    keep = np.ones((len(records), record_dtype.itemsize), dtype=bool)
+    for value, null in nulls:
+        offset = record_dtype.fields[value][1]
+        keep[null, offset:offset + record_dtype[value].itemsize] = False
+    return records.view(np.uint8).reshape(keep.shape)[keep].tobytes()
+
+
+def encode_copy_columns(field_types: list[str], columns: list[list | np.ndarray],
+                        dump: Callable[[list[int], list[list | np.ndarray]], list[Sequence[bytes | None]]]) -> bytes:
+    """
+    Собирает строки блока в формате бинарного COPY из колонок любых типов.
+    Колонки numpy фиксированной длины кодируются целиком, по одному значению кодируются только остальные колонки,
+    затем поля каждой колонки раскладываются по строкам одной операцией
+    :param dump: Получает номера и значения колонок, которые нужно кодировать по одному,
+                 возвращает для каждой из них бинарные значения, None для NULL
+    """
+    rows = len(columns[0])
+    if not rows:
+        return b''
+    dtypes = [column.dtype if isinstance(column, np.ndarray) else None for column in columns]
+    record_dtype = copy_record_dtype(field_types, dtypes)
+    if record_dtype is not None:
+        return encode_copy_block(record_dtype, field_types, columns)
+
+    fixed = {}
+    for i, (type_, column) in enumerate(zip(field_types, columns)):
+        pg_dtype = _field_dtype(type_, dtypes[i])
+        if pg_dtype is not None:
+            fixed[i] = pg_dtype
+    variable = [i for i in range(len(columns)) if i not in fixed]
+    dumped = dict(zip(variable, dump(variable, [columns[i] for i in variable]))) if variable else {}
+
+    # для каждой колонки: длины значений (-1 для NULL) и значения всех строк подряд
+    fields = []
+    for i, (type_, column) in enumerate(zip(field_types, columns)):
+        if i in fixed:
+            values = np.empty(rows, dtype=fixed[i])
+            values[:] = _field_values(type_, column)
+            data = values.view(np.uint8).reshape(rows, values.itemsize)
+            lengths = np.full(rows, values.itemsize, dtype=np.int64)
+            if column.dtype.kind == 'M':
+                null = np.isnat(column)
+                lengths[null] = -1
+                data = data[~null]
+            data = data.reshape(-1)
+        else:
+            cells = dumped[i]
+            lengths = np.fromiter((-1 if cell is None else len(cell) for cell in cells), dtype=np.int64, count=rows)
+            data = np.frombuffer(b''.join(cell for cell in cells if cell is not None), dtype=np.uint8)
+        fields.append((lengths, data))
+
+    sizes = np.full(rows, _COUNT.itemsize, dtype=np.int64)
+    for lengths, _data in fields:
+        sizes += _LENGTH.itemsize + np.maximum(lengths, 0)
+    starts = np.zeros(rows, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    out[starts[:, None] + np.arange(_COUNT.itemsize)] = np.array([len(columns)], dtype=_COUNT).view(np.uint8)
+    offsets = starts + _COUNT.itemsize
+    for lengths, data in fields:
+        out[offsets[:, None] + np.arange(_LENGTH.itemsize)] = lengths.astype(_LENGTH).view(np.uint8).reshape(rows, -1)
+        offsets += _LENGTH.itemsize
+        # байт j значения строки попадает в offsets строки + j
+        value_lengths = np.maximum(lengths, 0)
+        data_starts = np.cumsum(value_lengths) - value_lengths
+        out[np.repeat(offsets - data_starts, value_lengths) + np.arange(len(data))] = data
+        offsets += value_lengths
+    return out.tobytes()
+
+
+def _field_dtype(type_: str, dtype: np.dtype | None) -> np.dtype | None:
+    """
+    Тип значения поля в бинарном COPY, если колонку типа dtype можно записать массивом без потери значений
+    """
+    pg_dtype = PG_BINARY_DTYPES.get(type_)
+    if pg_dtype is None or dtype is None:
+        return None
+    if type_ in ('date', 'timestamp', 'timestamptz'):
+        return pg_dtype if dtype.kind == 'M' else None
+    if dtype.kind == 'M' or not np.can_cast(dtype, pg_dtype, casting='safe'):
+        return None
+    return pg_dtype
+
+
+def _field_values(type_: str, column: np.ndarray) -> np.ndarray:
+    if type_ == 'date':
+        return (column.astype('datetime64[D]') - _PG_EPOCH_DAYS).astype(np.int64)
+    if type_ in ('timestamp', 'timestamptz'):
+        return (column.astype('datetime64[us]') - _PG_EPOCH).astype(np.int64)
+    return column
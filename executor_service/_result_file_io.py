@@ -0,0 +1,154 @@
+import os
+import re
+import csv
+import gzip
+
+from contextlib import contextmanager
+from typing import Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from executor_service._columnar_io import NUMPY_KINDS, column_values
+
+
+__all__ = [
+    'FILE_EXTENSIONS',
+    'result_file_writer'
+]
+
+
+FILE_EXTENSIONS = {
+    'csv': '.csv.gz',
+    'parquet': '.parquet',
+}
+
+
+class CsvResultWriter:
+    def __init__(self, fd, col_names: list[str]):
+        self._writer = csv.writer(fd)
+        self._writer.writerow(col_names)
+
+    def writerows(self, rows: list[Any]):
+        self._writer.writerows(rows)
+
+    def write_columns(self, columns: list[list | np.ndarray]):
+        self._writer.writerows(zip(*map(column_values, columns)))
+
+    def close(self):
+        pass
+
+
+class ParquetResultWriter:
+    """
+    Пишет результат в parquet группами строк по row_group_size.
+    Типы колонок берутся из типов Postgres, значения остальных типов сохраняются строками.
+    Колонки numpy передаются в arrow целиком, без создания объекта на каждое значение
+    """
+    def __init__(self, path: str, col_names: list[str], col_types: list[str], row_group_size: int):
+        arrow_types = _arrow_types()
+        types = [re.sub(r'\(.*\)', '', type_) for type_ in col_types]
+        self._types = [arrow_types.get(type_, pa.string()) for type_ in types]
+        self._as_text = [type_ not in arrow_types for type_ in types]
+        self._schema = pa.schema(list(zip(col_names, self._types)))
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._row_group_size = row_group_size
+        self._tables = []
+        self._rows = 0
+
+    def writerows(self, rows: list[Any]):
+        if rows:
+            self.write_columns([[row[i] for row in rows] for i in range(len(self._types))])
+
+    def write_columns(self, columns: list[list | np.ndarray]):
+        arrays = [
+            self._to_array(column, type_, as_text)
+            for column, type_, as_text in zip(columns, self._types, self._as_text)
+        ]
+        self._tables.append(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._rows += len(arrays[0])
+        if self._rows >= self._row_group_size:
+            self._flush()
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+
+    def abort(self):
+        """
+        Закрывает файл без записи накопленных строк
+        """
+        self._writer.close()
+
+    def _flush(self):
+        if not self._tables:
+            return
+        table = pa.concat_tables(self._tables)
+        self._tables = []
+        self._rows = 0
+        self._writer.write_table(table, row_group_size=self._row_group_size)
+
+    @staticmethod
+    def _to_array(column: list | np.ndarray, type_: pa.DataType, as_text: bool) -> pa.Array:
+        if isinstance(column, np.ndarray) and column.dtype.kind in NUMPY_KINDS and not as_text:
+            # NaT становится null, приведение к типу колонки проверяет переполнение
+            array = pa.array(column)
+            return array if array.type == type_ else array.cast(type_)
+        values = column_values(column)
+        if as_text:
+            values = [None if value is None else str(value) for value in values]
+        return pa.array(values, type=type_)
+
+
+def _arrow_types() -> dict:
+    return {
+        'bool': pa.bool_(),
+        'int2': pa.int16(),
+        'int4': pa.int32(),
+        'int8': pa.int64(),
+        'float4': pa.float32(),
+        'float8': pa.float64(),
+        'text': pa.string(),
+        'varchar': pa.string(),
+        'bpchar': pa.string(),
+        'name': pa.string(),
+        'bytea': pa.binary(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('us'),
+        'timestamptz': pa.timestamp('us', tz='UTC'),
+    }
+
+
+@contextmanager
+def result_file_writer(path: str, col_names: list[str], col_types: list[str], file_format: str,
+                       row_group_size: int):
+    """
+    Пишет файл результата во временный файл рядом и переименовывает его после успешной записи
+    :param file_format: csv (сжатый gzip) или parquet
+    """
+    if file_format not in FILE_EXTENSIONS:
+        raise ValueError(f'Unknown result file format {file_format}')
+
+    part_path = f'{path}.part'
+    try:
+        if file_format == 'csv':
+            with gzip.open(part_path, 'wt', newline='', encoding='utf-8', compresslevel=6) as fd:
+                writer = CsvResultWriter(fd, col_names)
+                yield writer
+                writer.close()
+        else:
+            writer = ParquetResultWriter(part_path, col_names, col_types, row_group_size)
+            try:
+                yield writer
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, path)
@@ -0,0 +1,59 @@
+import os
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from executor_service import metrics
+from executor_service._msgpack_io import msgpack_reader, msgpack_writer
+from executor_service._columnar_io import MAGIC, columnar_reader, columnar_writer
+from executor_service.settings import settings
+
+
+__all__ = [
+    'SpillStats',
+    'spill_reader',
+    'spill_writer'
+]
+
+
+@dataclass
+class SpillStats:
+    """
+    Объем записанного промежуточного файла. peak_batch_bytes — самый большой блок колонок
+    (для msgpack — самая большая строка) в упакованном виде
+    """
+    rows: int = 0
+    bytes: int = 0
+    peak_batch_bytes: int = 0
+
+
+@contextmanager
+def spill_writer(path: str, col_names: list[str], col_types: list[str], stats: SpillStats | None = None):
+    started = time.monotonic()
+    if settings.spill_format == 'columnar':
+        with columnar_writer(path, col_names, col_types, settings.spill_block_size) as writer:
+            yield writer
+    else:
+        with msgpack_writer(path, col_names, col_types) as writer:
+            yield writer
+
+    elapsed = time.monotonic() - started
+    size = os.path.getsize(path)
+    if elapsed > 0:
+        metrics.SPILL_ROWS_PER_SECOND.observe(writer.rows / elapsed)
+        metrics.SPILL_BYTES_PER_SECOND.observe(size / elapsed)
+    if stats is not None:
+        stats.rows = writer.rows
+        stats.bytes = size
+        stats.peak_batch_bytes = writer.peak_batch_bytes
+
+
+@contextmanager
+def spill_reader(path: str):
+    with open(path, 'rb') as fd:
+        is_columnar = fd.read(len(MAGIC)) == MAGIC
+
+    reader = columnar_reader if is_columnar else msgpack_reader
+    with reader(path) as reader:
+        yield reader
@@ -2,17 +2,20 @@
 import asyncio
 import os
 import logging
-from typing import Callable
 
 from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from executor_service.endpoints import queries, keys, publications
 from executor_service.services.publish_request_lifespan import publish_request
+from executor_service.services.outbox import relay
 from executor_service.errors import APIError
 from executor_service.auth import load_jwks
-from executor_service.mq import create_channel
+from executor_service.mq import create_channel, consume, consumers_stats, publisher
+from executor_service.database.results import open_results_pool, close_results_pool, results_pool_stats
+from executor_service.database.sources import close_source_pools
 from executor_service.settings import settings
 
 logger = logging.getLogger(__name__)
@@ -45,6 +48,7 @@ executor_app.include_router(keys.router, prefix='/v1')
 @executor_app.on_event('startup')
 async def on_startup():
     await load_jwks()
+    await open_results_pool()
 
     async with create_channel() as channel:
         await channel.exchange_declare(settings.publish_exchange, 'direct')
@@ -55,7 +59,23 @@ async def on_startup():
         await channel.queue_declare(settings.publish_result_queue)
         await channel.queue_bind(settings.publish_result_queue, settings.publish_exchange, 'result')
 
-        asyncio.create_task(consume(settings.publish_request_queue, publish_request))
+        if settings.execution_backend == 'mq':
+            await channel.queue_declare(settings.execute_task_queue)
+
+        asyncio.create_task(relay())
+        asyncio.create_task(consume(
+            settings.publish_request_queue,
+            publish_request,
+            prefetch_count=settings.publish_consumer_prefetch,
+            concurrency=settings.publish_consumer_concurrency
+        ))
+
+
+@executor_app.on_event('shutdown')
+async def on_shutdown():
+    await publisher.close()
+    await close_results_pool()
+    await close_source_pools()
 
 
 @executor_app.middleware("http")
@@ -94,6 +114,39 @@ def health() -> JSONResponse:
     )
 
 
+@executor_app.get("/health/pools")
+def health_pools() -> JSONResponse:
+    """
+    Connection pool metrics
+    :return: JSONResponse
+    """
+    return JSONResponse(
+        status_code=200,
+        content={"results": results_pool_stats()},
+    )
+
+
+@executor_app.get("/health/consumers")
+async def health_consumers() -> JSONResponse:
+    """
+    Queue consumer metrics: backlog, in-flight handlers and handler latency
+    :return: JSONResponse
+    """
+    return JSONResponse(
+        status_code=200,
+        content={"consumers": await consumers_stats()},
+    )
+
+
+@executor_app.get("/metrics")
+async def metrics() -> Response:
+    """
+    Prometheus metrics, collected in the event loop that owns the pools and the scheduler
+    :return: Response
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @executor_app.exception_handler(APIError)
 def api_exception_handler(_request: Request, exc: APIError) -> JSONResponse:
     """
@@ -107,21 +160,3 @@ def api_exception_handler(_request: Request, exc: APIError) -> JSONResponse:
         status_code=exc.status_code,
         content={"message": exc.message},
     )
-
-
-async def consume(query, func: Callable):
-    while True:
-        try:
-            logger.info(f'Starting {query} worker')
-            async with create_channel() as channel:
-                async for delivery_tag, body in channel.consume(query):
-                    try:
-                        await func(body, channel)
-                        await channel.basic_ack(delivery_tag)
-                    except Exception as e:
-                        logger.exception(f'Failed to process message {body}: {e}')
-                        await channel.basic_reject(delivery_tag, requeue=False)
-        except Exception as e:
-            logger.exception(f'Worker {query} failed: {e}')
-
-        await asyncio.sleep(0.5)
@@ -1,3 +1,10 @@
+import time
+import asyncio
+import hashlib
+import logging
+
+from collections import OrderedDict
+
 import httpx
 import jwt
 
@@ -7,25 +14,95 @@ from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
 from executor_service.settings import settings
 
 
+LOG = logging.getLogger(__name__)
+
 __PUBLIC_KEYS = {}
 
+# sha256 токена -> (проверенные claims, время, до которого их можно использовать)
+__CLAIMS: OrderedDict[bytes, tuple[dict, float]] = OrderedDict()
+
+__jwks_refresh: asyncio.Task | None = None
+__jwks_loaded_at = 0.0
+
 
 async def load_jwks():
-    __PUBLIC_KEYS.clear()
+    global __jwks_loaded_at
 
+    public_keys = {}
     async with httpx.AsyncClient() as requests:
         response = await requests.get(f'{settings.api_iam}/auth/.well-known/jwks.json')
         data = response.json()
 
         for jwk in data:
             numbers = RSAPublicNumbers(e=jwk['e'], n=jwk['n'])
-            __PUBLIC_KEYS[jwk['kid']] = numbers.public_key().public_bytes(
+            public_keys[jwk['kid']] = numbers.public_key().public_bytes(
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PublicFormat.SubjectPublicKeyInfo
             )
 
+    if __PUBLIC_KEYS.keys() - public_keys.keys():
+        # отозванные ключи не должны продолжать действовать через кэш
+        __CLAIMS.clear()
+    __PUBLIC_KEYS.clear()
+    __PUBLIC_KEYS.update(public_keys)
+    __jwks_loaded_at = time.monotonic()
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        LOG.error(f'Failed to refresh JWKS: {task.exception()}')
+
+
+async def _public_key(kid: str) -> bytes:
+    """
+    Ключ по kid. При промахе ключи перезагружаются в фоне, не чаще jwks_refresh_interval.
+    Одновременные промахи ждут одну и ту же загрузку
+    """
+    global __jwks_refresh
+
+    key = __PUBLIC_KEYS.get(kid)
+    if key is not None:
+        return key
+
+    if __jwks_refresh is None or __jwks_refresh.done():
+        if time.monotonic() - __jwks_loaded_at < settings.jwks_refresh_interval:
+            raise KeyError(kid)
+        __jwks_refresh = asyncio.create_task(load_jwks())
+        __jwks_refresh.add_done_callback(_log_refresh_error)
+
+    await asyncio.shield(__jwks_refresh)
+    return __PUBLIC_KEYS[kid]
+
+
+def _cached_claims(token_hash: bytes) -> dict | None:
+    item = __CLAIMS.get(token_hash)
+    if item is None:
+        return None
+    claims, valid_until = item
+    if time.time() >= valid_until:
+        del __CLAIMS[token_hash]
+        return None
+    __CLAIMS.move_to_end(token_hash)
+    return claims
+
+
+def _cache_claims(token_hash: bytes, claims: dict):
+    valid_until = time.time() + settings.jwt_cache_ttl
+    if 'exp' in claims:
+        valid_until = min(valid_until, float(claims['exp']))
+    __CLAIMS[token_hash] = (claims, valid_until)
+    while len(__CLAIMS) > settings.jwt_cache_max_entries:
+        __CLAIMS.popitem(last=False)
+
 
 async def decode_jwt(token: str):
+    token_hash = hashlib.sha256(token.encode()).digest()
+    claims = _cached_claims(token_hash)
+    if claims is not None:
+        return claims
+
     headers = jwt.get_unverified_header(token)
-    key = __PUBLIC_KEYS[headers['kid']]
-    return jwt.decode(token, key, algorithms=['RS256'])
+    key = await _public_key(headers['kid'])
+    claims = jwt.decode(token, key, algorithms=['RS256'])
+    _cache_claims(token_hash, claims)
+    return claims
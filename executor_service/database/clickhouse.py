@@ -1,57 +1,157 @@
+import json
 import logging
-import pandas as pd
-import numpy as np
+import threading
 
 
-from typing import Iterable
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
 
 from clickhouse_connect import get_client
 from clickhouse_connect.driver.client import Client
 from clickhouse_connect.driver.exceptions import ClickHouseError
+from clickhouse_connect.driver.query import quote_identifier
 
 from executor_service.settings import settings
 
 LOG = logging.getLogger(__name__)
 
 
+# соответствие типов Postgres (udt_name из information_schema) типам ClickHouse
+PG_CLICKHOUSE_TYPES = {
+    'bool': 'Bool',
+    'int2': 'Int16',
+    'int4': 'Int32',
+    'int8': 'Int64',
+    'float4': 'Float32',
+    'float8': 'Float64',
+    'text': 'String',
+    'varchar': 'String',
+    'bpchar': 'String',
+    'name': 'String',
+    'bytea': 'String',
+    'uuid': 'UUID',
+    'date': 'Date32',
+    'timestamp': 'DateTime64(6)',
+    'timestamptz': "DateTime64(6, 'UTC')",
+}
+# значения остальных типов (time, interval, inet, ...) публикуются в текстовом виде
+TEXT_CONVERTERS = {
+    'json': json.dumps,
+    'jsonb': json.dumps,
+}
+# numeric без точности
+DEFAULT_DECIMAL = 'Decimal(76, 20)'
+# наибольшая точность Decimal в ClickHouse, numeric большей точности публикуется строкой
+MAX_DECIMAL_PRECISION = 76
+# типы, по которым таблица публикации разбивается на партиции по месяцам
+TEMPORAL_TYPES = {'date', 'timestamp', 'timestamptz'}
+
+
+@dataclass
+class PublishColumn:
+    name: str
+    udt_name: str
+    precision: int | None = None
+    scale: int | None = None
+
+    @property
+    def is_array(self) -> bool:
+        return self.udt_name.startswith('_')
+
+    @property
+    def clickhouse_type(self) -> str:
+        element_type = self._element_type()
+        if self.is_array:
+            return f'Array(Nullable({element_type}))'
+        return f'Nullable({element_type})'
+
+    @property
+    def converter(self) -> Callable[[Any], Any] | None:
+        """
+        Преобразование значения для колонки, тип которой публикуется строкой
+        """
+        udt_name = self.udt_name.removeprefix('_')
+        if udt_name in PG_CLICKHOUSE_TYPES or udt_name == 'numeric' and self._element_type() != 'String':
+            return None
+        convert = TEXT_CONVERTERS.get(udt_name, str)
+        if self.is_array:
+            return lambda values: [None if value is None else convert(value) for value in values]
+        return convert
+
+    def _element_type(self) -> str:
+        udt_name = self.udt_name.removeprefix('_')
+        if udt_name == 'numeric':
+            if self.precision is None or self.is_array:
+                return DEFAULT_DECIMAL
+            if self.precision > MAX_DECIMAL_PRECISION:
+                return 'String'
+            return f'Decimal({self.precision}, {self.scale or 0})'
+        return PG_CLICKHOUSE_TYPES.get(udt_name, 'String')
+
+
 class ClickhouseService:
+    """
+    Клиент ClickHouse, общий для одновременных обработчиков публикации. При потере соединения
+    пересоздается один раз, остальные обработчики продолжают с новым клиентом
+    """
     def __init__(self):
         self._conn_string = settings.clickhouse_connection_string
+        self._lock = threading.Lock()
         self.client: Client | None = None
 
     def connect(self):
-        self.client = get_client(dsn=settings.clickhouse_connection_string)
+        # клиент используют одновременные обработчики, а запросы в одной сессии ClickHouse
+        # выполняются только последовательно (SESSION_IS_LOCKED), поэтому клиент создается без сессии
+        self.client = get_client(dsn=settings.clickhouse_connection_string, autogenerate_session_id=False)
         return self
 
-    def create_publish_table(self, publish_name: str, df: pd.DataFrame):
+    def create_publish_table(self, publish_name: str, columns: list[PublishColumn],
+                             order_by: list[str] | None = None, partition_by: str | None = None):
+        """
+        :param order_by: Колонки ключа сортировки, по умолчанию id
+        :param partition_by: Колонка партиционирования, даты разбиваются по месяцам
+        """
         self._ping()
-        col_names_and_types = self._get_col_names_and_types_from_df(df)
-        schema = ','.join(col_names_and_types)
+        types = {column.name: column for column in columns}
+        for name in [*(order_by or []), *([partition_by] if partition_by else [])]:
+            if name not in types:
+                raise ValueError(f'Column {name} is not in query result')
+
+        schema = ','.join(f'{quote_identifier(column.name)} {column.clickhouse_type}' for column in columns)
+        order_key = ','.join(map(quote_identifier, order_by)) if order_by else 'id'
+        partition = ''
+        if partition_by:
+            partition = quote_identifier(partition_by)
+            if types[partition_by].udt_name in TEMPORAL_TYPES:
+                partition = f'toYYYYMM({partition})'
+            partition = f'PARTITION BY {partition}'
+        # колонки результата допускают NULL, для ключей по ним нужна allow_nullable_key
+        key_settings = 'SETTINGS allow_nullable_key = 1' if order_by or partition_by else ''
+
         self.client.command(
             f"""
                 CREATE OR REPLACE TABLE {{table:Identifier}} (id UInt64, {schema})
                 ENGINE MergeTree()
-                ORDER BY id
+                {partition}
+                ORDER BY ({order_key})
+                {key_settings}
             """,
             parameters={'table': publish_name}
         )
 
-    def _get_col_names_and_types_from_df(self, df: pd.DataFrame) -> Iterable[str]:
-        df_json = df.head(2).to_json(orient="records")
-        res = self.client.query(
-            'DESC format(JSONEachRow, {df_json:String})',
-            parameters={'df_json': df_json}
-        )
-        col_names_and_types = (
-            f"{res_tuple[0]} {res_tuple[1]}"
-            for res_tuple in reversed(res.result_rows)
-        )
-        return col_names_and_types
-
-    def insert_dataframe(self, table: str, df: pd.DataFrame):
-        self._ping()
-        df['id'] = np.arange(1, df.shape[0] + 1)
-        self.client.insert_df(table, df)
+    def insert_rows(self, table: str, column_names: list[str], rows: list[Any],
+                    converters: Iterable[Callable[[Any], Any] | None] = ()):
+        """
+        Вставляет пачку строк публикации. Соединение проверяется один раз за публикацию в create_publish_table
+        """
+        converters = list(converters)
+        if any(converters):
+            rows = [
+                [value if value is None or convert is None else convert(value)
+                 for value, convert in zip(row, converters)]
+                for row in rows
+            ]
+        self.client.insert(table, rows, column_names=column_names)
 
     def exist(self, publish_name) -> bool:
         self._ping()
@@ -62,10 +162,14 @@ class ClickhouseService:
         return res.result_rows[0][0]
 
     def _ping(self):
+        client = self.client
         try:
-            self.client.query('SELECT 1')
+            client.query('SELECT 1')
         except ClickHouseError:
-            self.connect()
+            with self._lock:
+                # клиента мог уже пересоздать другой обработчик
+                if self.client is client:
+                    self.connect()
 
 
 clickhouse_client = ClickhouseService().connect()
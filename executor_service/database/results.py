@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from psycopg_pool import AsyncConnectionPool
+
+from executor_service import metrics
+from executor_service.settings import settings
+
+LOG = logging.getLogger(__name__)
+
+
+results_pool = AsyncConnectionPool(
+    settings.db_connection_string_results,
+    open=False,
+    name='results',
+    min_size=settings.results_pool_min_size,
+    max_size=settings.results_pool_max_size,
+    max_idle=settings.results_pool_max_idle,
+    timeout=settings.results_pool_timeout,
+)
+
+_check_task: asyncio.Task | None = None
+
+
+async def open_results_pool():
+    global _check_task
+
+    await results_pool.open()
+    _check_task = asyncio.create_task(_check_results_pool())
+
+
+async def close_results_pool():
+    if _check_task is not None:
+        _check_task.cancel()
+    await results_pool.close()
+
+
+def results_pool_stats() -> dict[str, int]:
+    return results_pool.get_stats()
+
+
+def _results_pool_gauges() -> dict[tuple, int]:
+    stats = results_pool.get_stats()
+    return {
+        ('size',): stats.get('pool_size', 0),
+        ('available',): stats.get('pool_available', 0),
+        ('waiting',): stats.get('requests_waiting', 0),
+        ('max',): results_pool.max_size,
+    }
+
+
+metrics.add_gauge(
+    'query_executor_results_pool',
+    'Results database connection pool usage',
+    ['state'],
+    _results_pool_gauges,
+)
+
+
+async def _check_results_pool():
+    """
+    Периодически проверяет простаивающие соединения и заменяет разорванные
+    """
+    while True:
+        await asyncio.sleep(settings.results_pool_check_interval)
+        try:
+            await results_pool.check()
+        except Exception as e:
+            LOG.warning(f'Results pool check failed: {repr(e)}')
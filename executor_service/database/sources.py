@@ -0,0 +1,297 @@
+import time
+import threading
+
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator
+
+import psycopg
+
+from clickhouse_connect import get_client
+from clickhouse_connect.driver.client import Client
+from clickhouse_connect.driver.exceptions import OperationalError
+from psycopg_pool import AsyncConnectionPool
+
+from executor_service import metrics
+from executor_service.errors import SourcePoolTimeoutError
+from executor_service.settings import settings
+
+
+async def _reset_session(conn: psycopg.AsyncConnection):
+    # возвращает application_name и остальные параметры сессии к начальным значениям,
+    # чтобы отмена по application_name не нашла чужой запрос
+    await conn.set_autocommit(True)
+    await conn.execute('DISCARD ALL')
+    await conn.set_autocommit(False)
+
+
+class PostgresPools:
+    """
+    Пулы соединений к базам-источникам Postgres по строке подключения.
+    Пулы, не использовавшиеся дольше max_idle, и самые старые пулы сверх max_pools закрываются.
+    Пул с выданными соединениями не закрывается, иначе к источнику открылось бы больше max_size соединений
+    """
+    def __init__(self, max_pools: int, max_size: int, max_idle: float, timeout: float):
+        self._max_pools = max_pools
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._pools: OrderedDict[str, tuple[AsyncConnectionPool, float]] = OrderedDict()
+        self._in_use = Counter()
+
+    @asynccontextmanager
+    async def connection(self, conn_string: str) -> AsyncIterator[psycopg.AsyncConnection]:
+        """
+        Соединение из пула источника. Использование пула отмечается и при выдаче, и при возврате соединения
+        """
+        self._in_use[conn_string] += 1
+        try:
+            pool = await self._get(conn_string)
+            async with pool.connection() as conn:
+                yield conn
+        finally:
+            self._in_use[conn_string] -= 1
+            if not self._in_use[conn_string]:
+                del self._in_use[conn_string]
+            self._touch(conn_string)
+
+    async def _get(self, conn_string: str) -> AsyncConnectionPool:
+        await self._evict()
+        pool, _ = self._pools.pop(conn_string, (None, None))
+        if pool is None:
+            pool = AsyncConnectionPool(
+                conn_string,
+                open=False,
+                min_size=0,
+                max_size=self._max_size,
+                max_idle=self._max_idle,
+                timeout=self._timeout,
+                reset=_reset_session,
+            )
+        self._pools[conn_string] = (pool, time.monotonic())
+        await pool.open()
+        return pool
+
+    def _touch(self, conn_string: str):
+        if conn_string in self._pools:
+            pool, _ = self._pools[conn_string]
+            self._pools[conn_string] = (pool, time.monotonic())
+            self._pools.move_to_end(conn_string)
+
+    def stats(self) -> dict[str, int]:
+        # в воркере метрики собираются в потоке HTTP-сервера, словарь копируется до обхода
+        pools = [pool for pool, _ in list(self._pools.values())]
+        size = available = waiting = 0
+        for pool in pools:
+            stats = pool.get_stats()
+            size += stats.get('pool_size', 0)
+            available += stats.get('pool_available', 0)
+            waiting += stats.get('requests_waiting', 0)
+        return {'pools': len(pools), 'size': size, 'available': available, 'waiting': waiting}
+
+    async def close(self):
+        while self._pools:
+            _, (pool, _) = self._pools.popitem()
+            await pool.close()
+
+    async def _evict(self):
+        now = time.monotonic()
+        evicted = []
+        for conn_string, (pool, last_used) in list(self._pools.items()):
+            if len(self._pools) < self._max_pools and now - last_used < self._max_idle:
+                break
+            if self._in_use[conn_string]:
+                continue
+            del self._pools[conn_string]
+            evicted.append(pool)
+        # пулы убираются из словаря до первого await, чтобы параллельный get не получил закрываемый пул
+        for pool in evicted:
+            await pool.close()
+
+
+class ClickHouseClientPool:
+    """
+    Потокобезопасный пул клиентов ClickHouse к одной базе, клиент выдается в монопольное пользование.
+    Если все max_size клиентов заняты, клиент ожидается не дольше timeout
+    """
+    def __init__(self, conn_string: str, max_size: int, max_idle: float, timeout: float):
+        self._conn_string = conn_string
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._idle: list[tuple[Client, float]] = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.last_used = time.monotonic()
+
+    @contextmanager
+    def client(self) -> Client:
+        client = self._acquire()
+        broken = False
+        try:
+            yield client
+        except OperationalError:
+            # соединение с сервером могло быть разорвано, не возвращаем клиента в пул
+            broken = True
+            raise
+        finally:
+            if broken:
+                self._discard(client)
+            else:
+                self._release(client)
+
+    def stats(self) -> tuple[int, int]:
+        """
+        :return: Число открытых клиентов и число свободных из них
+        """
+        with self._cond:
+            return self._size, len(self._idle)
+
+    @property
+    def in_use(self) -> bool:
+        with self._cond:
+            return self._size > len(self._idle)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for client, _ in idle:
+            client.close()
+
+    def _acquire(self) -> Client:
+        with self._cond:
+            self._evict_idle()
+            self.last_used = time.monotonic()
+            if not self._cond.wait_for(lambda: self._idle or self._size < self._max_size, self._timeout):
+                raise SourcePoolTimeoutError()
+            if self._idle:
+                client, _ = self._idle.pop()
+                return client
+            self._size += 1
+
+        try:
+            return get_client(dsn=self._conn_string)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, client: Client):
+        with self._cond:
+            self.last_used = time.monotonic()
+            if not self._closed:
+                self._idle.append((client, time.monotonic()))
+                self._cond.notify()
+                return
+        self._discard(client)
+
+    def _discard(self, client: Client):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        client.close()
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        expired = [client for client, last_used in self._idle if now - last_used >= self._max_idle]
+        if not expired:
+            return
+        self._idle = [(client, last_used) for client, last_used in self._idle if now - last_used < self._max_idle]
+        self._size -= len(expired)
+        for client in expired:
+            client.close()
+
+
+class ClickHousePools:
+    """
+    Пулы клиентов ClickHouse по строке подключения, доступны из рабочих потоков.
+    Как и пулы Postgres, пул с выданными клиентами не закрывается
+    """
+    def __init__(self, max_pools: int, max_size: int, max_idle: float, timeout: float):
+        self._max_pools = max_pools
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._pools: OrderedDict[str, tuple[ClickHouseClientPool, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conn_string: str) -> ClickHouseClientPool:
+        with self._lock:
+            evicted = self._evict()
+            pool, _ = self._pools.pop(conn_string, (None, None))
+            if pool is None:
+                pool = ClickHouseClientPool(conn_string, self._max_size, self._max_idle, self._timeout)
+            self._pools[conn_string] = (pool, time.monotonic())
+
+        for evicted_pool in evicted:
+            evicted_pool.close()
+        return pool
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            pools = [pool for pool, _ in self._pools.values()]
+        size = available = 0
+        for pool in pools:
+            pool_size, pool_available = pool.stats()
+            size += pool_size
+            available += pool_available
+        return {'pools': len(pools), 'size': size, 'available': available}
+
+    def close(self):
+        with self._lock:
+            pools = [pool for pool, _ in self._pools.values()]
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def _evict(self) -> list[ClickHouseClientPool]:
+        now = time.monotonic()
+        evicted = []
+        for conn_string, (pool, last_used) in list(self._pools.items()):
+            if len(self._pools) < self._max_pools and now - max(last_used, pool.last_used) < self._max_idle:
+                break
+            if pool.in_use:
+                continue
+            del self._pools[conn_string]
+            evicted.append(pool)
+        return evicted
+
+
+postgres_pools = PostgresPools(
+    max_pools=settings.source_pool_max_dsns,
+    max_size=settings.source_pool_max_size,
+    max_idle=settings.source_pool_max_idle,
+    timeout=settings.source_pool_timeout,
+)
+
+clickhouse_pools = ClickHousePools(
+    max_pools=settings.source_pool_max_dsns,
+    max_size=settings.source_pool_max_size,
+    max_idle=settings.source_pool_max_idle,
+    timeout=settings.source_pool_timeout,
+)
+
+
+def _source_pool_gauges() -> dict[tuple, int]:
+    gauges = {}
+    for source, stats in (('postgresql', postgres_pools.stats()), ('clickhouse', clickhouse_pools.stats())):
+        for state, value in stats.items():
+            gauges[(source, state)] = value
+    return gauges
+
+
+metrics.add_gauge(
+    'query_executor_source_pools',
+    'Source database connection pools usage, summed over connection strings',
+    ['source', 'state'],
+    _source_pool_gauges,
+)
+
+
+async def close_source_pools():
+    await postgres_pools.close()
+    clickhouse_pools.close()
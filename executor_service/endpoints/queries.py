@@ -1,23 +1,31 @@
-import asyncio
-import io
+import os
+import time
+import base64
 import logging
-import sys
-import pandas as pd
+
+from datetime import datetime
+from typing import Any, Awaitable, Callable
 
 from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
-from sqlalchemy import select, update
+from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio.session import AsyncSession
 
+from executor_service import metrics
 from executor_service.schemas.queries import QueryErrorIn, QueryIn, QueryDeleteIn
 from executor_service.services.executor import (
-    execute_query, get_query_result, terminate_query, send_notification, delete_query_execs
+    scheduler, submit_execution, get_query_result, get_query_result_page, terminate_query,
+    release_results, invalidate_results, stream_query_result_csv
 )
 from executor_service.dependencies import db_session, get_user
-from executor_service.models.queries import QueryExecution, QueryDestination, QueryDestinationStatus
+from executor_service.models.queries import QueryExecution, QueryDestination, QueryStatus
+from executor_service.services import outbox
 from executor_service.services.crypto import encrypt
+from executor_service.services.page_cache import QueryAccess, access_cache, page_cache
+from executor_service.services.result_cache import cache_key
 from executor_service.settings import settings
 
 
@@ -34,9 +42,13 @@ logger = logging.getLogger(__name__)
 
 
 def available_to_user(query: QueryExecution, user: dict):
+    return available_to_identity(query.identity_id, user)
+
+
+def available_to_identity(identity_id: str | None, user: dict):
     if user.get('is_superuser'):
         return True
-    return query.identity_id == user['identity_id']
+    return identity_id == user['identity_id']
 
 
 async def select_query_exec(guid: str, user: dict, session: AsyncSession) -> QueryExecution:
@@ -68,26 +80,115 @@ async def select_query_execs(guids: list[str], user: dict, session: AsyncSession
     return queries
 
 
-async def select_query_result(guid: str, limit: int, offset: int, user: dict, session: AsyncSession) -> list[dict]:
-    query = await select_query_exec(guid, user, session)
+async def select_query_access(guid: str, user: dict, session: AsyncSession) -> QueryAccess:
+    """
+    Владелец и расположение результатов запуска. Завершенные запуски берутся из кэша без загрузки из базы
+    """
+    access = access_cache.get(guid)
+    if access is not None:
+        if not available_to_identity(access.identity_id, user):
+            raise HTTPException(status_code=401)
+        return access
 
+    query = await select_query_exec(guid, user, session)
     results = {
         dest.dest_type: dest for dest in query.results
     }
-    if 'table' not in results:
+    access = QueryAccess(
+        identity_id=query.identity_id,
+        status=query.status,
+        db_table=results['table'].path if 'table' in results else None,
+        file_path=results['file'].path if 'file' in results else None,
+    )
+    if access.status == QueryStatus.DONE.value:
+        access_cache.put(guid, access)
+    return access
+
+
+def result_table(access: QueryAccess) -> str:
+    if access.db_table is None:
         raise HTTPException(status_code=422, detail='Query does not have results stored in table')
+    return access.db_table
+
+
+async def select_result_table(guid: str, user: dict, session: AsyncSession) -> str:
+    access = await select_query_access(guid, user, session)
+    return result_table(access)
+
+
+async def select_result_file(guid: str, user: dict, session: AsyncSession) -> str:
+    access = await select_query_access(guid, user, session)
+    if not access.file_path:
+        raise HTTPException(status_code=422, detail='Query does not have results stored in file')
+    return access.file_path
+
+
+async def cached_page(guid: str, key: tuple, user: dict, session: AsyncSession,
+                      load_page: Callable[[str], Awaitable[Any]]) -> Response:
+    """
+    Страница результатов из кэша. Таблицы результатов завершенных запусков не меняются,
+    поэтому страницы кэшируются после перехода запуска в DONE и удаляются вместе с результатами
+    :param load_page: Загрузка страницы из таблицы результатов
+    """
+    started = time.monotonic()
+    cached = page_cache.get(guid, *key)
+    if cached is not None:
+        identity_id, data = cached
+        if not available_to_identity(identity_id, user):
+            raise HTTPException(status_code=401)
+        metrics.PAGE_SECONDS.labels(key[0], 'hit').observe(time.monotonic() - started)
+        return Response(data, media_type='application/json')
+
+    access = await select_query_access(guid, user, session)
+    page = await load_page(result_table(access))
+    data = JSONResponse(jsonable_encoder(page)).body
+    if access.status == QueryStatus.DONE.value:
+        page_cache.put(guid, *key, identity_id=access.identity_id, data=data)
+    metrics.PAGE_SECONDS.labels(key[0], 'miss').observe(time.monotonic() - started)
+    return Response(data, media_type='application/json')
+
+
+def encode_cursor(seq: int | None) -> str | None:
+    if seq is None:
+        return None
+    return base64.urlsafe_b64encode(str(seq).encode()).decode()
+
+
+def decode_cursor(cursor: str | None) -> int:
+    if not cursor:
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=422, detail='Invalid cursor')
+
 
-    rows = await get_query_result(results['table'].path, limit, offset)
-    return rows
+async def fail_submission(query: QueryExecution, session: AsyncSession):
+    """
+    Завершает ошибкой запуск, который не удалось передать на выполнение, чтобы он не остался в очереди навсегда
+    """
+    await session.refresh(query, with_for_update=True)
+    if query.status != QueryStatus.QUEUED.value:
+        return
+    query.status = QueryStatus.ERROR.value
+    query.error_description = 'Failed to submit query for execution'
+    outbox.add_status_event(session, query)
+    await session.commit()
 
 
-@router.post("/", response_model=dict[str, int | str])
+@router.post("/", response_model=dict[str, int | str | None])
 async def execute(query_data: QueryIn, session=Depends(db_session)):
+    if settings.execution_backend != 'mq':
+        scheduler.check_capacity()
+
     query = QueryExecution(
         guid=query_data.run_guid,
         query=query_data.query,
         db=encrypt(settings.encryption_key, query_data.conn_string),
         identity_id=query_data.identity_id,
+        status=QueryStatus.QUEUED.value,
+        queued_at=datetime.utcnow(),
+        cache_key=cache_key(query_data.query, query_data.conn_string) if query_data.use_cache else None,
     )
     session.add(query)
 
@@ -96,10 +197,15 @@ async def execute(query_data: QueryIn, session=Depends(db_session)):
         query.results.append(dest)
     await session.commit()
 
-    asyncio.create_task(execute_query(query.id, query_data.conn_string))
+    try:
+        position = await submit_execution(query, query_data.conn_string, query_data.priority)
+    except Exception:
+        await fail_submission(query, session)
+        raise
     return {
         'id': query.id,
         'guid': query.guid,
+        'queue_position': position,
     }
 
 
@@ -129,8 +235,7 @@ async def log_download(guid: str, session=Depends(db_session), user=Depends(get_
 
 @router.delete("/{guid}")
 async def terminate(guid: str):
-    query = await terminate_query(guid)
-    await send_notification(query)
+    await terminate_query(guid)
 
 
 @router.get("/{guid}", response_model=dict)
@@ -149,13 +254,25 @@ async def get_query(guid: str, session=Depends(db_session), user=Depends(get_use
 
     return {
         'status': query.status,
+        'queue_position': scheduler.position(query.id),
         'error': query.error_description,
+        'stages': {
+            'queued_at': query.queued_at,
+            'source_started_at': query.source_started_at,
+            'first_row_at': query.first_row_at,
+            'source_finished_at': query.source_finished_at,
+        },
+        'rows_count': query.rows_count,
+        'spill_bytes': query.spill_bytes,
+        'peak_batch_bytes': query.peak_batch_bytes,
         'result_destinations': [{
             'type': dest.dest_type,
             'status': dest.status,
             'error': dest.error_description,
             'path': dest.path,
             'creds': dest.access_creds,
+            'load_started_at': dest.load_started_at,
+            'loaded_at': dest.finished_at,
         }
             for dest in query.results
         ],
@@ -168,44 +285,75 @@ async def get_result(guid: str,
                      offset: int = Query(default=0, ge=0),
                      session=Depends(db_session),
                      user=Depends(get_user)):
-    return await select_query_result(guid, limit, offset, user, session)
+    return await cached_page(
+        guid, ('offset', limit, offset), user, session,
+        lambda db_table: get_query_result(db_table, limit, offset)
+    )
 
 
-@router.get('/{guid}/download')
-async def download_result(guid: str, session=Depends(db_session), user=Depends(get_user)):
-    rows = await select_query_result(guid, sys.maxsize, 0, user, session)
+@router.get("/{guid}/results/page", response_model=dict)
+async def get_result_page(guid: str,
+                          limit: int = Query(default=MAX_LIMIT-1, gt=0, lt=MAX_LIMIT),
+                          cursor: str | None = Query(default=None),
+                          session=Depends(db_session),
+                          user=Depends(get_user)):
+    """
+    Страница результатов по курсору: стоимость запроса не зависит от номера страницы.
+    Для следующей страницы передается next_cursor из ответа, null означает последнюю страницу
+    """
+    after = decode_cursor(cursor)
+
+    async def load_page(db_table: str) -> dict:
+        rows, last_seq = await get_query_result_page(db_table, limit, after)
+        return {
+            'result': rows,
+            'next_cursor': encode_cursor(last_seq),
+        }
 
-    df = pd.DataFrame(rows)
-    stream = io.StringIO()
-    df.to_csv(stream, index=False)
+    return await cached_page(guid, ('cursor', limit, after), user, session, load_page)
+
+
+@router.get('/{guid}/download')
+async def download_result(guid: str,
+                          compress: bool = Query(default=False),
+                          session=Depends(db_session),
+                          user=Depends(get_user)):
+    db_table = await select_result_table(guid, user, session)
 
     response = StreamingResponse(
-        iter([stream.getvalue()]),
-        media_type='text/csv',
+        stream_query_result_csv(db_table, compress=compress),
+        media_type='application/gzip' if compress else 'text/csv',
         headers={
-            'Content-Disposition': 'attachment; filename=result.csv',
+            'Content-Disposition': f'attachment; filename=result.csv{".gz" if compress else ""}',
             'Access-Control-Expose-Headers': 'Content-Disposition'
         }
     )
     return response
 
 
+@router.get('/{guid}/results/file')
+async def download_result_file(guid: str, session=Depends(db_session), user=Depends(get_user)):
+    path = await select_result_file(guid, user, session)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail='Result file was deleted')
+
+    return FileResponse(
+        path,
+        media_type='application/gzip' if path.endswith('.gz') else 'application/octet-stream',
+        filename=os.path.basename(path),
+        headers={'Access-Control-Expose-Headers': 'Content-Disposition'}
+    )
+
+
 @router.post('/delete-results')
 async def delete_results(query_delete_in: QueryDeleteIn, session=Depends(db_session), user=Depends(get_user)):
     queries = await select_query_execs(query_delete_in.guids, user, session)
     if not queries:
         return
     results = [{dest.dest_type: dest for dest in query.results} for query in queries]
-    try:
-        paths = [res['table'].path for res in results if res['table'].path]
-    except KeyError:
-        raise HTTPException(status_code=422, detail='Query does not have results stored in table')
-    else:
-        await delete_query_execs(paths)
-
-    query_ids = [query.id for query in queries]
-    await session.execute(
-        update(QueryDestination)
-        .where(QueryDestination.query_id.in_(query_ids))
-        .values(status=QueryDestinationStatus.DELETED.value)
-    )
+    if any('table' not in res and 'file' not in res for res in results):
+        raise HTTPException(status_code=422, detail='Query does not have results stored in table or file')
+
+    guids = await release_results(session, queries)
+    await session.commit()
+    invalidate_results(guids)
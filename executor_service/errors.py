@@ -25,3 +25,13 @@ class QueryNotFoundError(QueryError):
 
 class QueryNotRunning(QueryError):
     message: str = 'Query is not in the running state'
+
+
+class QueueFullError(APIError):
+    status_code: int = status.HTTP_429_TOO_MANY_REQUESTS
+    message: str = 'Query execution queue is full, try again later'
+
+
+class SourcePoolTimeoutError(APIError):
+    status_code: int = status.HTTP_503_SERVICE_UNAVAILABLE
+    message: str = 'No free connection to the source database, try again later'
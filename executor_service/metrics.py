@@ -0,0 +1,100 @@
+import asyncio
+from typing import Callable
+
+from prometheus_client import REGISTRY, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+
+__all__ = [
+    'SOURCE_EXECUTION_SECONDS',
+    'SPILL_ROWS_PER_SECOND',
+    'SPILL_BYTES_PER_SECOND',
+    'DEST_LOAD_SECONDS',
+    'PAGE_SECONDS',
+    'NOTIFICATION_PUBLISH_SECONDS',
+    'add_gauge',
+    'refresh_gauges'
+]
+
+
+_LONG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf'))
+
+SOURCE_EXECUTION_SECONDS = Histogram(
+    'query_executor_source_execution_seconds',
+    'Time from sending a query to the source until its result is fully read',
+    ['source'],
+    buckets=_LONG_BUCKETS,
+)
+SPILL_ROWS_PER_SECOND = Histogram(
+    'query_executor_spill_rows_per_second',
+    'Rows written to the intermediate result file per second',
+    buckets=(1e2, 1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, float('inf')),
+)
+SPILL_BYTES_PER_SECOND = Histogram(
+    'query_executor_spill_bytes_per_second',
+    'Bytes written to the intermediate result file per second',
+    buckets=(1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8, 1e9, float('inf')),
+)
+DEST_LOAD_SECONDS = Histogram(
+    'query_executor_destination_load_seconds',
+    'Time to load a result into a destination',
+    ['dest_type'],
+    buckets=_LONG_BUCKETS,
+)
+PAGE_SECONDS = Histogram(
+    'query_executor_result_page_seconds',
+    'Result page latency',
+    ['pagination', 'cache'],
+)
+NOTIFICATION_PUBLISH_SECONDS = Histogram(
+    'query_executor_notification_publish_seconds',
+    'Time from publishing a status notification until the broker confirms it',
+)
+
+
+class _CallbackGauges:
+    """
+    Gauge, значения которых читаются из состояния сервиса в момент сбора метрик.
+    Если метрики отдает HTTP-сервер в отдельном потоке, состояние читается только в событийном цикле:
+    refresh_gauges периодически снимает значения, а сбор отдает последний снимок
+    """
+    def __init__(self):
+        self._gauges: list[tuple[str, str, list[str], Callable[[], dict[tuple, float]]]] = []
+        self._snapshot: dict[str, dict[tuple, float]] | None = None
+
+    def add(self, name: str, documentation: str, labels: list[str], values: Callable[[], dict[tuple, float]]):
+        self._gauges.append((name, documentation, labels, values))
+
+    def take_snapshot(self):
+        # снимок заменяется целиком, поток сбора метрик видит либо старый, либо новый словарь
+        self._snapshot = {name: dict(values()) for name, _documentation, _labels, values in self._gauges}
+
+    def collect(self):
+        snapshot = self._snapshot
+        for name, documentation, labels, values in self._gauges:
+            gauge = GaugeMetricFamily(name, documentation, labels=labels)
+            current = values() if snapshot is None else snapshot.get(name, {})
+            for label_values, value in current.items():
+                gauge.add_metric(list(label_values), value)
+            yield gauge
+
+
+_callback_gauges = _CallbackGauges()
+REGISTRY.register(_callback_gauges)
+
+
+def add_gauge(name: str, documentation: str, labels: list[str], values: Callable[[], dict[tuple, float]]):
+    """
+    :param values: Значения gauge по кортежам значений меток
+    """
+    _callback_gauges.add(name, documentation, labels, values)
+
+
+async def refresh_gauges(interval: float):
+    """
+    Обновляет снимок gauge в событийном цикле, после первого снимка сбор метрик отдает только снимки
+    :param interval: Период обновления снимка в секундах
+    """
+    while True:
+        _callback_gauges.take_snapshot()
+        await asyncio.sleep(interval)
@@ -10,6 +10,7 @@ from executor_service.database.sqlalchemy import Base
 
 class QueryStatus(Enum):
     CREATED = 'created'
+    QUEUED = 'queued'
     DONE = 'done'
     RUNNING = 'running'
     CANCELLED = 'cancelled'
@@ -33,6 +34,15 @@ class QueryExecution(Base):
     identity_id = Column(String(36))
     status = Column(String(36), default=QueryStatus.CREATED.value)
     error_description = Column(Text, nullable=True)
+    cache_key = Column(String(64), nullable=True)
+
+    queued_at = Column(DateTime)
+    source_started_at = Column(DateTime)
+    first_row_at = Column(DateTime)
+    source_finished_at = Column(DateTime)
+    rows_count = Column(BigInteger)
+    spill_bytes = Column(BigInteger)
+    peak_batch_bytes = Column(BigInteger)
 
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
     updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, server_onupdate=func.now())
@@ -50,4 +60,28 @@ class QueryDestination(Base):
     status = Column(String(36), default=QueryDestinationStatus.DECLARED.value)
     error_description = Column(Text, nullable=True)
     access_creds = Column(Text)
+    load_started_at = Column(DateTime)
     finished_at = Column(DateTime)
+
+
+class QueryResultCache(Base):
+    __tablename__ = 'result_cache'
+
+    id = Column(BigInteger, primary_key=True)
+    key = Column(String(64), nullable=False, unique=True, index=True)
+    query_id = Column(BigInteger, ForeignKey('queries.id'))
+    db_table = Column(Text, nullable=False)
+
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
+    last_used_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
+
+
+class OutboxEvent(Base):
+    __tablename__ = 'outbox'
+
+    id = Column(BigInteger, primary_key=True)
+    exchange = Column(String(255), nullable=False)
+    routing_key = Column(String(255), nullable=False)
+    body = Column(Text, nullable=False)
+
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
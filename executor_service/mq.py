@@ -1,18 +1,91 @@
+import time
 import logging
 import asyncio
 import pika
 
+from collections import deque
 from contextlib import asynccontextmanager
+from typing import Callable
 
 from pika.channel import Channel
 from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.exceptions import ChannelClosedByClient, AMQPError
+from pika.frame import Method
 
+from executor_service import metrics
 from executor_service.settings import settings
 
 logger = logging.getLogger(__name__)
 
 
+class ConsumerStats:
+    """
+    Метрики потребителя очереди: сообщения, полученные от брокера и ожидающие обработчика,
+    работающие обработчики и время обработки по последним latency_window сообщениям
+    """
+    def __init__(self, queue: str, prefetch_count: int, concurrency: int, latency_window: int = 1000):
+        self.queue = queue
+        self.prefetch_count = prefetch_count
+        self.concurrency = concurrency
+        self.received = 0
+        self.started = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=latency_window)
+
+    def start(self):
+        self.started += 1
+        self.in_flight += 1
+
+    def finish(self, latency: float, failed: bool):
+        self.in_flight -= 1
+        self.processed += 1
+        self.failed += failed
+        self._latencies.append(latency)
+
+    def as_dict(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            'prefetch_count': self.prefetch_count,
+            'concurrency': self.concurrency,
+            'backlog': self.received - self.started,
+            'in_flight': self.in_flight,
+            'processed': self.processed,
+            'failed': self.failed,
+            'latency': {
+                'avg': sum(latencies) / len(latencies) if latencies else None,
+                'p50': latencies[len(latencies) // 2] if latencies else None,
+                'p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+
+consumer_stats: dict[str, ConsumerStats] = {}
+
+
+def _consumer_gauges() -> dict[tuple, float]:
+    gauges = {}
+    for queue, stats in consumer_stats.items():
+        gauges[(queue, 'prefetch')] = stats.prefetch_count
+        gauges[(queue, 'concurrency')] = stats.concurrency
+        gauges[(queue, 'backlog')] = stats.received - stats.started
+        gauges[(queue, 'in_flight')] = stats.in_flight
+        gauges[(queue, 'acked')] = stats.processed - stats.failed
+        gauges[(queue, 'failed')] = stats.failed
+    return gauges
+
+
+metrics.add_gauge(
+    'query_executor_consumer_messages',
+    'Queue consumer prefetch limit, concurrency, messages waiting for a handler, '
+    'messages in flight and total acked and failed messages',
+    ['queue', 'state'],
+    _consumer_gauges,
+)
+
+
 class PikaChannel:
     conn: AsyncioConnection | None = None
 
@@ -56,23 +129,41 @@ class PikaChannel:
         async with self.wait_for_callback('Queue.BindOk') as callback:
             self._channel.queue_bind(queue, exchange, routing_key, callback=callback)
 
+    async def basic_qos(self, prefetch_count: int):
+        async with self.wait_for_callback('Basic.QosOk') as callback:
+            self._channel.basic_qos(prefetch_count=prefetch_count, callback=callback)
+
     async def basic_ack(self, delivery_tag: int):
         self._channel.basic_ack(delivery_tag)
 
     async def basic_reject(self, delivery_tag: int, requeue: bool):
         self._channel.basic_reject(delivery_tag, requeue=requeue)
 
-    async def basic_publish(self, exchange: str, routing_key: str, body: bytes):
-        self._channel.basic_publish(exchange, routing_key, body)
+    async def basic_publish(self, exchange: str, routing_key: str, body: bytes,
+                            properties: pika.BasicProperties | None = None):
+        self._channel.basic_publish(exchange, routing_key, body, properties)
 
-    async def consume(self, queue: str) -> bytes:
+    async def message_count(self, queue: str) -> int:
         loop = asyncio.get_running_loop()
-        messages = asyncio.Queue()
-        self._channel.basic_consume(
-            queue,
-            on_message_callback=lambda _channel, method, _props, body: messages.put_nowait((method.delivery_tag, body)),
-            auto_ack=False
+        fut = loop.create_future()
+        self._channel.queue_declare(
+            queue, passive=True, callback=lambda method: fut.set_result(method.method.message_count)
         )
+        return await fut
+
+    async def consume(self, queue: str, prefetch_count: int | None = None,
+                      stats: ConsumerStats | None = None) -> bytes:
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        if prefetch_count:
+            await self.basic_qos(prefetch_count)
+
+        def on_message(_channel, method, _props, body):
+            if stats is not None:
+                stats.received += 1
+            messages.put_nowait((method.delivery_tag, body))
+
+        self._channel.basic_consume(queue, on_message_callback=on_message, auto_ack=False)
 
         fut = loop.create_future()
 
@@ -104,22 +195,154 @@ class PikaChannel:
             self._close_callbacks.remove(on_close_callback)
 
 
+class MessageNacked(AMQPError):
+    pass
+
+
+class ConfirmChannel:
+    """
+    Канал в режиме подтверждений издателя. Публикации не ждут друг друга:
+    брокер подтверждает их пачками (multiple), и одно подтверждение завершает все ожидающие публикации до него
+    """
+    def __init__(self, channel: Channel):
+        self._channel = channel
+        self._pending: dict[int, asyncio.Future] = {}
+        self._next_tag = 1
+        self._channel.add_on_close_callback(self._on_close)
+
+    @classmethod
+    async def open(cls, conn: AsyncioConnection, timeout: float) -> 'ConfirmChannel':
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        conn.channel(on_open_callback=lambda ch: fut.set_result(ch))
+        channel = cls(await asyncio.wait_for(fut, timeout))
+
+        async with PikaChannel.wait_for_callback('Confirm.SelectOk') as callback:
+            channel._channel.confirm_delivery(channel._on_confirm, callback=callback)
+        return channel
+
+    @property
+    def is_open(self) -> bool:
+        return self._channel.is_open
+
+    def publish(self, exchange: str, routing_key: str, body: bytes | str,
+                properties: pika.BasicProperties | None = None) -> asyncio.Future:
+        """
+        :return: Future, завершающийся при подтверждении сообщения брокером
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._channel.basic_publish(exchange, routing_key, body, properties)
+        self._pending[self._next_tag] = fut
+        self._next_tag += 1
+        return fut
+
+    def close(self):
+        if self._channel.is_open:
+            self._channel.close()
+
+    def _on_confirm(self, frame: Method):
+        method = frame.method
+        if method.multiple:
+            # номера доставок растут, ожидающие публикации хранятся в порядке отправки
+            tags = []
+            for tag in self._pending:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._pending else []
+
+        for tag in tags:
+            fut = self._pending.pop(tag)
+            if fut.done():
+                continue
+            if method.NAME == 'Basic.Ack':
+                fut.set_result(None)
+            else:
+                fut.set_exception(MessageNacked(f'Message {tag} was rejected by broker'))
+
+    def _on_close(self, _channel: Channel, reason: Exception):
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(reason)
+
+
+class Publisher:
+    """
+    Долгоживущий издатель на общем соединении с пулом каналов в режиме подтверждений.
+    Закрытые каналы и соединение открываются заново при следующей публикации
+    """
+    def __init__(self, pool_size: int, timeout: float):
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._channels: list[ConfirmChannel] = []
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def publish(self, exchange: str, routing_key: str, body: bytes | str,
+                      properties: pika.BasicProperties | None = None):
+        """
+        Публикует сообщение и ждет подтверждения брокера.
+        Если канал или соединение закрылись до подтверждения, публикация повторяется один раз через новый канал
+        """
+        for attempt in range(2):
+            try:
+                channel = await self._channel()
+                await asyncio.wait_for(channel.publish(exchange, routing_key, body, properties), self._timeout)
+                return
+            except AMQPError as err:
+                if attempt:
+                    raise
+                logger.warning(f'Failed to publish message to {exchange or routing_key}, retrying: {err}')
+
+    async def close(self):
+        async with self._lock:
+            channels, self._channels = self._channels, []
+        for channel in channels:
+            channel.close()
+
+    async def _channel(self) -> ConfirmChannel:
+        self._channels = [channel for channel in self._channels if channel.is_open]
+        if len(self._channels) < self._pool_size:
+            async with self._lock:
+                self._channels = [channel for channel in self._channels if channel.is_open]
+                if len(self._channels) < self._pool_size:
+                    conn = await create_connection()
+                    self._channels.append(await ConfirmChannel.open(conn, self._timeout))
+
+        self._next = (self._next + 1) % len(self._channels)
+        return self._channels[self._next]
+
+
+_connection_lock = asyncio.Lock()
+
+
 async def create_connection():
-    if PikaChannel.conn:
-        return PikaChannel.conn
+    async with _connection_lock:
+        if PikaChannel.conn and PikaChannel.conn.is_open:
+            return PikaChannel.conn
 
-    loop = asyncio.get_running_loop()
+        loop = asyncio.get_running_loop()
 
-    fut = loop.create_future()
-    AsyncioConnection(
-        pika.URLParameters(settings.mq_connection_string),
-        on_open_callback=lambda c: fut.set_result(c),
-        on_open_error_callback=lambda c, exc: fut.set_exception(exc),
-        on_close_callback=lambda c, exc: fut.set_exception(exc)
-    )
-    conn = await fut
-    PikaChannel.conn = conn
-    return PikaChannel.conn
+        fut = loop.create_future()
+
+        def on_close_callback(conn: AsyncioConnection, exc: Exception):
+            # закрытое соединение будет открыто заново следующим create_connection
+            if PikaChannel.conn is conn:
+                PikaChannel.conn = None
+            if not fut.done():
+                fut.set_exception(exc)
+
+        AsyncioConnection(
+            pika.URLParameters(settings.mq_connection_string),
+            on_open_callback=lambda c: fut.set_result(c),
+            on_open_error_callback=lambda c, exc: fut.set_exception(exc),
+            on_close_callback=on_close_callback
+        )
+        conn = await fut
+        PikaChannel.conn = conn
+        return PikaChannel.conn
 
 
 @asynccontextmanager
@@ -134,6 +357,76 @@ async def create_channel() -> PikaChannel:
     try:
         yield PikaChannel(channel)
     finally:
-        PikaChannel.conn = None
         if channel.is_open:
             channel.close()
+
+
+async def consume(query, func: Callable, prefetch_count: int | None = None, concurrency: int = 1):
+    """
+    Потребитель очереди: до concurrency обработчиков одновременно,
+    брокер выдает не больше prefetch_count неподтвержденных сообщений (не меньше concurrency).
+    Каждое сообщение подтверждается по своему delivery_tag, поэтому обработчики могут завершаться в любом порядке
+    """
+    prefetch_count = max(prefetch_count or 0, concurrency)
+    stats = consumer_stats[query] = ConsumerStats(query, prefetch_count, concurrency)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def handle(channel: PikaChannel, delivery_tag: int, body: bytes):
+        started = time.monotonic()
+        failed = False
+        try:
+            try:
+                await func(body, channel)
+            except Exception as e:
+                failed = True
+                logger.exception(f'Failed to process message {body}: {e}')
+                await channel.basic_reject(delivery_tag, requeue=False)
+            else:
+                await channel.basic_ack(delivery_tag)
+        except AMQPError as e:
+            # канал закрыт, брокер доставит сообщение повторно
+            logger.warning(f'Failed to acknowledge message {delivery_tag} from {query}: {e}')
+        finally:
+            stats.finish(time.monotonic() - started, failed)
+            slots.release()
+
+    while True:
+        handlers = set()
+        try:
+            logger.info(f'Starting {query} worker')
+            async with create_channel() as channel:
+                async for delivery_tag, body in channel.consume(query, prefetch_count, stats):
+                    await slots.acquire()
+                    stats.start()
+                    handler = asyncio.create_task(handle(channel, delivery_tag, body))
+                    handlers.add(handler)
+                    handler.add_done_callback(handlers.discard)
+                await asyncio.gather(*handlers, return_exceptions=True)
+        except Exception as e:
+            logger.exception(f'Worker {query} failed: {e}')
+
+        # сообщения, полученные закрытым каналом, брокер доставит повторно
+        stats.received = stats.started
+        await asyncio.sleep(0.5)
+
+
+async def consumers_stats() -> dict[str, dict]:
+    """
+    Метрики потребителей по очередям и число сообщений, ожидающих в очередях брокера
+    """
+    stats = {queue: queue_stats.as_dict() for queue, queue_stats in consumer_stats.items()}
+    try:
+        async with create_channel() as channel:
+            for queue, queue_stats in stats.items():
+                queue_stats['queued'] = await asyncio.wait_for(
+                    channel.message_count(queue), settings.mq_publish_timeout
+                )
+    except Exception as e:
+        logger.warning(f'Failed to get queue sizes: {e}')
+    return stats
+
+
+publisher = Publisher(
+    pool_size=settings.mq_publisher_channels,
+    timeout=settings.mq_publish_timeout,
+)
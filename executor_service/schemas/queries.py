@@ -14,6 +14,8 @@ class QueryIn(BaseModel):
     result_destinations: list[DestinationType]
     identity_id: str
     conn_string: str
+    priority: int = 0
+    use_cache: bool = False
 
 class QueryErrorIn(BaseModel):
     guid: str
@@ -41,3 +43,5 @@ class QueryPublishIn(BaseModel):
     guid: str
     publish_name: str
     identity_id: str
+    order_by: list[str] | None = None
+    partition_by: str | None = None
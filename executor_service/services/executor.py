@@ -1,31 +1,49 @@
 import os
 import json
+import asyncio
 import logging
 import secrets
 import string
+import re
+import time
+import zlib
 import psycopg
+import pika
 
 from datetime import datetime
+from contextlib import asynccontextmanager
 from itertools import zip_longest
 from tempfile import TemporaryDirectory
-from typing import Iterable, Any
+from functools import partial
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Any
 
-from psycopg import sql as sql_builder
+from psycopg import pq, sql as sql_builder
+from psycopg.adapt import PyFormat, Transformer
+from psycopg.types.json import Json, Jsonb
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 
 from fastapi import HTTPException, status
 
+from executor_service import metrics
 from executor_service.settings import settings
 
-from executor_service._msgpack_io import msgpack_reader
+from executor_service._spill_io import spill_reader
+from executor_service._columnar_io import ColumnarReader, column_values
+from executor_service._result_file_io import FILE_EXTENSIONS, result_file_writer
+from executor_service._pg_binary_io import COPY_SIGNATURE, COPY_TRAILER, encode_copy_columns
 from executor_service.database.sqlalchemy import AsyncSession
 from executor_service.errors import QueryNotFoundError, QueryNotRunning
-from executor_service.mq import create_channel
-from executor_service.models.queries import QueryExecution, QueryStatus, QueryDestinationStatus
+from executor_service.mq import publisher
+from executor_service.models.queries import QueryExecution, QueryDestination, QueryStatus, QueryDestinationStatus
 from executor_service.database.sqlalchemy import db_session
-from executor_service.services.query_runner import QueryRunnerFactory
+from executor_service.database.results import results_pool
+from executor_service.services.query_runner import ExecutionStats, QueryRunnerFactory
+from executor_service.services.pipeline import ResultPipe, fan_out
+from executor_service.services.scheduler import ExecutionScheduler
 from executor_service.services.crypto import decrypt
+from executor_service.services import outbox, result_cache
+from executor_service.services.page_cache import access_cache, page_cache
 
 
 LOG = logging.getLogger(__name__)
@@ -33,6 +51,17 @@ LOG = logging.getLogger(__name__)
 
 ORDER_KEY = '__dwh_seq__'
 CREDENTIALS_SYMBOLS = string.ascii_letters + string.digits + '+-=/,.'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# типы, значения которых сохраняются в промежуточном файле без потерь и загружаются бинарным COPY
+BINARY_COPY_TYPES = {
+    'bool', 'int2', 'int4', 'int8', 'float4', 'float8', 'numeric', 'text', 'varchar', 'bpchar', 'name',
+    'date', 'time', 'timetz', 'timestamp', 'timestamptz', 'interval', 'uuid', 'bytea', 'json', 'jsonb',
+}
+# json из промежуточного файла читается словарями и списками, psycopg адаптирует их только в обертке
+JSON_WRAPPERS = {
+    'json': Json,
+    'jsonb': Jsonb,
+}
 
 
 def _generate_random_string(strength: int):
@@ -44,7 +73,7 @@ async def get_query_result(db_table: str, limit: int, offset: int) -> list[dict]
         sql_builder.Identifier(db_table),
         sql_builder.Identifier(ORDER_KEY)
     )
-    async with await psycopg.AsyncConnection.connect(settings.db_connection_string_results) as con:
+    async with results_pool.connection() as con:
         async with con.cursor() as cursor:
             await cursor.execute(sql, (limit, offset))
             fields = [c.name for c in cursor.description]
@@ -58,17 +87,173 @@ async def get_query_result(db_table: str, limit: int, offset: int) -> list[dict]
     return result
 
 
+async def get_query_result_page(db_table: str, limit: int, after: int = 0) -> tuple[list[dict], int | None]:
+    """
+    Keyset-пагинация: страница строк с порядковым номером больше after
+    :return: Строки и номер последней строки для запроса следующей страницы
+    """
+    sql = sql_builder.SQL('SELECT * FROM {} WHERE {} > %s ORDER BY {} LIMIT %s').format(
+        sql_builder.Identifier(db_table),
+        sql_builder.Identifier(ORDER_KEY),
+        sql_builder.Identifier(ORDER_KEY)
+    )
+    async with results_pool.connection() as con:
+        async with con.cursor() as cursor:
+            await cursor.execute(sql, (after, limit))
+            fields = [c.name for c in cursor.description]
+
+            result = []
+            last_seq = None
+            async for row in cursor:
+                item = dict(zip_longest(fields, row))
+                last_seq = item.pop(ORDER_KEY)
+                result.append(item)
+
+    return result, last_seq if len(result) == limit else None
+
+
+async def stream_query_result_csv(db_table: str, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Выгружает таблицу результатов в CSV через COPY TO STDOUT частями по DOWNLOAD_CHUNK_SIZE,
+    не загружая результат в память целиком
+    :param compress: Сжимать поток в gzip
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    async with results_pool.connection() as con:
+        async with con.cursor() as cursor:
+            await cursor.execute(
+                sql_builder.SQL('SELECT * FROM {} LIMIT 0').format(sql_builder.Identifier(db_table))
+            )
+            fields = [c.name for c in cursor.description if c.name != ORDER_KEY]
+
+            sql = sql_builder.SQL('COPY (SELECT {} FROM {} ORDER BY {}) TO STDOUT (FORMAT csv, HEADER)').format(
+                sql_builder.SQL(',').join(map(sql_builder.Identifier, fields)),
+                sql_builder.Identifier(db_table),
+                sql_builder.Identifier(ORDER_KEY)
+            )
+            buffer = bytearray()
+            async with cursor.copy(sql) as copy:
+                async for data in copy:
+                    buffer += data
+                    if len(buffer) < DOWNLOAD_CHUNK_SIZE:
+                        continue
+                    chunk = compressor.compress(buffer) if compressor else bytes(buffer)
+                    buffer.clear()
+                    if chunk:
+                        yield chunk
+
+    chunk = compressor.compress(buffer) + compressor.flush() if compressor else bytes(buffer)
+    if chunk:
+        yield chunk
+
+
+async def get_result_table_schema(db_table: str) -> list[tuple[str, str, int | None, int | None]]:
+    """
+    Колонки таблицы результатов без ORDER_KEY
+    :return: Имя, udt_name, точность и масштаб numeric для каждой колонки
+    """
+    async with results_pool.connection() as con:
+        async with con.cursor() as cursor:
+            await cursor.execute(
+                'SELECT column_name, udt_name, numeric_precision, numeric_scale '
+                'FROM information_schema.columns '
+                'WHERE table_schema = current_schema() AND table_name = %s '
+                'ORDER BY ordinal_position',
+                (db_table,)
+            )
+            return [row for row in await cursor.fetchall() if row[0] != ORDER_KEY]
+
+
+@asynccontextmanager
+async def open_query_result_cursor(db_table: str) -> AsyncIterator[psycopg.AsyncServerCursor]:
+    """
+    Серверный курсор по таблице результатов в порядке ORDER_KEY, строки читаются частями через fetchmany
+    """
+    sql = sql_builder.SQL('SELECT * FROM {} ORDER BY {}').format(
+        sql_builder.Identifier(db_table),
+        sql_builder.Identifier(ORDER_KEY)
+    )
+    async with results_pool.connection() as con:
+        async with con.cursor(name=f'read_{db_table}') as cursor:
+            await cursor.execute(sql)
+            yield cursor
+
+
 async def delete_query_execs(db_tables: list[str]) -> None:
     if not db_tables:
         return 
     tables = sql_builder.SQL(', ').join(map(sql_builder.Identifier, db_tables))
     drop_tables_sql = sql_builder.SQL('DROP TABLE IF EXISTS {}').format(tables)
 
-    async with await psycopg.AsyncConnection.connect(settings.db_connection_string_results) as conn:
+    async with results_pool.connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute(drop_tables_sql)
 
 
+async def delete_result_files(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def release_results(session: AsyncSession, queries: list[QueryExecution]) -> list[str]:
+    """
+    Помечает результаты запусков удаленными. Запуски из кэша и присоединенные к чужому выполнению ссылаются
+    на ту же таблицу или файл, что и исходный запуск, поэтому путь удаляется, только когда на него не осталось
+    ссылок других действующих получателей. Изменения в session фиксирует вызывающий
+    :return: guid запусков, которые вызывающий убирает из кэшей через invalidate_results после фиксации,
+    иначе параллельный запрос успеет закэшировать еще не удаленные результаты
+    """
+    query_ids = {query.id for query in queries}
+    own = [dest for query in queries for dest in query.results if dest.dest_type in ('table', 'file') and dest.path]
+    dest_types = {dest.path: dest.dest_type for dest in own}
+
+    referencing = []
+    if dest_types:
+        # блокировка получателей не дает двум одновременным удалениям оставить общий результат без владельца
+        referencing = await session.execute(
+            select(QueryDestination, QueryExecution.guid)
+            .join(QueryExecution, QueryExecution.id == QueryDestination.query_id)
+            .where(QueryDestination.dest_type.in_(['table', 'file']), QueryDestination.path.in_(list(dest_types)))
+            .order_by(QueryDestination.id)
+            .with_for_update(of=QueryDestination)
+            .execution_options(populate_existing=True)
+        )
+        referencing = referencing.all()
+    shared = {
+        dest.path for dest, _ in referencing
+        if dest.query_id not in query_ids and dest.status != QueryDestinationStatus.DELETED.value
+    }
+    released = dest_types.keys() - shared
+
+    for query in queries:
+        for dest in query.results:
+            dest.status = QueryDestinationStatus.DELETED.value
+    guids = {query.guid for query in queries}
+    for dest, guid in referencing:
+        if dest.path in released:
+            dest.status = QueryDestinationStatus.DELETED.value
+            guids.add(guid)
+    await session.flush()
+
+    tables = [path for path in released if dest_types[path] == 'table']
+    await delete_query_execs(tables)
+    await result_cache.forget(session, tables)
+    await delete_result_files([path for path in released if dest_types[path] == 'file'])
+    return list(guids)
+
+
+def invalidate_results(guids: list[str]) -> None:
+    """
+    Убирает из кэшей процесса страницы и расположение результатов запусков
+    """
+    page_cache.invalidate(guids)
+    access_cache.invalidate(guids)
+
+
 async def _get_query_by_id(session: AsyncSession, query_id: int) -> QueryExecution:
     query = await session.execute(
         select(QueryExecution)
@@ -94,6 +279,31 @@ async def _get_query_by_guid(query_guid: str, session: AsyncSession) -> QueryExe
 async def terminate_query(query_guid: str):
     async with db_session() as session:
         query = await _get_query_by_guid(query_guid, session)
+        flight = _leave_flight(query.id)
+        if flight is not None:
+            await session.refresh(query, with_for_update=True)
+            if query.status not in (QueryStatus.QUEUED.value, QueryStatus.RUNNING.value):
+                raise QueryNotRunning(query_id=query.id)
+            query.status = QueryStatus.CANCELLED.value
+            outbox.add_status_event(session, query)
+            await session.commit()
+            if not flight.participants:
+                # отменен последний участник совместного выполнения, запрос в источнике больше никому не нужен
+                leader = query if flight.leader_id == query.id else await _get_query_by_id(session, flight.leader_id)
+                await _stop_execution(leader)
+            return query
+
+        if query.status == QueryStatus.QUEUED.value:
+            await session.refresh(query, with_for_update=True)
+        if query.status == QueryStatus.QUEUED.value:
+            # запрос еще не запущен: убираем из локальной очереди,
+            # а воркер пропустит его по статусу при выполнении задачи из MQ
+            scheduler.discard(query.id)
+            query.status = QueryStatus.CANCELLED.value
+            outbox.add_status_event(session, query)
+            await session.commit()
+            return query
+
         if query.status != QueryStatus.RUNNING.value:
             raise QueryNotRunning(query_id=query.id)
 
@@ -113,10 +323,29 @@ async def terminate_query(query_guid: str):
         await session.refresh(query, with_for_update=True)
         await query_runner.cancel(query_guid=query.guid)
         query.status = QueryStatus.CANCELLED.value
+        outbox.add_status_event(session, query)
         await session.commit()
         return query
 
 
+async def _stop_execution(query: QueryExecution):
+    """
+    Останавливает выполнение запуска, уже отмеченного отмененным: убирает из очереди или отменяет запрос в источнике
+    """
+    if scheduler.discard(query.id):
+        _finish_flight(query.id)
+        return
+
+    query_runner = QueryRunnerFactory.build(
+        query_id=query.id,
+        conn_string=decrypt(settings.encryption_key, query.db)
+    )
+    try:
+        await query_runner.cancel(query_guid=query.guid)
+    except QueryNotRunning:
+        LOG.info(f'Run {query.id} finished before cancellation')
+
+
 async def execute_query(query_id: int, conn_string: str):
     """
     Выполняет запрос и загружает его результаты
@@ -127,19 +356,242 @@ async def execute_query(query_id: int, conn_string: str):
         await _execute_query(query_id, conn_string)
     except Exception as e:
         LOG.exception(f'Failed to execute run {query_id}: {repr(e)}')
+    finally:
+        _finish_flight(query_id)
+
+
+class _Flight:
+    """
+    Выполнение запроса, к результату которого присоединяются одинаковые запуски.
+    participants — запуски, которым еще нужен результат, включая лидера, если он не отменен
+    """
+    def __init__(self, key: str, leader_id: int, dest_types: set[str]):
+        self.key = key
+        self.leader_id = leader_id
+        self.dest_types = dest_types
+        self.participants = {leader_id}
+        self.done = asyncio.get_running_loop().create_future()
+
+
+_flights: dict[str, _Flight] = {}
+_run_flights: dict[int, _Flight] = {}
+_followers: set[asyncio.Task] = set()
+
+
+def _single_flight_enabled() -> bool:
+    """
+    Участники совместного выполнения известны только процессу, который его выполняет, поэтому отменить
+    присоединенный запуск можно, только если запросы выполняются в процессе API. При выполнении воркерами через MQ
+    совместное выполнение отключено
+    """
+    return settings.single_flight and settings.execution_backend != 'mq'
+
+
+def _lead_flight(query: QueryExecution, conn_string: str):
+    if not _single_flight_enabled():
+        return
+    key = result_cache.cache_key(query.query, conn_string)
+    flight = _Flight(key, query.id, {dest.dest_type for dest in query.results})
+    _flights[key] = flight
+    _run_flights[query.id] = flight
+
+
+def _join_flight(query: QueryExecution, conn_string: str) -> _Flight | None:
+    """
+    Присоединяет запуск к выполняющемуся или ожидающему в очереди одинаковому запросу к той же базе,
+    если тот загружает результат во все нужные запуску получатели
+    """
+    if not _single_flight_enabled():
+        return None
+    flight = _flights.get(result_cache.cache_key(query.query, conn_string))
+    if flight is None or not flight.participants:
+        return None
+    if not {dest.dest_type for dest in query.results} <= flight.dest_types:
+        return None
+    flight.participants.add(query.id)
+    _run_flights[query.id] = flight
+    LOG.info(f'Run {query.id} joined execution of run {flight.leader_id}')
+    return flight
+
+
+def _leave_flight(query_id: int) -> _Flight | None:
+    flight = _run_flights.get(query_id)
+    if flight is not None:
+        flight.participants.discard(query_id)
+    return flight
+
+
+def _finish_flight(leader_id: int):
+    flight = _run_flights.pop(leader_id, None)
+    if flight is None or flight.leader_id != leader_id:
+        return
+    if _flights.get(flight.key) is flight:
+        del _flights[flight.key]
+    if not flight.done.done():
+        flight.done.set_result(None)
+
+
+def _flight_needed(query_id: int) -> bool:
+    flight = _run_flights.get(query_id)
+    return flight is not None and bool(flight.participants)
+
+
+async def _follow(flight: _Flight, query_id: int):
+    """
+    Дожидается выполнения лидера и завершает присоединенный запуск с тем же результатом
+    """
+    await asyncio.shield(flight.done)
+    _run_flights.pop(query_id, None)
+    if query_id not in flight.participants:
+        return
+
+    async with db_session() as session:
+        query = await _get_query_by_id(session, query_id)
+        await session.refresh(query, with_for_update=True)
+        if query.status == QueryStatus.CANCELLED.value:
+            return
+        leader = await _get_query_by_id(session, flight.leader_id)
+        leader_results = {dest.dest_type: dest for dest in leader.results}
+
+        failed = []
+        for dest in query.results:
+            leader_dest = leader_results.get(dest.dest_type)
+            if leader_dest is None or leader_dest.status != QueryDestinationStatus.UPLOADED.value:
+                dest.status = QueryDestinationStatus.ERROR.value
+                dest.error_description = f'Failed to upload into {dest.dest_type}'
+                failed.append(dest.dest_type)
+                continue
+
+            creds = json.loads(leader_dest.access_creds) if leader_dest.access_creds else {}
+            if dest.dest_type == 'table':
+                async with results_pool.connection() as con:
+                    async with psycopg.AsyncClientCursor(con) as cursor:
+                        creds = await _create_access(cursor, query.id, leader_dest.path)
+            dest.path = leader_dest.path
+            dest.status = QueryDestinationStatus.UPLOADED.value
+            dest.finished_at = datetime.utcnow()
+            dest.access_creds = json.dumps(creds)
+
+        if failed:
+            query.status = QueryStatus.ERROR.value
+            query.error_description = leader.error_description or 'SQL execution failed'
+        else:
+            query.status = QueryStatus.DONE.value
+        outbox.add_status_event(session, query)
+        await session.commit()
+
+
+scheduler = ExecutionScheduler(
+    execute_query,
+    max_running=settings.max_running_queries,
+    max_running_per_db=settings.max_running_queries_per_db,
+    max_queued=settings.max_queued_queries,
+)
+
+metrics.add_gauge(
+    'query_executor_executions',
+    'Executions in the local scheduler by state',
+    ['state'],
+    lambda: {('running',): scheduler.running_count, ('queued',): scheduler.queued_count},
+)
+
+
+async def submit_execution(query: QueryExecution, conn_string: str, priority: int = 0) -> int | None:
+    """
+    Передает запрос на выполнение в локальную очередь или воркерам через MQ
+    :return: Позиция в локальной очереди, None при выполнении воркерами
+    """
+    if query.cache_key and await _finish_from_cache(query.id, query.cache_key):
+        return 0
+
+    if settings.execution_backend != 'mq':
+        flight = _join_flight(query, conn_string)
+        if flight is not None:
+            follower = asyncio.create_task(_follow(flight, query.id))
+            _followers.add(follower)
+            follower.add_done_callback(_followers.discard)
+            return scheduler.position(flight.leader_id) or 0
+
+        _lead_flight(query, conn_string)
+        return scheduler.submit(query.id, conn_string, priority)
+
+    await publisher.publish(
+        exchange='',
+        routing_key=settings.execute_task_queue,
+        body=json.dumps({'run_id': query.id, 'priority': priority}),
+        properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent)
+    )
+    return None
+
+
+async def _finish_from_cache(query_id: int, key: str) -> bool:
+    """
+    Завершает запуск готовым результатом из кэша: получатель ссылается на уже загруженную таблицу результатов.
+    Из кэша обслуживаются только запуски с единственным получателем table
+    :return: True, если результат найден в кэше
+    """
+    async with db_session() as session:
+        query = await _get_query_by_id(session, query_id)
+        if {dest.dest_type for dest in query.results} != {'table'}:
+            return False
+        entry = await result_cache.lookup(session, key)
+        if entry is None:
+            return False
+
+        async with results_pool.connection() as con:
+            async with psycopg.AsyncClientCursor(con) as cursor:
+                creds = await _create_access(cursor, query.id, entry.db_table)
+
+        for dest in query.results:
+            dest.path = entry.db_table
+            dest.status = QueryDestinationStatus.UPLOADED.value
+            dest.finished_at = datetime.utcnow()
+            dest.access_creds = json.dumps(creds)
+        query.status = QueryStatus.DONE.value
+        outbox.add_status_event(session, query)
+        await session.commit()
+
+    LOG.info(f'Run {query.id} is served from cache by {entry.db_table}')
+    return True
+
+
+async def execute_task(body: bytes, _channel):
+    """
+    Обработчик задач выполнения из MQ в процессе воркера.
+    Строка подключения расшифровывается из базы, чтобы не передавать ее через брокер
+    """
+    task = json.loads(body)
+    async with db_session() as session:
+        query = await _get_query_by_id(session, task['run_id'])
+        conn_string = decrypt(settings.encryption_key, query.db)
+
+    scheduler.submit(query.id, conn_string, task.get('priority', 0))
+    await scheduler.wait(query.id)
 
 
 async def _execute_query(query_id: int, conn_string: str):
     async with db_session() as session:
         query = await _get_query_by_id(session, query_id)
-        query.status = QueryStatus.RUNNING.value
+        await session.refresh(query, with_for_update=True)
+        # отмененный лидер продолжает выполнение, если результат нужен присоединенным запускам
+        if query.status == QueryStatus.CANCELLED.value and not _flight_needed(query.id):
+            LOG.info(f'Run {query.id} was cancelled before start')
+            return
+        if query.status != QueryStatus.CANCELLED.value:
+            query.status = QueryStatus.RUNNING.value
         await session.commit()
 
+        stats = ExecutionStats()
+        load_times = {}
         with TemporaryDirectory() as temp_dir:
             data_path = os.path.join(temp_dir, f'{query.guid}.bin')
 
             try:
-                await _execute_sql_to_file(query, conn_string, write_to=data_path)
+                if settings.pipelined_load:
+                    loaded = await _execute_sql_pipelined(query, conn_string, data_path, stats, load_times)
+                else:
+                    await _execute_sql_to_file(query, conn_string, data_path, stats)
+                    loaded = {}
             except psycopg.errors.QueryCanceled:
                 await session.refresh(query, with_for_update=True)
                 if query.status == QueryStatus.CANCELLED.value:
@@ -149,107 +601,378 @@ async def _execute_query(query_id: int, conn_string: str):
                 LOG.error(f'Query {query.id} was cancelled')
                 query.status = QueryStatus.ERROR.value
                 query.error_description = f'Cancelled'
+                _record_stats(query, stats)
+                outbox.add_status_event(session, query)
                 await session.commit()
-                await send_notification(query)
                 return
             except Exception:
                 LOG.exception(f'Failed to run query: {query.guid}')
+                await session.refresh(query, with_for_update=True)
+                if query.status == QueryStatus.CANCELLED.value:
+                    # отмененный лидер выполнялся для присоединенных запусков, они получат ошибку по его получателям
+                    return
                 query.status = QueryStatus.ERROR.value
                 query.error_description = f'SQL execution failed'
+                _record_stats(query, stats)
+                outbox.add_status_event(session, query)
                 await session.commit()
-                await send_notification(query)
                 return
 
-            for dest in query.results:
-                load = RESULTS_DEST_MAPPING.get(dest.dest_type)
-                if load is None:
-                    LOG.error(f'Unknown destination type: {dest.dest_type}')
-                    continue
-                try:
-                    LOG.info(f'Run {query.id} upload to {dest.dest_type} started')
-                    path, creds = await load(query, data_path)
-                    LOG.info(f'Run {query.id} upload to {dest.dest_type} finished')
-                except Exception:
-                    LOG.exception(f'Failed to upload result of query {query.guid} into {dest.dest_type}')
-                    dest.status = QueryDestinationStatus.ERROR.value
-                    dest.error_description = f'Failed to upload into {dest.dest_type}'
-                    query.status = QueryStatus.ERROR.value
-                    query.error_description = f'Results failed to upload into {dest.dest_type}'
-                    await session.commit()
-                    await send_notification(query)
-                    return
+            results = await _load_results(query, data_path, loaded, load_times)
 
-                dest.path = path
-                dest.status = QueryDestinationStatus.UPLOADED.value
-                dest.finished_at = datetime.utcnow()
-                dest.access_creds = json.dumps(creds)
-                await session.commit()
+        await session.refresh(query, attribute_names=['status'], with_for_update=True)
+        cancelled = query.status == QueryStatus.CANCELLED.value
+        _record_stats(query, stats)
 
-        query.status = QueryStatus.DONE.value
+        # получатели загружаются независимо, ошибка одного не отменяет результат остальных
+        failed = []
+        for dest in query.results:
+            if dest.dest_type not in results:
+                LOG.error(f'Unknown destination type: {dest.dest_type}')
+                continue
+            result = results[dest.dest_type]
+            dest.load_started_at, load_finished_at = load_times.get(dest.dest_type, (None, None))
+            if isinstance(result, BaseException):
+                LOG.error(
+                    f'Failed to upload result of query {query.guid} into {dest.dest_type}', exc_info=result
+                )
+                dest.status = QueryDestinationStatus.ERROR.value
+                dest.error_description = f'Failed to upload into {dest.dest_type}'
+                failed.append(dest.dest_type)
+                continue
+
+            path, creds = result
+            dest.path = path
+            dest.status = QueryDestinationStatus.UPLOADED.value
+            dest.finished_at = load_finished_at or datetime.utcnow()
+            dest.access_creds = json.dumps(creds)
+
+        if cancelled:
+            # результат загружен для присоединенных запусков, сам запуск остается отмененным
+            await session.commit()
+            return
+        if failed:
+            query.status = QueryStatus.ERROR.value
+            query.error_description = f'Results failed to upload into {", ".join(failed)}'
+        else:
+            query.status = QueryStatus.DONE.value
+            table = next((dest.path for dest in query.results if dest.dest_type == 'table'), None)
+            if query.cache_key and table:
+                await result_cache.store(session, query.cache_key, query.id, table)
+        outbox.add_status_event(session, query)
         await session.commit()
 
-    await send_notification(query)
 
+def _record_stats(query: QueryExecution, stats: ExecutionStats):
+    query.source_started_at = stats.started_at
+    query.first_row_at = stats.first_row_at
+    query.source_finished_at = stats.finished_at
+    if stats.finished_at is not None:
+        query.rows_count = stats.spill.rows
+        query.spill_bytes = stats.spill.bytes or None
+        query.peak_batch_bytes = stats.spill.peak_batch_bytes or None
 
-async def send_notification(query: QueryExecution):
-    async with create_channel() as channel:
-        await channel.basic_publish(
-            exchange=settings.exchange_execute,
-            routing_key='result',
-            body=json.dumps({
-                'guid': query.guid,
-                'run_id': query.id,
-                'status': query.status,
-                'error_description': query.error_description
-            })
-        )
+
+async def _load_results(query, data_path: str, loaded: dict[str, asyncio.Task],
+                        load_times: dict[str, tuple[datetime, datetime]]) -> dict[str, Any]:
+    """
+    Загружает результат во все получатели одновременно.
+    Если получателей с потоковой загрузкой несколько, файл читается один раз и каждый блок передается всем,
+    остальные получатели читают файл самостоятельно. Если COPY в таблицу не удался,
+    таблица отключается от общего чтения и перечитывает строки из файла для INSERT
+    :param loaded: Задачи получателей, загруженных во время выполнения запроса
+    :param load_times: Время начала и окончания загрузки по типу получателя, заполняется по мере загрузки
+    :return: Путь и доступы или исключение по типу получателя
+    """
+    dest_types = [
+        dest_type for dest_type in dict.fromkeys(dest.dest_type for dest in query.results)
+        if dest_type in RESULTS_DEST_MAPPING and dest_type not in loaded
+    ]
+    piped = [dest_type for dest_type in dest_types if dest_type in PIPELINE_DEST_MAPPING]
+    if len(piped) < 2:
+        piped = []
+
+    loads = dict(loaded)
+    for dest_type in dest_types:
+        if dest_type not in piped:
+            loads[dest_type] = asyncio.create_task(
+                _observe_load(dest_type, RESULTS_DEST_MAPPING[dest_type](query, data_path), load_times)
+            )
+
+    feeder = None
+    if piped:
+        pipes = {
+            dest_type: ResultPipe(settings.pipeline_queue_size, settings.pipeline_batch_size) for dest_type in piped
+        }
+        for dest_type, pipe in pipes.items():
+            load = PIPELINE_DEST_MAPPING[dest_type]
+            if dest_type == 'table':
+                load = partial(load, fallback=partial(_read_records, data_path))
+            loads[dest_type] = asyncio.create_task(_observe_load(dest_type, load(query, pipe), load_times))
+        feeder = asyncio.create_task(_fan_out_file(data_path, list(pipes.values())))
+
+    LOG.info(f'Run {query.id} upload to {", ".join(loads)} started')
+    results = await asyncio.gather(*loads.values(), return_exceptions=True)
+    if feeder is not None:
+        await asyncio.gather(feeder, return_exceptions=True)
+    LOG.info(f'Run {query.id} upload to {", ".join(loads)} finished')
+    return dict(zip(loads, results))
+
+
+async def _observe_load(dest_type: str, load: Awaitable, load_times: dict[str, tuple[datetime, datetime]]) -> Any:
+    started = time.monotonic()
+    started_at = datetime.utcnow()
+    try:
+        result = await load
+    finally:
+        load_times[dest_type] = (started_at, datetime.utcnow())
+    metrics.DEST_LOAD_SECONDS.labels(dest_type).observe(time.monotonic() - started)
+    return result
+
+
+async def _fan_out_file(read_from: str, pipes: list[ResultPipe]):
+    try:
+        with spill_reader(read_from) as reader:
+            batches, columnar = _spill_batches(reader)
+            await fan_out(reader.names, reader.types, batches, pipes, columnar)
+    except Exception as err:
+        LOG.exception(f'Failed to read results from {read_from}')
+        for pipe in pipes:
+            pipe.abort(err)
+
+
+def _spill_batches(reader) -> tuple[AsyncIterable[list], bool]:
+    """
+    Пачки промежуточного файла: блоки колонок из колоночного файла, иначе пачки строк
+    :return: Пачки и признак блоков колонок
+    """
+    if isinstance(reader, ColumnarReader):
+        return _to_async(reader.column_batches()), True
+    return _to_async(reader.batches(settings.pipeline_batch_size)), False
 
 
 async def _load_into_table(query, write_from):
-    with msgpack_reader(write_from) as reader:
-        names = reader.readrow()
-        types = reader.readrow()
-
-        if ORDER_KEY in names:
-            raise Exception('Failed to insert order key')
-
-        table_name = f'results_{int(query.id)}'
-        # для пагинации результатов нужен order, добавляем дополнительное поле
-        ddl = [f'CREATE TABLE IF NOT EXISTS {table_name} ({ORDER_KEY} BIGSERIAL PRIMARY KEY,']
-        fields = []
-        for name, type_ in zip_longest(names, types):
-            fields.append(f'"{name}" {type_} NULL')
-        ddl.append(','.join(fields))
-        ddl.append(')')
-
-        ddl = ''.join(ddl)
-        LOG.info(f'DDL for query {query.id}: {ddl}', extra={'query': query.guid})
-
-        async with await psycopg.AsyncConnection.connect(settings.db_connection_string_results,
-                                                         cursor_factory=psycopg.AsyncClientCursor) as con:
-            async with con.cursor() as cursor:
-                await cursor.execute(ddl)
-                user_name = f'sdwh_run_{query.id}'
-                user_pass = _generate_random_string(8)
-                await cursor.execute(f"CREATE USER {user_name} WITH password %s", [user_pass])
-                await cursor.execute(f"GRANT SELECT ON {table_name} TO {user_name}")
-
-                for batch_records in to_batches(100, reader):
+    with spill_reader(write_from) as reader:
+        batches, columnar = _spill_batches(reader)
+        return await _upload_into_table(
+            query, reader.names, reader.types, batches, fallback=partial(_read_records, write_from), columnar=columnar
+        )
+
+
+async def _pipe_into_table(query, pipe: ResultPipe, fallback: Callable[[], Iterable[list]] | None = None):
+    """
+    :param fallback: Строки для INSERT, если COPY не удался
+    """
+    def reread() -> Iterable[list]:
+        # остальные пачки из pipe не нужны, общее чтение не должно ждать таблицу
+        pipe.detach()
+        return fallback()
+
+    try:
+        names, types = await pipe.header()
+        return await _upload_into_table(
+            query, names, types, pipe.batches(), fallback=reread if fallback is not None else None,
+            columnar=pipe.columnar
+        )
+    except BaseException:
+        # не блокируем выполнение запроса, если загрузка упала
+        pipe.detach()
+        raise
+
+
+async def _load_into_file(query, write_from):
+    with spill_reader(write_from) as reader:
+        batches, columnar = _spill_batches(reader)
+        return await _write_into_file(query, reader.names, reader.types, batches, columnar=columnar)
+
+
+async def _pipe_into_file(query, pipe: ResultPipe):
+    try:
+        names, types = await pipe.header()
+        return await _write_into_file(query, names, types, pipe.batches(), columnar=pipe.columnar)
+    except BaseException:
+        pipe.detach()
+        raise
+
+
+async def _write_into_file(query, names: list, types: list, batches: AsyncIterable[list], columnar: bool = False):
+    """
+    :param columnar: batches - блоки колонок, а не пачки строк
+    """
+    if ORDER_KEY in names:
+        raise Exception('Failed to insert order key')
+
+    file_format = settings.results_file_format
+    os.makedirs(settings.results_file_dir, exist_ok=True)
+    path = os.path.join(settings.results_file_dir, f'results_{int(query.id)}{FILE_EXTENSIONS.get(file_format, "")}')
+
+    with result_file_writer(path, names, types, file_format, settings.results_file_row_group_size) as writer:
+        # колонки numpy передаются писателю блоками целиком
+        write = writer.write_columns if columnar else writer.writerows
+        async for batch in batches:
+            # сжатие и кодирование выполняются вне event loop
+            await asyncio.to_thread(write, batch)
+
+    return path, {}
+
+
+async def _upload_into_table(query, names: list, types: list, batches: AsyncIterable[list],
+                             fallback: Callable[[], Iterable[list]] | None = None, columnar: bool = False):
+    if ORDER_KEY in names:
+        raise Exception('Failed to insert order key')
+
+    table_name = f'results_{int(query.id)}'
+    # для пагинации результатов нужен order, добавляем дополнительное поле
+    ddl = [f'CREATE TABLE IF NOT EXISTS {table_name} ({ORDER_KEY} BIGSERIAL PRIMARY KEY,']
+    fields = []
+    for name, type_ in zip_longest(names, types):
+        fields.append(f'"{name}" {type_} NULL')
+    ddl.append(','.join(fields))
+    ddl.append(')')
+
+    ddl = ''.join(ddl)
+    LOG.info(f'DDL for query {query.id}: {ddl}', extra={'query': query.guid})
+
+    async with results_pool.connection() as con:
+        # клиентский курсор нужен для mogrify и параметров в CREATE USER
+        async with psycopg.AsyncClientCursor(con) as cursor:
+            await cursor.execute(ddl)
+            creds = await _create_access(cursor, query.id, table_name)
+
+            try:
+                # COPY выполняется в savepoint, чтобы при ошибке откатить только загруженные строки
+                async with con.transaction():
+                    await _copy_into_table(cursor, table_name, names, types, batches, columnar)
+            except Exception as err:
+                if fallback is None:
+                    raise
+                LOG.warning(f'COPY into {table_name} failed, falling back to INSERT: {repr(err)}')
+                adapt = _json_adapter(types)
+                for batch_records in to_batches(100, fallback()):
+                    if adapt is not None:
+                        batch_records = list(map(adapt, batch_records))
                     await _insert_many(cursor, table_name, names, batch_records)
 
-    return table_name, {
+    return table_name, creds
+
+
+async def _create_access(cursor, query_id: int, table_name: str) -> dict:
+    user_name = f'sdwh_run_{int(query_id)}'
+    user_pass = _generate_random_string(8)
+    await cursor.execute(f"CREATE USER {user_name} WITH password %s", [user_pass])
+    await cursor.execute(f"GRANT SELECT ON {table_name} TO {user_name}")
+    return {
         'user': user_name,
         'pass': user_pass
     }
 
 
+def _read_records(write_from: str) -> Iterable[list]:
+    with spill_reader(write_from) as reader:
+        yield from reader
+
+
+def _resolve_copy_types(cursor, field_types: list[str]) -> list[int] | None:
+    """
+    Определяет oid колонок по записанным типам для бинарного COPY.
+    Возвращает None, если хотя бы один тип не хранится в промежуточном файле в нативном виде
+    """
+    oids = []
+    for type_ in map(_strip_type_modifiers, field_types):
+        is_array = type_.endswith('[]')
+        name = type_.removesuffix('[]')
+
+        info = cursor.adapters.types.get(name) if name in BINARY_COPY_TYPES else None
+        if info is None:
+            return None
+        oids.append(info.array_oid if is_array else info.oid)
+    return oids
+
+
+def _strip_type_modifiers(type_: str) -> str:
+    # varchar(10), numeric(10, 2), int4[]
+    return re.sub(r'\(.*\)', '', type_)
+
+
+def _json_adapter(field_types: list[str]) -> Callable[[list], list] | None:
+    """
+    Преобразование строки для COPY и INSERT: значения колонок json и jsonb оборачиваются в Json и Jsonb.
+    Возвращает None, если таких колонок нет
+    """
+    wrappers = {}
+    for i, type_ in enumerate(map(_strip_type_modifiers, field_types)):
+        wrapper = JSON_WRAPPERS.get(type_.removesuffix('[]'))
+        if wrapper is not None:
+            wrappers[i] = (wrapper, type_.endswith('[]'))
+    if not wrappers:
+        return None
+
+    def adapt(row: list) -> list:
+        row = list(row)
+        for i, (wrap, is_array) in wrappers.items():
+            value = row[i]
+            if value is None:
+                continue
+            row[i] = [None if item is None else wrap(item) for item in value] if is_array else wrap(value)
+        return row
+    return adapt
+
+
+async def _copy_into_table(cursor, table_name, field_names, field_types, batches: AsyncIterable[list],
+                           columnar: bool = False):
+    oids = _resolve_copy_types(cursor, field_types)
+    sql = sql_builder.SQL('COPY {} ({}) FROM STDIN {}').format(
+        sql_builder.Identifier(table_name),
+        sql_builder.SQL(',').join(map(sql_builder.Identifier, field_names)),
+        sql_builder.SQL('(FORMAT BINARY)' if oids else '')
+    )
+    async with cursor.copy(sql) as copy:
+        if oids and columnar:
+            # строки COPY собираются из колонок блока: колонки numpy фиксированной длины кодируются целиком,
+            # по одному значению только остальные
+            copy_types = list(map(_strip_type_modifiers, field_types))
+            dump = _column_dumper(cursor, oids, field_types)
+            await copy.write(COPY_SIGNATURE)
+            async for block in batches:
+                await copy.write(encode_copy_columns(copy_types, block, dump))
+            await copy.write(COPY_TRAILER)
+            return
+
+        if oids:
+            copy.set_types(oids)
+        # загрузчики json, текстовые и бинарные, принимают словари и списки только в обертках
+        adapt = _json_adapter(field_types)
+        async for batch_records in batches:
+            if columnar:
+                batch_records = zip(*map(column_values, batch_records))
+            for r in batch_records:
+                await copy.write_row(r if adapt is None else adapt(r))
+
+
+def _column_dumper(cursor, oids: list[int], field_types: list[str]) -> Callable[[list[int], list], list]:
+    """
+    Бинарное представление значений колонок для COPY, значения кодируются по одному загрузчиками psycopg
+    :param oids: oid всех колонок результата
+    """
+    transformer = Transformer(cursor)
+
+    def dump(indexes: list[int], columns: list) -> list:
+        transformer.set_dumper_types([oids[i] for i in indexes], pq.Format.BINARY)
+        formats = [PyFormat.BINARY] * len(indexes)
+        adapt = _json_adapter([field_types[i] for i in indexes])
+        rows = zip(*map(column_values, columns))
+        if adapt is not None:
+            rows = map(adapt, rows)
+        return list(zip(*(transformer.dump_sequence(row, formats) for row in rows)))
+    return dump
+
+
 async def _insert_many(cursor, table_name, field_names, records):
     values = []
     values_template = ','.join(['%s'] * len(field_names))
 
     for r in records:
-        row = [None if col == 'None' else col for col in r]
-        value = cursor.mogrify(f'({values_template})', row)
+        value = cursor.mogrify(f'({values_template})', r)
         values.append(value)
 
     sql = ''.join([
@@ -263,14 +986,64 @@ async def _insert_many(cursor, table_name, field_names, records):
 
 RESULTS_DEST_MAPPING = {
     'table': _load_into_table,
+    'file': _load_into_file,
+}
+
+PIPELINE_DEST_MAPPING = {
+    'table': _pipe_into_table,
+    'file': _pipe_into_file,
 }
 
 
-async def _execute_sql_to_file(query, conn_string: str, write_to):
+async def _execute_sql_to_file(query, conn_string: str, write_to, stats: ExecutionStats):
     query_runner = QueryRunnerFactory.build(query_id=query.id, conn_string=conn_string)
 
     LOG.info(f'Run {query.id} using db {conn_string}')
-    await query_runner.execute_to_file(query.query, write_to)
+    await query_runner.execute_to_file(query.query, write_to, stats)
+
+
+async def _execute_sql_pipelined(query, conn_string: str, spill_to: str, stats: ExecutionStats,
+                                 load_times: dict[str, tuple[datetime, datetime]]) -> dict[str, asyncio.Task]:
+    """
+    Выполняет запрос, одновременно загружая строки в получатель, поддерживающий потоковую загрузку.
+    Файл пишется только если у запроса есть получатели, которые читают результат из файла
+    :return: Задачи загрузки по типу получателя
+    """
+    dest_types = [dest.dest_type for dest in query.results]
+    piped = next((dest_type for dest_type in dest_types if dest_type in PIPELINE_DEST_MAPPING), None)
+    needs_file = any(dest_type != piped for dest_type in dest_types)
+
+    pipe = ResultPipe(
+        settings.pipeline_queue_size,
+        settings.pipeline_batch_size,
+        spill_to=spill_to if needs_file or piped is None else None
+    )
+    loaders = {}
+    if piped is not None:
+        loaders[piped] = asyncio.create_task(
+            _observe_load(piped, PIPELINE_DEST_MAPPING[piped](query, pipe), load_times)
+        )
+    else:
+        pipe.detach()
+
+    query_runner = QueryRunnerFactory.build(query_id=query.id, conn_string=conn_string)
+    LOG.info(f'Run {query.id} using db {conn_string} in pipelined mode')
+    try:
+        await query_runner.execute_to_pipe(query.query, pipe, stats)
+    except BaseException:
+        for loader in loaders.values():
+            loader.cancel()
+        await asyncio.gather(*loaders.values(), return_exceptions=True)
+        raise
+
+    if loaders:
+        await asyncio.wait(loaders.values())
+    return loaders
+
+
+async def _to_async(iterable: Iterable) -> AsyncIterable:
+    for item in iterable:
+        yield item
 
 
 def to_batches(size: int, iterable: Iterable) -> Iterable[list[Any]]:
@@ -0,0 +1,100 @@
+import json
+import time
+import asyncio
+import logging
+
+from sqlalchemy import event, select, delete
+from sqlalchemy.orm import Session
+
+from executor_service import metrics
+from executor_service.mq import publisher
+from executor_service.models.queries import OutboxEvent, QueryExecution
+from executor_service.database.sqlalchemy import AsyncSession, db_session
+from executor_service.settings import settings
+
+
+LOG = logging.getLogger(__name__)
+
+_wakeup = asyncio.Event()
+
+
+def add_status_event(session: AsyncSession, query: QueryExecution):
+    """
+    Добавляет уведомление о статусе запуска в outbox.
+    Уведомление сохраняется тем же commit, что и статус, и отправляется в брокер фоновой пересылкой
+    """
+    session.add(OutboxEvent(
+        exchange=settings.exchange_execute,
+        routing_key='result',
+        body=json.dumps({
+            'guid': query.guid,
+            'run_id': query.id,
+            'status': query.status,
+            'error_description': query.error_description
+        })
+    ))
+    session.info['outbox'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_relay(session: Session):
+    if session.info.pop('outbox', False):
+        _wakeup.set()
+
+
+async def relay():
+    """
+    Пересылает события outbox в брокер. Несколько процессов могут пересылать одновременно:
+    захваченные другим процессом события пропускаются. Событие удаляется после подтверждения брокера,
+    поэтому доставка выполняется как минимум один раз
+    """
+    while True:
+        try:
+            sent = await _relay_batch()
+        except Exception as e:
+            LOG.warning(f'Failed to relay outbox events: {e}')
+            sent = 0
+
+        if sent < settings.outbox_batch_size:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), settings.outbox_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+
+
+async def _relay_batch() -> int:
+    """
+    :return: Число отправленных событий
+    """
+    async with db_session() as session:
+        events = await session.execute(
+            select(OutboxEvent)
+            .order_by(OutboxEvent.id)
+            .limit(settings.outbox_batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        events = events.scalars().all()
+        if not events:
+            return 0
+
+        # публикации пачки идут параллельно, брокер подтверждает их пачками
+        results = await asyncio.gather(
+            *[_publish(event) for event in events],
+            return_exceptions=True
+        )
+        sent = [event.id for event, result in zip(events, results) if not isinstance(result, BaseException)]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            LOG.warning(f'Failed to publish {len(errors)} outbox events: {errors[0]}')
+
+        if sent:
+            await session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(sent)))
+        await session.commit()
+        return len(sent)
+
+
+async def _publish(event: OutboxEvent):
+    started = time.monotonic()
+    await publisher.publish(event.exchange, event.routing_key, event.body)
+    metrics.NOTIFICATION_PUBLISH_SECONDS.observe(time.monotonic() - started)
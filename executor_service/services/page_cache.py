@@ -0,0 +1,116 @@
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable
+
+from executor_service.settings import settings
+
+
+class PageCache:
+    """
+    LRU-кэш сериализованных страниц результатов, ограниченный числом записей и суммарным размером.
+    Ключ начинается с guid запуска, чтобы все страницы запуска можно было удалить разом
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._pages: OrderedDict[tuple, tuple[str | None, bytes, float]] = OrderedDict()
+        self._keys_by_guid: dict[str, set[tuple]] = {}
+        self._size = 0
+
+    def get(self, guid: str, *key: Hashable) -> tuple[str | None, bytes] | None:
+        """
+        :return: identity_id владельца запуска и страница
+        """
+        page_key = (guid, *key)
+        item = self._pages.get(page_key)
+        if item is None:
+            return None
+        identity_id, data, stored_at = item
+        if time.monotonic() - stored_at >= self._ttl:
+            self._remove(page_key)
+            return None
+        self._pages.move_to_end(page_key)
+        return identity_id, data
+
+    def put(self, guid: str, *key: Hashable, identity_id: str | None, data: bytes):
+        if len(data) > self._max_bytes:
+            return
+        page_key = (guid, *key)
+        self._remove(page_key)
+        self._pages[page_key] = (identity_id, data, time.monotonic())
+        self._keys_by_guid.setdefault(guid, set()).add(page_key)
+        self._size += len(data)
+
+        while len(self._pages) > self._max_entries or self._size > self._max_bytes:
+            self._remove(next(iter(self._pages)))
+
+    def invalidate(self, guids: list[str]):
+        for guid in guids:
+            for page_key in list(self._keys_by_guid.get(guid, ())):
+                self._remove(page_key)
+
+    def _remove(self, page_key: tuple):
+        item = self._pages.pop(page_key, None)
+        if item is None:
+            return
+        self._size -= len(item[1])
+        keys = self._keys_by_guid[page_key[0]]
+        keys.discard(page_key)
+        if not keys:
+            del self._keys_by_guid[page_key[0]]
+
+
+@dataclass(frozen=True)
+class QueryAccess:
+    identity_id: str | None
+    status: str
+    db_table: str | None
+    file_path: str | None
+
+
+class AccessCache:
+    """
+    LRU-кэш владельца и расположения результатов запуска по guid,
+    чтобы эндпоинты результатов не загружали запуск с получателями на каждый запрос.
+    Кэш локален для процесса: удаление результатов в другом процессе видно только после истечения ttl
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._items: OrderedDict[str, tuple[QueryAccess, float]] = OrderedDict()
+
+    def get(self, guid: str) -> QueryAccess | None:
+        item = self._items.get(guid)
+        if item is None:
+            return None
+        access, stored_at = item
+        if time.monotonic() - stored_at >= self._ttl:
+            del self._items[guid]
+            return None
+        self._items.move_to_end(guid)
+        return access
+
+    def put(self, guid: str, access: QueryAccess):
+        self._items.pop(guid, None)
+        self._items[guid] = (access, time.monotonic())
+        while len(self._items) > self._max_entries:
+            self._items.popitem(last=False)
+
+    def invalidate(self, guids: list[str]):
+        for guid in guids:
+            self._items.pop(guid, None)
+
+
+page_cache = PageCache(
+    max_entries=settings.page_cache_max_entries,
+    max_bytes=settings.page_cache_max_bytes,
+    ttl=settings.page_cache_ttl,
+)
+
+access_cache = AccessCache(
+    max_entries=settings.access_cache_max_entries,
+    ttl=settings.access_cache_ttl,
+)
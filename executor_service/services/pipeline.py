@@ -0,0 +1,125 @@
+import asyncio
+
+from contextlib import ExitStack
+from typing import AsyncIterable, Any
+
+from executor_service._spill_io import SpillStats, spill_writer
+
+
+_EOF = object()
+
+
+class _Failed:
+    def __init__(self, err: BaseException):
+        self.err = err
+
+
+class ResultPipe:
+    """
+    Ограниченная очередь пачек строк между выполнением запроса и загрузчиком результатов.
+    Если передан spill_to, строки дополнительно пишутся в файл для загрузчиков, работающих с файлом.
+    При чтении колоночного промежуточного файла по очереди передаются блоки колонок, тогда columnar истинно
+    """
+    def __init__(self, maxsize: int, batch_size: int, spill_to: str | None = None):
+        self._queue = asyncio.Queue(maxsize)
+        self._batch_size = batch_size
+        self._spill_to = spill_to
+        self.spill_stats = SpillStats()
+        self._header = asyncio.get_running_loop().create_future()
+        self._detached = False
+        self.columnar = False
+
+    @property
+    def detached(self) -> bool:
+        return self._detached
+
+    async def feed(self, col_names: list, col_types: list, rows: AsyncIterable):
+        self.open(col_names, col_types)
+        with ExitStack() as stack:
+            writer = None
+            if self._spill_to:
+                writer = stack.enter_context(spill_writer(self._spill_to, col_names, col_types, self.spill_stats))
+
+            async for batch in to_async_batches(self._batch_size, rows):
+                if writer is not None:
+                    writer.writerows(batch)
+                else:
+                    # без файла число строк считается по пачкам
+                    self.spill_stats.rows += len(batch)
+                await self.put(batch)
+        await self.close()
+
+    def open(self, col_names: list, col_types: list, columnar: bool = False):
+        self.columnar = columnar
+        self._header.set_result((col_names, col_types))
+
+    async def put(self, batch: list[Any]):
+        if not self._detached:
+            await self._queue.put(batch)
+
+    async def close(self):
+        await self.put(_EOF)
+
+    def abort(self, err: BaseException):
+        """
+        Завершает передачу с ошибкой, получатель получит ее из header или batches
+        """
+        if not self._header.done():
+            self._header.set_exception(err)
+        if self._detached:
+            return
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_Failed(err))
+
+    async def header(self) -> tuple[list, list]:
+        return await self._header
+
+    async def batches(self) -> AsyncIterable[list[Any]]:
+        while True:
+            item = await self._queue.get()
+            if item is _EOF:
+                return
+            if isinstance(item, _Failed):
+                raise item.err
+            yield item
+
+    def detach(self):
+        """
+        Отключает получателя: выполнение запроса продолжится без ожидания загрузчика
+        """
+        self._detached = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+
+async def fan_out(col_names: list, col_types: list, batches: AsyncIterable[list[Any]], pipes: list[ResultPipe],
+                  columnar: bool = False):
+    """
+    Передает каждую пачку во все pipe, получатель отстает от самого быстрого не больше чем на размер своей очереди.
+    Отключенные получатели пропускаются, чтение прекращается, когда отключены все
+    :param columnar: Пачки - блоки колонок, а не строк
+    """
+    for pipe in pipes:
+        pipe.open(col_names, col_types, columnar)
+
+    async for batch in batches:
+        active = [pipe for pipe in pipes if not pipe.detached]
+        if not active:
+            return
+        await asyncio.gather(*(pipe.put(batch) for pipe in active))
+
+    for pipe in pipes:
+        await pipe.close()
+
+
+async def to_async_batches(size: int, iterable: AsyncIterable) -> AsyncIterable[list[Any]]:
+    batch_records = []
+    async for record in iterable:
+        batch_records.append(record)
+        if len(batch_records) >= size:
+            yield batch_records
+            batch_records = []
+
+    if batch_records:
+        yield batch_records
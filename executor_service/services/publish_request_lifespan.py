@@ -1,15 +1,15 @@
 import json
-import sys
+import asyncio
 import logging
-import pandas as pd
 
 from enum import Enum
 
-from executor_service.mq import PikaChannel
+from executor_service.mq import PikaChannel, publisher
 from executor_service.schemas.queries import QueryPublishIn
-from executor_service.endpoints.queries import select_query_result
+from executor_service.endpoints.queries import select_result_table
+from executor_service.services.executor import ORDER_KEY, get_result_table_schema, open_query_result_cursor
 from executor_service.database.sqlalchemy import db_session
-from executor_service.database.clickhouse import clickhouse_client
+from executor_service.database.clickhouse import PublishColumn, clickhouse_client
 from executor_service.settings import settings
 
 
@@ -25,22 +25,48 @@ class QueryRunningPublishStatus(Enum):
 async def publish_request(body: bytes, mq: PikaChannel):
     query_publish_in = QueryPublishIn.parse_raw(body)
     async with db_session() as session:
-        rows = await select_query_result(
-            query_publish_in.guid, sys.maxsize, 0, {'identity_id': query_publish_in.identity_id}, session
+        db_table = await select_result_table(
+            query_publish_in.guid, {'identity_id': query_publish_in.identity_id}, session
         )
 
-        df = pd.DataFrame(rows)
-        clickhouse_client.create_publish_table(query_publish_in.publish_name, df)
-
-        try:
-            clickhouse_client.insert_dataframe(query_publish_in.publish_name, df)
-            status = QueryRunningPublishStatus.PUBLISHED.value
-        except Exception as err:
-            logger.error(err)
-            status = QueryRunningPublishStatus.ERROR.value
-        finally:
-            await mq.basic_publish(
-                settings.publish_exchange,
-                'result',
-                json.dumps({'guid': query_publish_in.guid, 'status': status})
+    try:
+        await _publish(db_table, query_publish_in)
+        status = QueryRunningPublishStatus.PUBLISHED.value
+    except Exception as err:
+        logger.error(err)
+        status = QueryRunningPublishStatus.ERROR.value
+    finally:
+        await publisher.publish(
+            settings.publish_exchange,
+            'result',
+            json.dumps({'guid': query_publish_in.guid, 'status': status})
+        )
+
+
+async def _publish(db_table: str, query_publish_in: QueryPublishIn):
+    # типы колонок публикации определяются по схеме таблицы результатов
+    columns = {
+        name: PublishColumn(name, udt_name, precision, scale)
+        for name, udt_name, precision, scale in await get_result_table_schema(db_table)
+    }
+    await asyncio.to_thread(
+        clickhouse_client.create_publish_table,
+        query_publish_in.publish_name,
+        list(columns.values()),
+        query_publish_in.order_by,
+        query_publish_in.partition_by
+    )
+
+    # результат читается серверным курсором и вставляется пачками, вызовы ClickHouse выполняются вне event loop
+    async with open_query_result_cursor(db_table) as cursor:
+        fields = [c.name for c in cursor.description]
+        # порядковый номер строки в таблице результатов становится id публикации
+        column_names = ['id' if name == ORDER_KEY else name for name in fields]
+        converters = [None if name == ORDER_KEY else columns[name].converter for name in fields]
+
+        rows = await cursor.fetchmany(settings.publish_batch_size)
+        while rows:
+            await asyncio.to_thread(
+                clickhouse_client.insert_rows, query_publish_in.publish_name, column_names, rows, converters
             )
+            rows = await cursor.fetchmany(settings.publish_batch_size)
@@ -1,20 +1,45 @@
+import time
 import logging
 import psycopg
 import asyncio
-import clickhouse_connect
+import threading
+
+import numpy as np
+import pandas as pd
 
 from abc import ABC, abstractmethod
-from typing import AsyncIterable
-from clickhouse_connect.driver.exceptions import DatabaseError
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+from typing import AsyncIterable, Awaitable, Callable
+from clickhouse_connect.driver.exceptions import ClickHouseError, StreamFailureError
 
-from executor_service._msgpack_io import msgpack_writer
+from executor_service import metrics
+from executor_service._spill_io import SpillStats, spill_writer
+from executor_service.database.sources import postgres_pools, clickhouse_pools
 from executor_service.errors import QueryNotRunning
+from executor_service.settings import settings
+from executor_service.services.pipeline import ResultPipe
 
 
 LOG = logging.getLogger(__name__)
 
 
+@dataclass
+class ExecutionStats:
+    """
+    Стадии выполнения запроса в источнике и объем результата
+    """
+    started_at: datetime | None = None
+    first_row_at: datetime | None = None
+    finished_at: datetime | None = None
+    spill: SpillStats = field(default_factory=SpillStats)
+
+
 class QueryRunner(ABC):
+    source: str
+
     @abstractmethod
     def __init__(self, query_id: int, conn_string: str):
         self._query_id = query_id
@@ -24,8 +49,54 @@ class QueryRunner(ABC):
     def db_app_name(self):
         return f'sdwh_{self._query_id}'
 
+    async def execute_to_file(self, query: str, write_to: str, stats: ExecutionStats | None = None):
+        stats = stats or ExecutionStats()
+        with self._observe_execution(stats):
+            await self._execute_to_file(query, write_to, stats)
+
+    async def execute_to_pipe(self, query: str, pipe: ResultPipe, stats: ExecutionStats | None = None):
+        stats = stats or ExecutionStats()
+        with self._observe_execution(stats):
+            await self._execute(query, save=self._watch_first_row(pipe.feed, stats))
+        stats.spill = pipe.spill_stats
+
+    async def _execute_to_file(self, query: str, write_to: str, stats: ExecutionStats):
+        save = partial(self._save_to_dir, write_to, stats=stats.spill)
+        await self._execute(query, save=self._watch_first_row(save, stats))
+
+    @contextmanager
+    def _observe_execution(self, stats: ExecutionStats):
+        # в метрики попадают только успешно выполненные запросы
+        started = time.monotonic()
+        stats.started_at = datetime.utcnow()
+        yield
+        stats.finished_at = datetime.utcnow()
+        metrics.SOURCE_EXECUTION_SECONDS.labels(self.source).observe(time.monotonic() - started)
+
+    @staticmethod
+    def _watch_first_row(save: Callable[..., Awaitable[None]], stats: ExecutionStats) -> Callable[..., Awaitable[None]]:
+        """
+        Отмечает время получения первой строки или блока, передаваемых в save
+        """
+        async def first_marked(items: AsyncIterable):
+            iterator = aiter(items)
+            try:
+                first = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            stats.first_row_at = datetime.utcnow()
+            yield first
+            async for item in iterator:
+                yield item
+
+        async def watched_save(col_names: list, col_types: list, **data: AsyncIterable):
+            data = {name: first_marked(items) for name, items in data.items()}
+            return await save(col_names=col_names, col_types=col_types, **data)
+
+        return watched_save
+
     @abstractmethod
-    async def execute_to_file(self, query: str, write_to: str):
+    async def _execute(self, query: str, save: Callable[..., Awaitable[None]]):
         ...
 
     @abstractmethod
@@ -33,31 +104,31 @@ class QueryRunner(ABC):
         ...
 
     @staticmethod
-    async def _save_to_dir(write_to: str, col_names: list, col_types: list, rows: AsyncIterable):
-        with msgpack_writer(write_to) as writer:
-            # first two rows name and types
-            writer.writerow(col_names)
-            writer.writerow(col_types)
-
+    async def _save_to_dir(write_to: str, col_names: list, col_types: list, rows: AsyncIterable,
+                           stats: SpillStats | None = None):
+        with spill_writer(write_to, col_names, col_types, stats) as writer:
             async for record in rows:
-                record = tuple(map(str, record))
                 writer.writerow(record)
 
 
 class PostgresRunner(QueryRunner):
+    source = 'postgresql'
+
     def __init__(self, query_id: int, conn_string: str):
         super().__init__(query_id, conn_string)
 
-    async def execute_to_file(self, query: str, write_to: str):
-        async with await psycopg.AsyncConnection.connect(f'{self._conn_string}?application_name={self.db_app_name}') as conn:
+    async def _execute(self, query: str, save: Callable[..., Awaitable[None]]):
+        async with postgres_pools.connection(self._conn_string) as conn:
+            # application_name сбрасывается при возврате соединения в пул
+            await conn.execute("SELECT set_config('application_name', %s, false)", [self.db_app_name])
             async with conn.cursor(f'server_cursor_{self._query_id}') as cursor:
                 await cursor.execute(query)
                 col_names = [c.name for c in cursor.description]
                 col_types = [c._type_display() for c in cursor.description]
-                await self._save_to_dir(write_to, col_names=col_names, col_types=col_types, rows=cursor)
+                await save(col_names=col_names, col_types=col_types, rows=cursor)
 
     async def cancel(self, query_guid: str):
-        async with await psycopg.AsyncConnection.connect(self._conn_string) as conn:
+        async with postgres_pools.connection(self._conn_string) as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(
                     """
@@ -75,43 +146,212 @@ class PostgresRunner(QueryRunner):
                 await cursor.execute("SELECT pg_cancel_backend(%s)", [pid])
 
 
+# типы Postgres для колонок таблицы результатов, значения остальных типов ClickHouse сохраняются текстом
+CLICKHOUSE_PG_TYPES = {
+    'Bool': 'bool',
+    'Int8': 'int2',
+    'UInt8': 'int2',
+    'Int16': 'int2',
+    'UInt16': 'int4',
+    'Int32': 'int4',
+    'UInt32': 'int8',
+    'Int64': 'int8',
+    'UInt64': 'numeric',
+    'Int128': 'numeric',
+    'UInt128': 'numeric',
+    'Int256': 'numeric',
+    'UInt256': 'numeric',
+    'Float32': 'float4',
+    'Float64': 'float8',
+    'Decimal': 'numeric',
+    'String': 'text',
+    'FixedString': 'text',
+    'Enum8': 'text',
+    'Enum16': 'text',
+    'Date': 'date',
+    'Date32': 'date',
+    'DateTime': 'timestamp',
+    'DateTime64': 'timestamp',
+    'UUID': 'uuid',
+    'IPv4': 'inet',
+    'IPv6': 'inet',
+}
+
+
 class ClickHouseRunner(QueryRunner):
+    source = 'clickhouse'
+    _END = object()
+
     def __init__(self, query_id: int, conn_string: str):
         super().__init__(query_id, conn_string)
 
+    async def _execute_to_file(self, query: str, write_to: str, stats: ExecutionStats):
+        if settings.spill_format != 'columnar':
+            return await super()._execute_to_file(query, write_to, stats)
+        # колонки блоков ClickHouse пишутся в файл целиком, числовые — массивами numpy без создания объектов
+        save = partial(self._save_columns_to_dir, write_to, stats=stats.spill)
+        await self._stream(query, self._watch_first_row(save, stats), columnar=True)
+
+    async def _execute(self, query: str, save: Callable[..., Awaitable[None]]):
+        await self._stream(query, save, columnar=False)
+
+    async def _stream(self, query: str, save: Callable[..., Awaitable[None]], columnar: bool):
+        loop = asyncio.get_running_loop()
+        header = loop.create_future()
+        blocks = asyncio.Queue(maxsize=settings.clickhouse_stream_queue_size)
+        stop = threading.Event()
+
+        producer = asyncio.ensure_future(
+            asyncio.to_thread(self._stream_blocks, query, loop, header, blocks, stop, columnar)
+        )
+        saved = False
+        try:
+            await asyncio.wait([header, producer], return_when=asyncio.FIRST_COMPLETED)
+            if not header.done():
+                # запрос упал до получения первого блока
+                await producer
+            col_names, col_types = header.result()
+            if columnar:
+                await save(col_names=col_names, col_types=col_types, blocks=self._block_gen(blocks))
+            else:
+                await save(col_names=col_names, col_types=col_types, rows=self._row_gen(blocks))
+            saved = True
+        finally:
+            stop.set()
+            while not blocks.empty():
+                blocks.get_nowait()
+            # поток чтения дожидается всегда, его ошибка после ошибки сохранения не теряется, а пишется в лог
+            await asyncio.wait([producer])
+            if saved:
+                await producer
+            elif header.done() and not producer.cancelled() and producer.exception() is not None:
+                LOG.error(f'Reading results of query {self._query_id} failed', exc_info=producer.exception())
+
+    async def _block_gen(self, blocks: asyncio.Queue):
+        while True:
+            block = await blocks.get()
+            if block is self._END:
+                return
+            yield block
+
+    async def _row_gen(self, blocks: asyncio.Queue):
+        async for block in self._block_gen(blocks):
+            for row in block:
+                yield row
+
     @staticmethod
-    async def _row_gen(rows):
-        for row in rows:
-            yield row
-
-    async def execute_to_file(self, query: str, write_to: str):
-        query_result = await asyncio.to_thread(self._execute_to_file, query)
-        col_names = query_result.column_names
-        col_types = [col_type.base_type for col_type in query_result.column_types]
-        rows = self._row_gen(rows=query_result.result_rows)
-        await self._save_to_dir(write_to, col_names=col_names, col_types=col_types, rows=rows)
-
-    def _execute_to_file(self, query: str):
-        client = clickhouse_connect.get_client(dsn=self._conn_string)
+    async def _save_columns_to_dir(write_to: str, col_names: list, col_types: list, blocks: AsyncIterable,
+                                   stats: SpillStats | None = None):
+        with spill_writer(write_to, col_names, col_types, stats) as writer:
+            async for columns in blocks:
+                writer.write_columns(columns)
+
+    def _stream_blocks(self, query: str, loop: asyncio.AbstractEventLoop, header: asyncio.Future,
+                       blocks: asyncio.Queue, stop: threading.Event, columnar: bool):
+        """
+        Читает результат блоками в рабочем потоке и передает их в очередь событийного цикла.
+        Ограниченная очередь не дает читать быстрее, чем блоки записываются в файл
+        :param columnar: Передавать блоки списками колонок, иначе списками строк
+        """
+        def put(item):
+            asyncio.run_coroutine_threadsafe(blocks.put(item), loop).result()
+
         try:
-            result = client.query(
-                query,
-                settings={'replace_running_query': 1, 'query_id': self.db_app_name}
-            )
-        except DatabaseError as db_err:
+            with clickhouse_pools.get(self._conn_string).client() as client:
+                with self._open_stream(client, query, columnar) as stream:
+                    col_names = stream.source.column_names
+                    col_types = [self._pg_type(col_type) for col_type in stream.source.column_types]
+                    text_columns = [
+                        i for i, col_type in enumerate(stream.source.column_types)
+                        if col_type.base_type not in CLICKHOUSE_PG_TYPES
+                    ]
+                    nullable = [col_type.nullable for col_type in stream.source.column_types]
+                    loop.call_soon_threadsafe(header.set_result, (col_names, col_types))
+                    for block in stream:
+                        if stop.is_set():
+                            return
+                        if columnar:
+                            put(self._to_columns(block, col_types, nullable, text_columns))
+                        else:
+                            put(self._to_rows(block, text_columns))
+        except (ClickHouseError, StreamFailureError) as db_err:
+            # запрос, остановленный посреди чтения, завершается StreamFailureError с кодом ошибки сервера
             if "Code: 394" in str(db_err):  # if query was canceled
                 raise psycopg.errors.QueryCanceled()
             raise db_err
         finally:
-            client.close()
-        return result
+            if not stop.is_set():
+                put(self._END)
+
+    def _open_stream(self, client, query: str, columnar: bool):
+        query_settings = {'replace_running_query': 1, 'query_id': self.db_app_name}
+        if not columnar:
+            return client.query_row_block_stream(query, settings=query_settings)
+
+        # колонки Nullable приходят массивами pandas с маской, целые с NULL не превращаются во float с NaN
+        stream = client.query_df_stream(query, settings=query_settings, use_extended_dtypes=True)
+        col_names = stream.source.column_names
+        if len(set(col_names)) == len(col_names):
+            return stream
+        # DataFrame не хранит колонки с одинаковыми именами, такой результат читается колонками python-объектов
+        stream.source.close()
+        return client.query_column_block_stream(query, settings=query_settings)
+
+    @staticmethod
+    def _pg_type(col_type) -> str:
+        pg_type = CLICKHOUSE_PG_TYPES.get(col_type.base_type, 'text')
+        if pg_type == 'timestamp' and col_type.tzinfo is not None:
+            return 'timestamptz'
+        return pg_type
+
+    @classmethod
+    def _to_columns(cls, block, col_types: list[str], nullable: list[bool], text_columns: list[int]) -> list:
+        if isinstance(block, pd.DataFrame):
+            columns = [cls._frame_column(block.iloc[:, i], nullable[i]) for i in range(block.shape[1])]
+        else:
+            columns = list(block)
+        for i, col_type in enumerate(col_types):
+            # pandas хранит даты с точностью до секунд
+            if col_type == 'date' and isinstance(columns[i], np.ndarray) and columns[i].dtype.kind == 'M':
+                columns[i] = columns[i].astype('datetime64[D]')
+        for i in text_columns:
+            columns[i] = [None if value is None else str(value) for value in columns[i]]
+        return columns
+
+    @staticmethod
+    def _frame_column(series: pd.Series, nullable: bool) -> np.ndarray | list:
+        """
+        Колонка DataFrame массивом numpy. NULL в датах и времени остаются NaT,
+        колонки Nullable других типов с NULL передаются списком python-объектов с None
+        """
+        if series.dtype.kind == 'M':
+            # время с часовым поясом приводится к UTC
+            return np.asarray(series.values)
+        if nullable and series.hasnans:
+            return series.to_numpy(dtype=object, na_value=None).tolist()
+        if isinstance(series.dtype, np.dtype):
+            return series.to_numpy()
+        # массивы pandas с маской без NULL и строки
+        return series.to_numpy(dtype=getattr(series.dtype, 'numpy_dtype', object))
+
+    @staticmethod
+    def _to_rows(block, text_columns: list[int]) -> list:
+        if not text_columns:
+            return block
+        rows = []
+        for row in block:
+            row = list(row)
+            for i in text_columns:
+                if row[i] is not None:
+                    row[i] = str(row[i])
+            rows.append(row)
+        return rows
 
     async def cancel(self, query_guid: str):
         await asyncio.to_thread(self._cancel, query_guid)
 
     def _cancel(self, query_guid: str):
-        client = clickhouse_connect.get_client(dsn=self._conn_string)
-        try:
+        with clickhouse_pools.get(self._conn_string).client() as client:
             res = client.query(
                 "select query_id, query "
                 "from system.processes "
@@ -130,8 +370,6 @@ class ClickHouseRunner(QueryRunner):
                 "where query_id=%s",
                 (pid,)
             )
-        finally:
-            client.close()
 
 
 class QueryRunnerFactory:
@@ -0,0 +1,108 @@
+import re
+import hashlib
+import logging
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from executor_service.models.queries import QueryResultCache, QueryDestination, QueryDestinationStatus
+from executor_service.settings import settings
+
+
+LOG = logging.getLogger(__name__)
+
+# строковые литералы и идентификаторы в кавычках сохраняются как есть, остальные пробелы схлопываются
+_TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\s+")
+
+
+def normalize_query(query: str) -> str:
+    query = _TOKENS.sub(lambda m: m.group() if m.group()[0] in '\'"' else ' ', query.strip())
+    return query.rstrip('; ')
+
+
+def cache_key(query: str, conn_string: str) -> str:
+    """
+    Ключ кэша результата: хэш нормализованного текста запроса и расшифрованной строки подключения
+    """
+    data = f'{normalize_query(query)}\0{conn_string}'
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+async def lookup(session: AsyncSession, key: str) -> QueryResultCache | None:
+    """
+    Ищет действующую запись кэша и отмечает ее использование.
+    Запись действует, пока на ее таблицу ссылается загруженный получатель: удаленная таблица из кэша не выдается
+    """
+    uploaded = (
+        select(QueryDestination.id)
+        .where(QueryDestination.dest_type == 'table')
+        .where(QueryDestination.path == QueryResultCache.db_table)
+        .where(QueryDestination.status == QueryDestinationStatus.UPLOADED.value)
+    )
+    entry = await session.execute(
+        select(QueryResultCache)
+        .where(QueryResultCache.key == key)
+        .where(uploaded.exists())
+        .with_for_update(of=QueryResultCache)
+    )
+    entry = entry.scalars().first()
+    if entry is None:
+        return None
+
+    now = datetime.utcnow()
+    if now - entry.created_at >= timedelta(seconds=settings.result_cache_ttl):
+        return None
+    entry.last_used_at = now
+    return entry
+
+
+async def store(session: AsyncSession, key: str, query_id: int, db_table: str):
+    """
+    Сохраняет таблицу результатов в кэш и вытесняет просроченные записи и самые давно использованные
+    сверх result_cache_max_entries. Вытесняются только записи кэша: таблицы остаются у запусков,
+    которые их загрузили, и удаляются вместе с их результатами
+    """
+    if settings.result_cache_ttl <= 0 or settings.result_cache_max_entries <= 0:
+        return
+
+    now = datetime.utcnow()
+    entry = await session.execute(
+        select(QueryResultCache)
+        .where(QueryResultCache.key == key)
+        .with_for_update()
+    )
+    entry = entry.scalars().first()
+    if entry is None:
+        session.add(QueryResultCache(key=key, query_id=query_id, db_table=db_table, created_at=now, last_used_at=now))
+    else:
+        entry.query_id = query_id
+        entry.db_table = db_table
+        entry.created_at = now
+        entry.last_used_at = now
+    await session.flush()
+
+    expired = await session.execute(
+        select(QueryResultCache.id)
+        .where(QueryResultCache.key != key)
+        .where(QueryResultCache.created_at <= now - timedelta(seconds=settings.result_cache_ttl))
+    )
+    overflow = await session.execute(
+        select(QueryResultCache.id)
+        .where(QueryResultCache.key != key)
+        .order_by(QueryResultCache.last_used_at.desc())
+        .offset(settings.result_cache_max_entries - 1)
+    )
+    stale = {*expired.scalars().all(), *overflow.scalars().all()}
+    if stale:
+        await session.execute(delete(QueryResultCache).where(QueryResultCache.id.in_(list(stale))))
+        LOG.info(f'Evicted {len(stale)} result cache entries')
+
+
+async def forget(session: AsyncSession, db_tables: list[str]):
+    """
+    Убирает из кэша удаленные таблицы результатов
+    """
+    if db_tables:
+        await session.execute(delete(QueryResultCache).where(QueryResultCache.db_table.in_(db_tables)))
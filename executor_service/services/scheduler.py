@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Awaitable, Callable
+
+from executor_service.errors import QueueFullError
+
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass(order=True)
+class _Entry:
+    priority: int
+    seq: int
+    query_id: int = field(compare=False)
+    conn_string: str = field(compare=False, repr=False)
+
+
+class ExecutionScheduler:
+    """
+    Очередь выполнения запросов с ограничением числа одновременно выполняемых запросов
+    глобально и на каждую базу данных источника.
+    Запросы с большим приоритетом выполняются раньше, при равном приоритете — в порядке поступления
+    """
+    def __init__(self, run: Callable[[int, str], Awaitable[None]],
+                 max_running: int, max_running_per_db: int, max_queued: int):
+        self._run = run
+        self._max_running = max_running
+        self._max_running_per_db = max_running_per_db
+        self._max_queued = max_queued
+
+        self._queue: list[_Entry] = []
+        self._queued: dict[int, _Entry] = {}
+        self._seq = itertools.count()
+        self._running: dict[int, asyncio.Task] = {}
+        self._running_per_db = Counter()
+        self._waiters: dict[int, asyncio.Future] = {}
+
+    @property
+    def running_count(self) -> int:
+        return len(self._running)
+
+    @property
+    def queued_count(self) -> int:
+        return len(self._queue)
+
+    def check_capacity(self):
+        if len(self._queue) >= self._max_queued:
+            raise QueueFullError()
+
+    def submit(self, query_id: int, conn_string: str, priority: int = 0) -> int:
+        """
+        Ставит запрос в очередь
+        :return: Позиция в очереди, 0 если запрос сразу запущен
+        """
+        entry = _Entry(-priority, next(self._seq), query_id, conn_string)
+        heapq.heappush(self._queue, entry)
+        self._queued[query_id] = entry
+        self._dispatch()
+        return self.position(query_id) or 0
+
+    async def wait(self, query_id: int):
+        """
+        Ожидает завершения запроса, поставленного в очередь через submit
+        """
+        if query_id not in self._running and query_id not in self._queued:
+            return
+        waiter = self._waiters.setdefault(query_id, asyncio.get_running_loop().create_future())
+        await asyncio.shield(waiter)
+
+    def position(self, query_id: int) -> int | None:
+        """
+        Позиция запроса в очереди: число запросов, которые будут запущены раньше него, плюс один.
+        Очередь не сортируется, записи только сравниваются с записью запроса
+        """
+        entry = self._queued.get(query_id)
+        if entry is None:
+            return None
+        return 1 + sum(other < entry for other in self._queue)
+
+    def discard(self, query_id: int) -> bool:
+        """
+        Убирает из очереди еще не запущенный запрос
+        """
+        entry = self._queued.pop(query_id, None)
+        if entry is None:
+            return False
+        self._queue.remove(entry)
+        heapq.heapify(self._queue)
+        self._wake(query_id)
+        return True
+
+    def _dispatch(self):
+        deferred = []
+        while self._queue and len(self._running) < self._max_running:
+            entry = heapq.heappop(self._queue)
+            if self._running_per_db[entry.conn_string] >= self._max_running_per_db:
+                deferred.append(entry)
+                continue
+            self._start(entry)
+
+        for entry in deferred:
+            heapq.heappush(self._queue, entry)
+
+    def _start(self, entry: _Entry):
+        LOG.info(f'Starting run {entry.query_id}, {len(self._queue)} runs left in queue')
+        self._queued.pop(entry.query_id, None)
+        task = asyncio.create_task(self._run(entry.query_id, entry.conn_string))
+        self._running[entry.query_id] = task
+        self._running_per_db[entry.conn_string] += 1
+        task.add_done_callback(partial(self._finished, entry))
+
+    def _finished(self, entry: _Entry, _task: asyncio.Task):
+        self._running.pop(entry.query_id, None)
+        self._running_per_db[entry.conn_string] -= 1
+        if not self._running_per_db[entry.conn_string]:
+            del self._running_per_db[entry.conn_string]
+        self._wake(entry.query_id)
+        self._dispatch()
+
+    def _wake(self, query_id: int):
+        waiter = self._waiters.pop(query_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
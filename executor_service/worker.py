@@ -0,0 +1,54 @@
+# type: ignore[attr-defined]
+import asyncio
+import logging
+
+from prometheus_client import start_http_server
+
+from executor_service import metrics
+from executor_service.logger_config import config_logger
+from executor_service.mq import create_channel, consume, publisher
+from executor_service.database.results import open_results_pool, close_results_pool
+from executor_service.database.sources import close_source_pools
+from executor_service.services.executor import execute_task
+from executor_service.services.outbox import relay
+from executor_service.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    """
+    Воркер выполнения запросов: забирает задачи из execute_task_queue.
+    Одновременно выполняется не больше max_running_queries задач, брокер выдает не больше
+    max_running_queries неподтвержденных задач, подтверждение отправляется после завершения выполнения
+    """
+    if settings.worker_metrics_port:
+        start_http_server(settings.worker_metrics_port)
+    await open_results_pool()
+    try:
+        async with create_channel() as channel:
+            await channel.queue_declare(settings.execute_task_queue)
+
+        tasks = [relay()]
+        if settings.worker_metrics_port:
+            # сервер метрик работает в своем потоке и читает только снимки, снятые в событийном цикле
+            tasks.append(metrics.refresh_gauges(settings.worker_metrics_refresh_interval))
+        await asyncio.gather(
+            *tasks,
+            consume(
+                settings.execute_task_queue,
+                execute_task,
+                prefetch_count=settings.max_running_queries,
+                concurrency=settings.max_running_queries
+            )
+        )
+    finally:
+        await publisher.close()
+        await close_results_pool()
+        await close_source_pools()
+
+
+if __name__ == "__main__":
+    config_logger()
+    logger.info("Starting query executor worker!")
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from executor_service import auth
+from executor_service.endpoints import queries
+from executor_service.models.queries import QueryStatus
+from executor_service.services.page_cache import AccessCache, QueryAccess
+from executor_service.settings import settings
+
+
+def _access(status: str = QueryStatus.DONE.value) -> QueryAccess:
+    return QueryAccess(identity_id='owner', status=status, db_table='results_1', file_path=None)
+
+
+def test_access_cache_lru_and_invalidate():
+    cache = AccessCache(max_entries=2, ttl=60)
+    cache.put('a', _access())
+    cache.put('b', _access())
+    assert cache.get('a') is not None
+    cache.put('c', _access())
+
+    assert cache.get('b') is None
+    cache.invalidate(['a'])
+    assert cache.get('a') is None
+    assert cache.get('c') == _access()
+
+
+@pytest.mark.asyncio
+async def test_only_finished_runs_are_cached(monkeypatch):
+    query = SimpleNamespace(
+        identity_id='owner', status=QueryStatus.RUNNING.value,
+        results=[SimpleNamespace(dest_type='table', path='results_1')]
+    )
+    loads = []
+
+    async def select_query_exec(guid, _user, _session):
+        loads.append(guid)
+        return query
+
+    monkeypatch.setattr(queries, 'select_query_exec', select_query_exec)
+    monkeypatch.setattr(queries, 'access_cache', AccessCache(max_entries=10, ttl=60))
+    owner = {'identity_id': 'owner'}
+
+    assert (await queries.select_query_access('guid', owner, None)).status == QueryStatus.RUNNING.value
+    query.status = QueryStatus.DONE.value
+    assert (await queries.select_query_access('guid', owner, None)).status == QueryStatus.DONE.value
+    assert (await queries.select_query_access('guid', owner, None)).db_table == 'results_1'
+
+    assert loads == ['guid', 'guid']
+
+
+@pytest.fixture
+def jwt_state(monkeypatch):
+    monkeypatch.setattr(auth, '__PUBLIC_KEYS', {'k1': b'key'})
+    monkeypatch.setattr(auth, '__CLAIMS', auth.OrderedDict())
+    monkeypatch.setattr(auth, '__jwks_refresh', None)
+    monkeypatch.setattr(auth, '__jwks_loaded_at', time.monotonic())
+    monkeypatch.setattr(auth.jwt, 'get_unverified_header', lambda token: {'kid': token.split('.')[0]})
+    decoded = []
+
+    def decode(token, key, algorithms):
+        decoded.append(token)
+        return {'identity_id': token, 'exp': time.time() + 3600}
+
+    monkeypatch.setattr(auth.jwt, 'decode', decode)
+    return decoded
+
+
+@pytest.mark.asyncio
+async def test_claims_are_cached_per_token(jwt_state, monkeypatch):
+    monkeypatch.setattr(settings, 'jwt_cache_max_entries', 1)
+
+    assert await auth.decode_jwt('k1.a') == await auth.decode_jwt('k1.a')
+    await auth.decode_jwt('k1.b')
+    await auth.decode_jwt('k1.a')
+
+    assert jwt_state == ['k1.a', 'k1.b', 'k1.a']
+
+
+@pytest.mark.asyncio
+async def test_unknown_key_is_loaded_once(jwt_state, monkeypatch):
+    loads = []
+
+    async def load_jwks():
+        loads.append(True)
+        await asyncio.sleep(0)
+        getattr(auth, '__PUBLIC_KEYS')['k2'] = b'key2'
+
+    monkeypatch.setattr(auth, 'load_jwks', load_jwks)
+    monkeypatch.setattr(auth, '__jwks_loaded_at', 0.0)
+
+    await asyncio.gather(auth.decode_jwt('k2.a'), auth.decode_jwt('k2.b'))
+    assert loads == [True]
+
+    # ключи только что загружены, неизвестный kid не вызывает новую загрузку
+    monkeypatch.setattr(auth, '__jwks_loaded_at', time.monotonic())
+    with pytest.raises(KeyError):
+        await auth.decode_jwt('k3.a')
+    assert loads == [True]
@@ -0,0 +1,76 @@
+import logging
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import psycopg
+import pytest
+from clickhouse_connect.driver.exceptions import StreamFailureError
+
+from executor_service.services import query_runner
+from executor_service.services.query_runner import ClickHouseRunner
+
+
+class _Stream:
+    """
+    Поток блоков ClickHouse, который обрывается ошибкой после переданных блоков
+    """
+    def __init__(self, blocks: list, error: Exception | None = None):
+        self.source = SimpleNamespace(
+            column_names=['id'],
+            column_types=[SimpleNamespace(base_type='Int64', nullable=False, tzinfo=None)]
+        )
+        self._blocks = blocks
+        self._error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __iter__(self):
+        yield from self._blocks
+        if self._error is not None:
+            raise self._error
+
+
+@pytest.fixture
+def runner(monkeypatch):
+    @contextmanager
+    def client():
+        yield None
+
+    monkeypatch.setattr(query_runner.clickhouse_pools, 'get', lambda _conn_string: SimpleNamespace(client=client))
+    return ClickHouseRunner(query_id=1, conn_string='clickhouse://source')
+
+
+def _streaming(runner: ClickHouseRunner, stream: _Stream):
+    runner._open_stream = lambda _client, _query, _columnar: stream
+
+
+@pytest.mark.asyncio
+async def test_killed_stream_is_cancelled(runner):
+    _streaming(runner, _Stream([[(1,)]], StreamFailureError('Code: 394. DB::Exception: Query was cancelled')))
+    collected = []
+
+    async def save(col_names, col_types, rows):
+        async for row in rows:
+            collected.append(row)
+
+    with pytest.raises(psycopg.errors.QueryCanceled):
+        await runner._execute('select 1', save)
+    assert collected == [(1,)]
+
+
+@pytest.mark.asyncio
+async def test_stream_error_is_logged_when_save_fails(runner, caplog):
+    _streaming(runner, _Stream([[(1,)]], StreamFailureError('Code: 241. DB::Exception: Memory limit exceeded')))
+
+    async def save(col_names, col_types, rows):
+        async for _row in rows:
+            raise OSError('disk is full')
+
+    with caplog.at_level(logging.ERROR, logger=query_runner.__name__):
+        with pytest.raises(OSError):
+            await runner._execute('select 1', save)
+    assert any('Memory limit exceeded' in str(record.exc_info[1]) for record in caplog.records if record.exc_info)
@@ -0,0 +1,69 @@
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from uuid import UUID
+
+import numpy as np
+import pytest
+
+from executor_service._columnar_io import ColumnarReader, columnar_reader, columnar_writer
+
+
+ROWS = [
+    (1, Decimal('1.10'), date(2024, 1, 2), datetime(2024, 1, 2, 3, 4, 5, 6, tzinfo=timezone.utc),
+     UUID(int=1), timedelta(days=1, seconds=2), 'a'),
+    (2, None, None, None, None, None, None),
+    (3, Decimal('-3'), date(1970, 1, 1), datetime(1970, 1, 1), UUID(int=3), timedelta(0), ''),
+]
+NAMES = ['id', 'amount', 'day', 'at', 'uid', 'span', 'name']
+TYPES = ['int8', 'numeric', 'date', 'timestamptz', 'uuid', 'interval', 'text']
+
+
+def test_rows_round_trip(tmp_path):
+    path = str(tmp_path / 'spill')
+    with columnar_writer(path, NAMES, TYPES, block_size=2) as writer:
+        writer.writerows(ROWS)
+
+    with columnar_reader(path) as reader:
+        assert (reader.names, reader.types) == (NAMES, TYPES)
+        assert list(reader) == ROWS
+        assert [len(batch) for batch in reader.batches()] == [2, 1]
+    assert writer.rows == 3
+
+
+def test_numpy_columns_are_read_from_mmap(tmp_path):
+    path = str(tmp_path / 'spill')
+    ids = np.arange(5, dtype=np.int64)
+    days = np.array(['2024-01-01', 'NaT', '2024-01-03', '2024-01-04', '2024-01-05'], dtype='datetime64[D]')
+    with columnar_writer(path, ['id', 'day', 'name'], ['int8', 'date', 'text'], block_size=100) as writer:
+        writer.write_columns([ids, days, list('abcde')])
+        writer.write_columns([ids[:2] + 5, days[:2], ['f', 'g']])
+
+    with columnar_reader(path) as reader:
+        assert reader.column_dtypes() == [np.dtype('int64'), np.dtype('<M8[D]'), None]
+        blocks = list(reader.column_batches())
+        rows = list(reader)
+        del blocks
+
+    assert np.array_equal(np.concatenate([ids, ids[:2] + 5]), [row[0] for row in rows])
+    assert rows[1] == (1, None, 'b')
+    assert rows[5] == (5, date(2024, 1, 1), 'f')
+
+
+def test_column_dtypes_differ_between_blocks(tmp_path):
+    path = str(tmp_path / 'spill')
+    with columnar_writer(path, ['id'], ['int8'], block_size=100) as writer:
+        writer.write_columns([np.arange(2, dtype=np.int64)])
+        writer.write_columns([[None, 3]])
+
+    with columnar_reader(path) as reader:
+        assert reader.column_dtypes() == [None]
+        assert list(reader) == [(0,), (1,), (None,), (3,)]
+
+
+def test_rejects_other_formats(tmp_path):
+    path = tmp_path / 'spill'
+    path.write_bytes(b'not a columnar file')
+
+    with open(path, 'rb') as fd:
+        with pytest.raises(ValueError):
+            ColumnarReader(fd)
@@ -0,0 +1,121 @@
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import psycopg
+import pytest
+from psycopg import pq, sql
+from psycopg.adapt import PyFormat, Transformer
+
+from executor_service.services import executor
+
+
+NAMES = ['doc', 'addr', 'name']
+TYPES = ['jsonb', 'inet', 'text']
+ROWS = [[{'a': [1, 2]}, '10.0.0.1', 'first'], [None, None, None], [[1, 'b'], '10.0.0.2', 'third']]
+
+
+class _Copy:
+    def __init__(self, fail: bool):
+        self.rows = []
+        self._fail = fail
+        self._transformer = Transformer()
+        self._format = PyFormat.TEXT
+
+    def set_types(self, oids):
+        self._transformer.set_dumper_types(oids, pq.Format.BINARY)
+        self._format = PyFormat.BINARY
+
+    async def write_row(self, row):
+        if self._fail:
+            raise psycopg.errors.BadCopyFileFormat()
+        # адаптация значений так же, как в COPY
+        self.rows.append([
+            None if value is None else bytes(value)
+            for value in self._transformer.dump_sequence(row, [self._format] * len(row))
+        ])
+
+
+class _Cursor:
+    def __init__(self, fail_copy: bool = False):
+        self.adapters = psycopg.adapters
+        self.copy_ = _Copy(fail_copy)
+        self.executed = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @asynccontextmanager
+    async def copy(self, statement):
+        self.executed.append(str(statement))
+        yield self.copy_
+
+    async def execute(self, statement, params=None):
+        self.executed.append(statement)
+
+    def mogrify(self, template, params):
+        return template % tuple(sql.Literal(value).as_string(None) for value in params)
+
+
+async def _batches(rows):
+    yield rows
+
+
+@asynccontextmanager
+async def _transaction():
+    yield
+
+
+@pytest.mark.asyncio
+async def test_text_copy_adapts_json():
+    cursor = _Cursor()
+
+    await executor._copy_into_table(cursor, 'results_1', NAMES, TYPES, _batches(ROWS))
+
+    assert 'BINARY' not in cursor.executed[0]
+    assert cursor.copy_.rows == [
+        [b'{"a": [1, 2]}', b'10.0.0.1', b'first'],
+        [None, None, None],
+        [b'[1, "b"]', b'10.0.0.2', b'third'],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_binary_copy_adapts_json():
+    cursor = _Cursor()
+    rows = [[row[0], row[2]] for row in ROWS]
+
+    await executor._copy_into_table(cursor, 'results_1', ['doc', 'name'], ['jsonb', 'text'], _batches(rows))
+
+    assert 'BINARY' in cursor.executed[0]
+    assert cursor.copy_.rows == [
+        [b'\x01{"a": [1, 2]}', b'first'],
+        [None, None],
+        [b'\x01[1, "b"]', b'third'],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_insert_fallback_adapts_json(monkeypatch):
+    cursor = _Cursor(fail_copy=True)
+
+    @asynccontextmanager
+    async def connection():
+        yield SimpleNamespace(transaction=_transaction)
+
+    async def create_access(_cursor, _query_id, _table_name):
+        return {}
+
+    monkeypatch.setattr(executor.results_pool, 'connection', connection)
+    monkeypatch.setattr(executor.psycopg, 'AsyncClientCursor', lambda _con: cursor)
+    monkeypatch.setattr(executor, '_create_access', create_access)
+
+    await executor._upload_into_table(
+        SimpleNamespace(id=1, guid='guid'), NAMES, TYPES, _batches(ROWS), fallback=lambda: iter(ROWS)
+    )
+
+    insert = cursor.executed[-1]
+    assert insert.startswith('INSERT INTO results_1')
+    assert '\'{"a": [1, 2]}\'::jsonb' in insert and '\'[1, "b"]\'::jsonb' in insert
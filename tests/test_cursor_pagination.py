@@ -0,0 +1,53 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from executor_service.endpoints import queries
+from executor_service.models.queries import QueryStatus
+from executor_service.services.page_cache import QueryAccess
+
+
+TABLE = [(seq, {'value': seq * 10}) for seq in range(1, 6)]
+
+
+async def get_query_result_page(db_table: str, limit: int, after: int = 0):
+    assert db_table == 'results_1'
+    rows = [(seq, row) for seq, row in TABLE if seq > after][:limit]
+    return [row for _, row in rows], rows[-1][0] if len(rows) == limit else None
+
+
+@pytest.fixture(autouse=True)
+def results(monkeypatch):
+    async def select_query_access(_guid, _user, _session):
+        return QueryAccess(identity_id=None, status=QueryStatus.RUNNING.value, db_table='results_1', file_path=None)
+
+    monkeypatch.setattr(queries, 'select_query_access', select_query_access)
+    monkeypatch.setattr(queries, 'get_query_result_page', get_query_result_page)
+
+
+def test_cursor_round_trip():
+    assert queries.decode_cursor(queries.encode_cursor(12345)) == 12345
+    assert queries.encode_cursor(None) is None
+    assert queries.decode_cursor(None) == 0
+    with pytest.raises(HTTPException) as err:
+        queries.decode_cursor('bm90LWEtbnVtYmVy')
+    assert err.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_pages_follow_next_cursor():
+    values = []
+    cursor = None
+    pages = 0
+    while True:
+        response = await queries.get_result_page('guid', limit=2, cursor=cursor, session=None, user={})
+        page = json.loads(response.body)
+        values.extend(row['value'] for row in page['result'])
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert values == [10, 20, 30, 40, 50]
+    assert pages == 3
@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from executor_service._columnar_io import columnar_writer
+from executor_service.services import executor
+from executor_service.settings import settings
+
+
+@pytest.fixture
+def spill_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'spill')
+    with columnar_writer(path, ['id', 'name'], ['int8', 'text'], 2) as writer:
+        for start in range(0, 6, 2):
+            writer.write_columns([np.arange(start, start + 2), [f'name_{start}', None]])
+
+    opened = []
+    spill_reader = executor.spill_reader
+
+    @contextmanager
+    def counting_reader(path: str):
+        opened.append(path)
+        with spill_reader(path) as reader:
+            yield reader
+
+    monkeypatch.setattr(executor, 'spill_reader', counting_reader)
+    monkeypatch.setattr(settings, 'pipeline_queue_size', 1)
+    return SimpleNamespace(path=path, opened=opened)
+
+
+def _query(*dest_types: str) -> SimpleNamespace:
+    results = [SimpleNamespace(dest_type=dest_type) for dest_type in dest_types]
+    return SimpleNamespace(id=1, guid='guid', results=results)
+
+
+@pytest.mark.asyncio
+async def test_destinations_share_one_read(spill_path, monkeypatch):
+    received = {}
+
+    async def upload_into_table(query, names, types, batches, fallback=None, columnar=False):
+        received['table'] = (columnar, [block[0].tolist() async for block in batches], fallback is not None)
+        return f'results_{query.id}', {}
+
+    async def write_into_file(query, names, types, batches, columnar=False):
+        received['file'] = (columnar, [block[1] async for block in batches])
+        return f'results_{query.id}.parquet', {}
+
+    monkeypatch.setattr(executor, '_upload_into_table', upload_into_table)
+    monkeypatch.setattr(executor, '_write_into_file', write_into_file)
+
+    results = await executor._load_results(_query('table', 'file'), spill_path.path, {}, {})
+
+    assert results == {'table': ('results_1', {}), 'file': ('results_1.parquet', {})}
+    assert spill_path.opened == [spill_path.path]
+    assert received == {
+        'table': (True, [[0, 1], [2, 3], [4, 5]], True),
+        'file': (True, [['name_0', None], ['name_2', None], ['name_4', None]]),
+    }
+
+
+@pytest.mark.asyncio
+async def test_table_falls_back_without_stalling_other_destinations(spill_path, monkeypatch):
+    received = {}
+
+    async def upload_into_table(query, names, types, batches, fallback=None, columnar=False):
+        async for _block in batches:
+            # COPY упал на первом блоке, строки перечитываются из файла
+            received['table'] = list(fallback())
+            return f'results_{query.id}', {}
+
+    async def write_into_file(query, names, types, batches, columnar=False):
+        received['file'] = [block[0].tolist() async for block in batches]
+        return f'results_{query.id}.parquet', {}
+
+    monkeypatch.setattr(executor, '_upload_into_table', upload_into_table)
+    monkeypatch.setattr(executor, '_write_into_file', write_into_file)
+
+    results = await executor._load_results(_query('table', 'file'), spill_path.path, {}, {})
+
+    assert results == {'table': ('results_1', {}), 'file': ('results_1.parquet', {})}
+    assert received['table'] == [(0, 'name_0'), (1, None), (2, 'name_2'), (3, None), (4, 'name_4'), (5, None)]
+    assert received['file'] == [[0, 1], [2, 3], [4, 5]]
@@ -0,0 +1,48 @@
+from executor_service import metrics, mq
+from executor_service.metrics import _CallbackGauges
+
+
+def _samples(gauges: _CallbackGauges) -> dict[tuple, float]:
+    return {
+        (family.name, *sample.labels.values()): sample.value
+        for family in gauges.collect() for sample in family.samples
+    }
+
+
+def test_collect_reads_snapshot_once_taken():
+    state = {('a',): 1}
+    gauges = _CallbackGauges()
+    gauges.add('pool_size', 'Pool size', ['pool'], lambda: state)
+
+    assert _samples(gauges) == {('pool_size', 'a'): 1}
+
+    gauges.take_snapshot()
+    state[('a',)] = 2
+    state[('b',)] = 3
+    assert _samples(gauges) == {('pool_size', 'a'): 1}
+
+    gauges.take_snapshot()
+    assert _samples(gauges) == {('pool_size', 'a'): 2, ('pool_size', 'b'): 3}
+
+
+def test_consumer_stats_are_exported(monkeypatch):
+    stats = mq.ConsumerStats('tasks', prefetch_count=4, concurrency=2)
+    stats.received = 3
+    for failed in (False, True):
+        stats.start()
+        stats.finish(0.1, failed)
+    stats.start()
+    monkeypatch.setattr(mq, 'consumer_stats', {'tasks': stats})
+
+    gauges = _CallbackGauges()
+    gauges.add('consumer', 'Consumer', ['queue', 'state'], mq._consumer_gauges)
+
+    assert _samples(gauges) == {
+        ('consumer', 'tasks', 'prefetch'): 4,
+        ('consumer', 'tasks', 'concurrency'): 2,
+        ('consumer', 'tasks', 'backlog'): 0,
+        ('consumer', 'tasks', 'in_flight'): 1,
+        ('consumer', 'tasks', 'acked'): 1,
+        ('consumer', 'tasks', 'failed'): 1,
+    }
+    assert any(name == 'query_executor_consumer_messages' for name, *_ in metrics._callback_gauges._gauges)
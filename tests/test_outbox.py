@@ -0,0 +1,82 @@
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.orm import Session
+
+from executor_service.models.queries import OutboxEvent
+from executor_service.services import outbox
+
+
+class _Session:
+    def __init__(self, events: list[OutboxEvent]):
+        self._events = events
+        self.deleted: list[str] = []
+        self.committed = False
+
+    async def execute(self, statement):
+        if statement.is_select:
+            return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: self._events))
+        self.deleted.append(str(statement.compile(compile_kwargs={'literal_binds': True})))
+
+    async def commit(self):
+        self.committed = True
+
+
+@pytest.fixture
+def relay_session(monkeypatch):
+    events = [OutboxEvent(id=i, exchange='execute', routing_key='result', body=f'{{"run_id": {i}}}') for i in (1, 2, 3)]
+    session = _Session(events)
+
+    @asynccontextmanager
+    async def db_session():
+        yield session
+
+    monkeypatch.setattr(outbox, 'db_session', db_session)
+    return session
+
+
+@pytest.mark.asyncio
+async def test_relay_deletes_only_confirmed_events(relay_session, monkeypatch):
+    published = []
+
+    async def publish(exchange, routing_key, body):
+        if body == '{"run_id": 2}':
+            raise ConnectionError('nacked')
+        published.append((exchange, routing_key, body))
+
+    monkeypatch.setattr(outbox.publisher, 'publish', publish)
+
+    assert await outbox._relay_batch() == 2
+
+    assert published == [('execute', 'result', '{"run_id": 1}'), ('execute', 'result', '{"run_id": 3}')]
+    assert len(relay_session.deleted) == 1 and 'IN (1, 3)' in relay_session.deleted[0]
+    assert relay_session.committed
+
+
+@pytest.mark.asyncio
+async def test_empty_outbox(monkeypatch):
+    session = _Session([])
+
+    @asynccontextmanager
+    async def db_session():
+        yield session
+
+    monkeypatch.setattr(outbox, 'db_session', db_session)
+
+    assert await outbox._relay_batch() == 0
+    assert session.deleted == []
+
+
+def test_commit_with_status_event_wakes_relay():
+    outbox._wakeup.clear()
+    session = Session()
+
+    session.commit()
+    assert not outbox._wakeup.is_set()
+
+    session.info['outbox'] = True
+    session.commit()
+    assert outbox._wakeup.is_set()
+    assert 'outbox' not in session.info
+    outbox._wakeup.clear()
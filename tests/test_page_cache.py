@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from executor_service.endpoints import queries
+from executor_service.models.queries import QueryStatus
+from executor_service.services import page_cache as page_cache_module
+from executor_service.services.page_cache import PageCache, QueryAccess
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(page_cache_module, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_evicts_least_recently_used_pages():
+    cache = PageCache(max_entries=2, max_bytes=100, ttl=60)
+    cache.put('a', 1, identity_id='u', data=b'1')
+    cache.put('a', 2, identity_id='u', data=b'2')
+    assert cache.get('a', 1) == ('u', b'1')
+
+    cache.put('b', 1, identity_id='u', data=b'3')
+
+    assert cache.get('a', 2) is None
+    assert cache.get('a', 1) == ('u', b'1')
+    assert cache.get('b', 1) == ('u', b'3')
+
+
+def test_limits_total_size():
+    cache = PageCache(max_entries=10, max_bytes=10, ttl=60)
+    cache.put('a', 1, identity_id=None, data=b'x' * 6)
+    cache.put('a', 2, identity_id=None, data=b'x' * 6)
+    cache.put('a', 3, identity_id=None, data=b'x' * 11)
+
+    assert cache.get('a', 1) is None
+    assert cache.get('a', 2) is not None
+    assert cache.get('a', 3) is None
+
+
+def test_expires_and_invalidates_pages(clock):
+    cache = PageCache(max_entries=10, max_bytes=100, ttl=60)
+    cache.put('a', 1, identity_id=None, data=b'1')
+    cache.put('a', 2, identity_id=None, data=b'2')
+    cache.put('b', 1, identity_id=None, data=b'3')
+
+    cache.invalidate(['a'])
+    assert cache.get('a', 1) is None and cache.get('a', 2) is None
+
+    clock[0] = 60
+    assert cache.get('b', 1) is None
+
+
+@pytest.mark.asyncio
+async def test_cached_page_is_served_only_to_owner(monkeypatch):
+    loads = []
+
+    async def select_query_access(_guid, _user, _session):
+        return QueryAccess(identity_id='owner', status=QueryStatus.DONE.value, db_table='results_1', file_path=None)
+
+    async def load_page(db_table):
+        loads.append(db_table)
+        return {'result': [{'a': 1}]}
+
+    monkeypatch.setattr(queries, 'select_query_access', select_query_access)
+    monkeypatch.setattr(queries, 'page_cache', PageCache(max_entries=10, max_bytes=1000, ttl=60))
+    owner = {'identity_id': 'owner'}
+
+    first = await queries.cached_page('guid', ('offset', 10, 0), owner, None, load_page)
+    second = await queries.cached_page('guid', ('offset', 10, 0), owner, None, load_page)
+
+    assert first.body == second.body == b'{"result":[{"a":1}]}'
+    assert loads == ['results_1']
+    with pytest.raises(HTTPException) as err:
+        await queries.cached_page('guid', ('offset', 10, 0), {'identity_id': 'other'}, None, load_page)
+    assert err.value.status_code == 401
@@ -0,0 +1,149 @@
+import struct
+
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+from psycopg import pq
+from psycopg.adapt import PyFormat, Transformer
+from psycopg.types.json import Jsonb
+from types import SimpleNamespace
+
+from executor_service._columnar_io import columnar_reader, columnar_writer, column_values
+from executor_service._pg_binary_io import copy_record_dtype, encode_copy_block, encode_copy_columns
+from executor_service.services.executor import _column_dumper
+from executor_service.services.query_runner import ClickHouseRunner
+
+
+def decode_copy_rows(data: bytes, formats: list[str]) -> list[list]:
+    rows = []
+    offset = 0
+    while offset < len(data):
+        count, = struct.unpack_from('>h', data, offset)
+        offset += 2
+        assert count == len(formats)
+        row = []
+        for fmt in formats:
+            length, = struct.unpack_from('>i', data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+                continue
+            assert length == struct.calcsize(fmt)
+            row.append(struct.unpack_from(fmt, data, offset)[0])
+            offset += length
+        rows.append(row)
+    return rows
+
+
+def test_encode_copy_block():
+    types = ['int4', 'float8', 'date', 'timestamp']
+    columns = [
+        np.array([1, -2], dtype=np.int32),
+        np.array([0.5, np.nan]),
+        np.array(['2000-01-02', '1999-12-31'], dtype='datetime64[D]'),
+        np.array(['2000-01-01T00:00:01', '2000-01-01T00:00:00.000002'], dtype='datetime64[us]'),
+    ]
+    record_dtype = copy_record_dtype(types, [column.dtype for column in columns])
+
+    rows = decode_copy_rows(encode_copy_block(record_dtype, types, columns), ['>i', '>d', '>i', '>q'])
+
+    assert rows[0] == [1, 0.5, 1, 1_000_000]
+    assert rows[1][0] == -2 and np.isnan(rows[1][1]) and rows[1][2:] == [-1, 2]
+
+
+def test_encode_copy_block_writes_nat_as_null():
+    types = ['int8', 'date', 'timestamptz']
+    columns = [
+        np.array([1, 2, 3], dtype=np.int64),
+        np.array(['2000-01-03', 'NaT', 'NaT'], dtype='datetime64[D]'),
+        np.array(['NaT', '2000-01-01T00:00:00', 'NaT'], dtype='datetime64[s]'),
+    ]
+    record_dtype = copy_record_dtype(types, [column.dtype for column in columns])
+
+    rows = decode_copy_rows(encode_copy_block(record_dtype, types, columns), ['>q', '>i', '>q'])
+
+    assert rows == [[1, 2, None], [2, None, 0], [3, None, None]]
+
+
+def test_encode_copy_columns_matches_row_encoding():
+    types = ['int8', 'text', 'timestamp', 'jsonb', 'int4', 'float8']
+    columns = [
+        np.array([1, -2, 3], dtype=np.int64),
+        ['first', None, ''],
+        np.array(['2000-01-01T00:00:01', 'NaT', '1999-12-31T23:59:59'], dtype='datetime64[s]'),
+        [{'a': [1, 2]}, None, [1, 'b']],
+        # int64 не помещается в int4 без проверки, такая колонка кодируется по одному значению
+        np.array([7, 8, 9], dtype=np.int64),
+        np.array([0.5, -1.5, 2.0]),
+    ]
+    cursor = SimpleNamespace(adapters=psycopg.adapters, connection=None)
+    oids = [psycopg.adapters.types.get(type_).oid for type_ in types]
+    dumped = []
+
+    def dump(indexes, values):
+        dumped.append(indexes)
+        return _column_dumper(cursor, oids, types)(indexes, values)
+
+    data = encode_copy_columns(types, columns, dump)
+
+    transformer = Transformer(cursor)
+    transformer.set_dumper_types(oids, pq.Format.BINARY)
+    expected = b''
+    for row in zip(*map(column_values, columns)):
+        row = [Jsonb(value) if i == 3 and value is not None else value for i, value in enumerate(row)]
+        expected += struct.pack('>h', len(row))
+        for value in transformer.dump_sequence(row, [PyFormat.BINARY] * len(row)):
+            expected += struct.pack('>i', -1) if value is None else struct.pack('>i', len(value)) + bytes(value)
+
+    assert data == expected
+    assert dumped == [[1, 3, 4]]
+
+
+def test_encode_copy_columns_uses_records_for_fixed_width():
+    types = ['int4', 'date']
+    columns = [np.array([1, 2], dtype=np.int32), np.array(['2000-01-02', 'NaT'], dtype='datetime64[D]')]
+
+    def dump(_indexes, _values):
+        raise AssertionError('fixed width columns are encoded as arrays')
+
+    rows = decode_copy_rows(encode_copy_columns(types, columns, dump), ['>i', '>i'])
+
+    assert rows == [[1, 1], [2, None]]
+
+
+def test_copy_record_dtype_rejects_unsafe_columns():
+    assert copy_record_dtype(['int4'], [np.dtype('int64')]) is None
+    assert copy_record_dtype(['int8'], [None]) is None
+    assert copy_record_dtype(['text'], [np.dtype('int64')]) is None
+    assert copy_record_dtype(['date'], [np.dtype('int32')]) is None
+
+
+def test_clickhouse_nulls_round_trip(tmp_path):
+    # так приходит блок query_df_stream с use_extended_dtypes для колонок Nullable
+    block = pd.DataFrame({
+        'i': pd.array([2 ** 62 + 1, None], dtype='Int64'),
+        'f': pd.array([1.5, None], dtype='Float64'),
+        'd': np.array(['2024-01-02', 'NaT'], dtype='datetime64[s]'),
+        't': np.array(['NaT', '2024-01-02T03:04:05'], dtype='datetime64[s]'),
+        'n': pd.array([7, 8], dtype='Int64'),
+    })
+    types = ['int8', 'float8', 'date', 'timestamp', 'int8']
+    columns = ClickHouseRunner._to_columns(block, types, [True] * 5, [])
+
+    path = str(tmp_path / 'spill')
+    with columnar_writer(path, list(block.columns), types, 100) as writer:
+        writer.write_columns(columns)
+    with columnar_reader(path) as reader:
+        dtypes = reader.column_dtypes()
+        rows = list(reader)
+
+    assert rows == [
+        (2 ** 62 + 1, 1.5, date(2024, 1, 2), None, 7),
+        (None, None, None, datetime(2024, 1, 2, 3, 4, 5), 8),
+    ]
+    # колонки с NULL пишутся объектами и загружаются построчно, NULL не превращается в 0, NaN или дату
+    assert copy_record_dtype(types, dtypes) is None
+    assert dtypes[2:] == [np.dtype('<M8[D]'), np.dtype('<M8[s]'), np.dtype('<i8')]
@@ -0,0 +1,157 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from executor_service.models.queries import QueryDestinationStatus, QueryResultCache
+from executor_service.services import executor, result_cache
+from executor_service.services.page_cache import QueryAccess, access_cache, page_cache
+from executor_service.services.result_cache import cache_key, normalize_query
+
+
+UPLOADED = QueryDestinationStatus.UPLOADED.value
+DELETED = QueryDestinationStatus.DELETED.value
+
+
+def test_normalize_query_keeps_literals():
+    assert normalize_query("  select 'a   b',\n\t\"x  y\"  from t ;  ") == "select 'a   b', \"x  y\" from t"
+
+
+def test_cache_key():
+    assert cache_key('select  1;', 'postgresql://a') == cache_key('select 1', 'postgresql://a')
+    assert cache_key('select 1', 'postgresql://a') != cache_key('select 1', 'postgresql://b')
+    assert cache_key("select 'a  b'", 'postgresql://a') != cache_key("select 'a b'", 'postgresql://a')
+
+
+class _Rows:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+
+class _Session:
+    """
+    Сессия, возвращающая получателей, которые ссылаются на освобождаемые пути, с guid их запусков
+    """
+    def __init__(self, referencing):
+        self._referencing = referencing
+
+    async def execute(self, _statement):
+        return _Rows(self._referencing)
+
+    async def flush(self):
+        pass
+
+
+def _run(query_id: int, guid: str, path: str, dest_type: str = 'table'):
+    dest = SimpleNamespace(query_id=query_id, dest_type=dest_type, path=path, status=UPLOADED)
+    return SimpleNamespace(id=query_id, guid=guid, results=[dest])
+
+
+@pytest.fixture
+def dropped(monkeypatch):
+    dropped = {'tables': [], 'files': [], 'forgotten': []}
+
+    async def delete_query_execs(tables):
+        dropped['tables'].extend(tables)
+
+    async def delete_result_files(paths):
+        dropped['files'].extend(paths)
+
+    async def forget(_session, tables):
+        dropped['forgotten'].extend(tables)
+
+    monkeypatch.setattr(executor, 'delete_query_execs', delete_query_execs)
+    monkeypatch.setattr(executor, 'delete_result_files', delete_result_files)
+    monkeypatch.setattr(executor.result_cache, 'forget', forget)
+    return dropped
+
+
+@pytest.mark.asyncio
+async def test_release_keeps_table_shared_with_cache_hit(dropped):
+    origin = _run(1, 'origin', 'results_1')
+    hit = _run(2, 'hit', 'results_1')
+    session = _Session([(origin.results[0], origin.guid), (hit.results[0], hit.guid)])
+
+    await executor.release_results(session, [origin])
+
+    assert origin.results[0].status == DELETED
+    assert hit.results[0].status == UPLOADED
+    assert dropped == {'tables': [], 'files': [], 'forgotten': []}
+
+
+@pytest.mark.asyncio
+async def test_release_drops_last_reference_and_invalidates_all_runs(dropped):
+    origin = _run(1, 'origin', 'results_1')
+    origin.results[0].status = DELETED
+    hit = _run(2, 'hit', 'results_1')
+    follower = _run(3, 'follower', '/data/results_1.csv', dest_type='file')
+    session = _Session([
+        (origin.results[0], origin.guid),
+        (hit.results[0], hit.guid),
+        (follower.results[0], follower.guid),
+    ])
+    for guid in ('origin', 'hit', 'follower'):
+        page_cache.put(guid, 0, 10, identity_id=None, data=b'[]')
+        access_cache.put(guid, QueryAccess(identity_id=None, status='done', db_table='results_1', file_path=None))
+
+    guids = await executor.release_results(session, [hit, follower])
+
+    assert hit.results[0].status == DELETED and follower.results[0].status == DELETED
+    assert dropped == {'tables': ['results_1'], 'files': ['/data/results_1.csv'], 'forgotten': ['results_1']}
+    assert sorted(guids) == ['follower', 'hit', 'origin']
+    # кэши очищаются вызывающим после фиксации
+    assert page_cache.get('hit', 0, 10) is not None
+
+    executor.invalidate_results(guids)
+    for guid in ('origin', 'hit', 'follower'):
+        assert page_cache.get(guid, 0, 10) is None
+        assert access_cache.get(guid) is None
+
+
+class _CacheSession:
+    """
+    Сессия, которая запоминает выполненные запросы и возвращает их результаты по очереди
+    """
+    def __init__(self, *results: list):
+        self._results = list(results)
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        rows = self._results.pop(0) if self._results else []
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(first=lambda: next(iter(rows), None), all=lambda: rows))
+
+    def add(self, _entry):
+        pass
+
+    async def flush(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_lookup_requires_uploaded_table():
+    entry = QueryResultCache(key='k', query_id=1, db_table='results_1', created_at=datetime.utcnow())
+    session = _CacheSession([entry])
+
+    assert await result_cache.lookup(session, 'k') is entry
+
+    statement, = session.statements
+    assert 'EXISTS (SELECT results.id' in statement
+    assert 'results.path = result_cache.db_table AND results.status' in statement
+    assert statement.endswith('FOR UPDATE OF result_cache')
+
+
+@pytest.mark.asyncio
+async def test_store_evicts_only_cache_entries():
+    entry = QueryResultCache(key='k', query_id=1, db_table='results_1')
+    session = _CacheSession([entry], [7], [8])
+
+    await result_cache.store(session, 'k', 2, 'results_2')
+
+    assert (entry.query_id, entry.db_table) == (2, 'results_2')
+    assert session.statements[-1].startswith('DELETE FROM result_cache')
+    assert not any('results.' in statement for statement in session.statements)
@@ -0,0 +1,68 @@
+import csv
+import gzip
+import os
+from datetime import date, datetime
+
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+
+from executor_service._result_file_io import result_file_writer
+
+
+def test_csv_result_file(tmp_path):
+    path = str(tmp_path / 'results.csv.gz')
+    with result_file_writer(path, ['id', 'name'], ['int4', 'text'], 'csv', 10) as writer:
+        writer.writerows([(1, 'a'), (2, None)])
+
+    with gzip.open(path, 'rt', newline='') as fd:
+        assert list(csv.reader(fd)) == [['id', 'name'], ['1', 'a'], ['2', '']]
+
+
+def test_parquet_result_file(tmp_path):
+    path = str(tmp_path / 'results.parquet')
+    with result_file_writer(path, ['id', 'day', 'amount'], ['int8', 'date', 'numeric(10,2)'], 'parquet', 2) as writer:
+        writer.writerows([(1, date(2024, 1, 2), 1.5), (2, None, None)])
+        writer.writerows([(3, date(2024, 1, 3), 2)])
+
+    table = pq.read_table(path)
+    assert table.to_pylist() == [
+        {'id': 1, 'day': date(2024, 1, 2), 'amount': '1.5'},
+        {'id': 2, 'day': None, 'amount': None},
+        {'id': 3, 'day': date(2024, 1, 3), 'amount': '2'},
+    ]
+    assert pq.ParquetFile(path).num_row_groups == 2
+
+
+def test_result_file_from_columns(tmp_path):
+    names = ['id', 'at', 'name']
+    types = ['int4', 'timestamp', 'text']
+    columns = [
+        np.array([1, 2], dtype=np.int64),
+        np.array(['2024-01-02T03:04:05', 'NaT'], dtype='datetime64[s]'),
+        ['a', None],
+    ]
+    rows = [(1, datetime(2024, 1, 2, 3, 4, 5), 'a'), (2, None, None)]
+
+    parquet_path = str(tmp_path / 'results.parquet')
+    with result_file_writer(parquet_path, names, types, 'parquet', 10) as writer:
+        writer.write_columns(columns)
+    assert [tuple(row.values()) for row in pq.read_table(parquet_path).to_pylist()] == rows
+
+    for name, write in (('columns', lambda writer: writer.write_columns(columns)),
+                        ('rows', lambda writer: writer.writerows(rows))):
+        with result_file_writer(str(tmp_path / f'{name}.csv.gz'), names, types, 'csv', 10) as writer:
+            write(writer)
+    with gzip.open(tmp_path / 'columns.csv.gz', 'rt') as from_columns:
+        with gzip.open(tmp_path / 'rows.csv.gz', 'rt') as from_rows:
+            assert from_columns.read() == from_rows.read()
+
+
+def test_failed_parquet_write_removes_file(tmp_path):
+    path = str(tmp_path / 'results.parquet')
+    with pytest.raises(RuntimeError):
+        with result_file_writer(path, ['id'], ['int8'], 'parquet', 10) as writer:
+            writer.writerows([(1,)])
+            raise RuntimeError('load failed')
+
+    assert os.listdir(tmp_path) == []
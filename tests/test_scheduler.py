@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from executor_service.errors import QueueFullError
+from executor_service.services.scheduler import ExecutionScheduler
+
+
+class _Runs:
+    """
+    Запуски, которые завершаются по команде теста
+    """
+    def __init__(self):
+        self.started = []
+        self._done: dict[int, asyncio.Event] = {}
+
+    async def run(self, query_id: int, _conn_string: str):
+        self.started.append(query_id)
+        await self._done.setdefault(query_id, asyncio.Event()).wait()
+
+    async def finish(self, query_id: int):
+        self._done.setdefault(query_id, asyncio.Event()).set()
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+
+@pytest_asyncio.fixture
+async def runs():
+    runs = _Runs()
+    yield runs
+    # отмена запуска освобождает место, и планировщик запускает следующий из очереди
+    while tasks := asyncio.all_tasks() - {asyncio.current_task()}:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_runs_first(runs):
+    scheduler = ExecutionScheduler(runs.run, max_running=1, max_running_per_db=1, max_queued=10)
+
+    assert scheduler.submit(1, 'db') == 0
+    assert scheduler.submit(2, 'db') == 1
+    assert scheduler.submit(3, 'db', priority=5) == 1
+    assert scheduler.submit(4, 'db', priority=5) == 2
+    await asyncio.sleep(0)
+
+    for query_id in (1, 3, 4):
+        await runs.finish(query_id)
+    assert runs.started == [1, 3, 4, 2]
+
+
+@pytest.mark.asyncio
+async def test_per_db_limit_does_not_block_other_sources(runs):
+    scheduler = ExecutionScheduler(runs.run, max_running=3, max_running_per_db=1, max_queued=10)
+
+    scheduler.submit(1, 'a')
+    scheduler.submit(2, 'a')
+    scheduler.submit(3, 'b')
+    await asyncio.sleep(0)
+    assert runs.started == [1, 3]
+    assert (scheduler.running_count, scheduler.queued_count) == (2, 1)
+
+    await runs.finish(1)
+    assert runs.started == [1, 3, 2]
+
+
+@pytest.mark.asyncio
+async def test_discard_and_wait(runs):
+    scheduler = ExecutionScheduler(runs.run, max_running=1, max_running_per_db=1, max_queued=1)
+    scheduler.submit(1, 'db')
+    scheduler.submit(2, 'db')
+    with pytest.raises(QueueFullError):
+        scheduler.check_capacity()
+
+    waiter = asyncio.create_task(scheduler.wait(2))
+    await asyncio.sleep(0)
+    assert scheduler.discard(2)
+    await asyncio.wait_for(waiter, 1)
+    assert not scheduler.discard(2)
+
+    await runs.finish(1)
+    await scheduler.wait(1)
+    assert runs.started == [1]
+
+
+@pytest.mark.asyncio
+async def test_position_follows_priority_and_order(runs):
+    scheduler = ExecutionScheduler(runs.run, max_running=1, max_running_per_db=1, max_queued=10)
+    for query_id, priority in [(1, 0), (2, 0), (3, 1), (4, 0), (5, 1)]:
+        scheduler.submit(query_id, 'db', priority)
+
+    assert [scheduler.position(query_id) for query_id in (1, 2, 3, 4, 5)] == [None, 3, 1, 4, 2]
+    scheduler.discard(3)
+    assert [scheduler.position(query_id) for query_id in (2, 4, 5)] == [2, 3, 1]
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+
+from executor_service.services import executor
+from executor_service.settings import settings
+
+
+CONN_STRING = 'postgresql://source/db'
+
+
+def _run(query_id: int, *dest_types: str, query: str = 'select 1'):
+    return SimpleNamespace(id=query_id, query=query, results=[SimpleNamespace(dest_type=t) for t in dest_types])
+
+
+@pytest.fixture(autouse=True)
+def flights(monkeypatch):
+    monkeypatch.setattr(settings, 'single_flight', True)
+    monkeypatch.setattr(settings, 'execution_backend', 'local')
+    monkeypatch.setattr(executor, '_flights', {})
+    monkeypatch.setattr(executor, '_run_flights', {})
+
+
+@pytest.mark.asyncio
+async def test_follower_joins_leader():
+    executor._lead_flight(_run(1, 'table', 'file'), CONN_STRING)
+
+    flight = executor._join_flight(_run(2, 'table', query='select  1;'), CONN_STRING)
+
+    assert flight is not None and flight.leader_id == 1
+    assert flight.participants == {1, 2}
+    assert executor._join_flight(_run(3, 'clickhouse'), CONN_STRING) is None
+    assert executor._join_flight(_run(4, 'table'), 'postgresql://other/db') is None
+
+
+@pytest.mark.asyncio
+async def test_single_flight_is_disabled_with_mq(monkeypatch):
+    monkeypatch.setattr(settings, 'execution_backend', 'mq')
+    executor._lead_flight(_run(1, 'table'), CONN_STRING)
+
+    assert executor._join_flight(_run(2, 'table'), CONN_STRING) is None
+    assert not executor._flights
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader_keeps_running_for_followers():
+    executor._lead_flight(_run(1, 'table'), CONN_STRING)
+    flight = executor._join_flight(_run(2, 'table'), CONN_STRING)
+
+    executor._leave_flight(1)
+    assert executor._flight_needed(1)
+    # после отмены всех участников к выполнению больше нельзя присоединиться
+    executor._leave_flight(2)
+    assert not executor._flight_needed(1)
+    assert executor._join_flight(_run(3, 'table'), CONN_STRING) is None
+
+    executor._finish_flight(1)
+    assert flight.done.done()
+    assert not executor._flights
+
+
+@pytest.mark.asyncio
+async def test_finished_flight_does_not_take_followers():
+    executor._lead_flight(_run(1, 'table'), CONN_STRING)
+    executor._finish_flight(1)
+
+    assert executor._join_flight(_run(2, 'table'), CONN_STRING) is None
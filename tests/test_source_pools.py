@@ -0,0 +1,67 @@
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from pydantic import ValidationError
+
+from executor_service.database import sources
+from executor_service.errors import SourcePoolTimeoutError
+from executor_service.settings import Settings
+
+
+class _Pool:
+    """
+    Пул соединений Postgres, который только запоминает открытие и закрытие
+    """
+    def __init__(self, conn_string: str, **_kwargs):
+        self.conn_string = conn_string
+        self.closed = False
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+    @asynccontextmanager
+    async def connection(self):
+        yield SimpleNamespace(pool=self)
+
+
+@pytest.mark.asyncio
+async def test_pool_with_connections_in_use_is_not_evicted(monkeypatch):
+    monkeypatch.setattr(sources, 'AsyncConnectionPool', _Pool)
+    pools = sources.PostgresPools(max_pools=1, max_size=2, max_idle=300, timeout=1)
+
+    async with pools.connection('a') as busy:
+        async with pools.connection('b') as other:
+            assert not busy.pool.closed
+        assert not other.pool.closed
+
+        async with pools.connection('c'):
+            assert other.pool.closed
+            assert not busy.pool.closed
+
+    async with pools.connection('d'):
+        assert busy.pool.closed
+
+
+def test_clickhouse_client_wait_times_out(monkeypatch):
+    monkeypatch.setattr(sources, 'get_client', lambda dsn: SimpleNamespace(dsn=dsn, close=lambda: None))
+    pool = sources.ClickHouseClientPool('clickhouse://source', max_size=1, max_idle=300, timeout=0.01)
+
+    with pool.client():
+        assert pool.in_use
+        with pytest.raises(SourcePoolTimeoutError):
+            with pool.client():
+                pass
+
+    with pool.client() as client:
+        assert client.dsn == 'clickhouse://source'
+    assert not pool.in_use
+
+
+def test_source_pool_must_exceed_running_queries_per_db():
+    with pytest.raises(ValidationError):
+        Settings(source_pool_max_size=4, max_running_queries_per_db=4)
+    assert Settings(source_pool_max_size=5, max_running_queries_per_db=4).source_pool_max_size == 5
@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import pytest
+
+from executor_service.endpoints import queries
+from executor_service.models.queries import OutboxEvent, QueryStatus
+
+
+class _Session:
+    def __init__(self, status: str):
+        self._status = status
+        self.added = []
+        self.committed = False
+        self.info = {}
+
+    async def refresh(self, query, with_for_update=None):
+        assert with_for_update
+        query.status = self._status
+
+    def add(self, item):
+        self.added.append(item)
+
+    async def commit(self):
+        self.committed = True
+
+
+def _query():
+    return SimpleNamespace(id=1, guid='guid', status=QueryStatus.QUEUED.value, error_description=None)
+
+
+@pytest.mark.asyncio
+async def test_failed_submission_ends_queued_run():
+    query = _query()
+    session = _Session(QueryStatus.QUEUED.value)
+
+    await queries.fail_submission(query, session)
+
+    assert query.status == QueryStatus.ERROR.value
+    assert [type(item) for item in session.added] == [OutboxEvent]
+    assert session.committed
+
+
+@pytest.mark.asyncio
+async def test_failed_submission_keeps_started_run():
+    query = _query()
+    session = _Session(QueryStatus.DONE.value)
+
+    await queries.fail_submission(query, session)
+
+    assert query.status == QueryStatus.DONE.value
+    assert not session.added and not session.committed